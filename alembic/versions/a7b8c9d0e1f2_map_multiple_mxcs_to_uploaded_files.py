@@ -0,0 +1,47 @@
+"""Map multiple mxc URIs to each uploaded file
+
+Revision ID: a7b8c9d0e1f2
+Revises: f6a7b8c9d0e1
+Create Date: 2019-03-14 16:41:08.205731
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "a7b8c9d0e1f2"
+down_revision = "f6a7b8c9d0e1"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table("uploaded_file_mxc",
+                    sa.Column("owner", sa.Integer(), nullable=False),
+                    sa.Column("mxc", sa.String(), nullable=False),
+                    sa.Column("msgtype", sa.String(), nullable=False),
+                    sa.Column("content_hash", sa.String(), nullable=False),
+                    sa.PrimaryKeyConstraint("owner", "mxc", "msgtype"))
+    op.execute("INSERT INTO uploaded_file_mxc (owner, mxc, msgtype, content_hash) "
+               "SELECT owner, mxc, msgtype, content_hash FROM uploaded_file "
+               "WHERE mxc IS NOT NULL AND msgtype IS NOT NULL")
+    op.drop_index("ix_uploaded_file_owner_mxc", "uploaded_file")
+    with op.batch_alter_table("uploaded_file") as batch_op:
+        batch_op.drop_column("mxc")
+        batch_op.drop_column("msgtype")
+
+
+def downgrade():
+    with op.batch_alter_table("uploaded_file") as batch_op:
+        batch_op.add_column(sa.Column("mxc", sa.String(), nullable=True))
+        batch_op.add_column(sa.Column("msgtype", sa.String(), nullable=True))
+    # Only one mxc per file fits in the old schema, so the rest of the mappings are dropped.
+    op.execute("UPDATE uploaded_file SET mxc=("
+               "SELECT MIN(mxc) FROM uploaded_file_mxc AS m "
+               "WHERE m.owner=uploaded_file.owner AND m.content_hash=uploaded_file.content_hash)")
+    op.execute("UPDATE uploaded_file SET msgtype=("
+               "SELECT MIN(msgtype) FROM uploaded_file_mxc AS m "
+               "WHERE m.owner=uploaded_file.owner AND m.mxc=uploaded_file.mxc)")
+    op.create_index("ix_uploaded_file_owner_mxc", "uploaded_file", ["owner", "mxc"])
+    op.drop_table("uploaded_file_mxc")
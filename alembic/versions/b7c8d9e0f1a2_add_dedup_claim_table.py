@@ -0,0 +1,29 @@
+"""Add dedup claim table
+
+Revision ID: b7c8d9e0f1a2
+Revises: f2a3b4c5d6e7
+Create Date: 2019-03-05 21:04:12.730318
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "b7c8d9e0f1a2"
+down_revision = "f2a3b4c5d6e7"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table("dedup_claim",
+                    sa.Column("tgid", sa.Integer(), nullable=False),
+                    sa.Column("tg_receiver", sa.Integer(), nullable=False),
+                    sa.Column("evt_hash", sa.String(), nullable=False),
+                    sa.Column("timestamp", sa.Integer(), nullable=False),
+                    sa.PrimaryKeyConstraint("tgid", "tg_receiver", "evt_hash"))
+
+
+def downgrade():
+    op.drop_table("dedup_claim")
@@ -0,0 +1,30 @@
+"""Add document attributes to uploaded files
+
+Revision ID: b8c9d0e1f2a3
+Revises: a7b8c9d0e1f2
+Create Date: 2019-03-21 12:08:47.519374
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "b8c9d0e1f2a3"
+down_revision = "a7b8c9d0e1f2"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table("uploaded_file") as batch_op:
+        batch_op.add_column(sa.Column("file_name", sa.String(), nullable=True))
+        batch_op.add_column(sa.Column("width", sa.Integer(), nullable=True))
+        batch_op.add_column(sa.Column("height", sa.Integer(), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table("uploaded_file") as batch_op:
+        batch_op.drop_column("height")
+        batch_op.drop_column("width")
+        batch_op.drop_column("file_name")
@@ -0,0 +1,29 @@
+"""Store bridged event in dedup claims
+
+Revision ID: c3d4e5f6a7b8
+Revises: b7c8d9e0f1a2
+Create Date: 2019-03-09 14:37:55.102934
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "c3d4e5f6a7b8"
+down_revision = "b7c8d9e0f1a2"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column("dedup_claim", sa.Column("mxid", sa.String(), nullable=True))
+    op.add_column("dedup_claim", sa.Column("tg_space", sa.Integer(), nullable=True))
+    op.create_index("ix_dedup_claim_timestamp", "dedup_claim", ["timestamp"])
+
+
+def downgrade():
+    op.drop_index("ix_dedup_claim_timestamp", "dedup_claim")
+    with op.batch_alter_table("dedup_claim") as batch_op:
+        batch_op.drop_column("tg_space")
+        batch_op.drop_column("mxid")
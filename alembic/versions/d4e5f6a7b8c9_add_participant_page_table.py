@@ -0,0 +1,29 @@
+"""Add participant page table
+
+Revision ID: d4e5f6a7b8c9
+Revises: c3d4e5f6a7b8
+Create Date: 2019-03-10 16:04:12.519362
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "d4e5f6a7b8c9"
+down_revision = "c3d4e5f6a7b8"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table("participant_page",
+                    sa.Column("channel_id", sa.Integer(), nullable=False),
+                    sa.Column("offset", sa.Integer(), nullable=False),
+                    sa.Column("hash", sa.Integer(), nullable=False),
+                    sa.Column("participants", sa.LargeBinary(), nullable=False),
+                    sa.PrimaryKeyConstraint("channel_id", "offset"))
+
+
+def downgrade():
+    op.drop_table("participant_page")
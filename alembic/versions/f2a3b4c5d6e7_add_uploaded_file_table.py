@@ -0,0 +1,37 @@
+"""Add uploaded file table
+
+Revision ID: f2a3b4c5d6e7
+Revises: a9119be92164
+Create Date: 2019-03-02 18:22:41.281546
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "f2a3b4c5d6e7"
+down_revision = "a9119be92164"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table("uploaded_file",
+                    sa.Column("owner", sa.Integer(), nullable=False),
+                    sa.Column("content_hash", sa.String(), nullable=False),
+                    sa.Column("mxc", sa.String(), nullable=True),
+                    sa.Column("msgtype", sa.String(), nullable=True),
+                    sa.Column("mime_type", sa.String(), nullable=True),
+                    sa.Column("is_photo", sa.Boolean(), nullable=False),
+                    sa.Column("id", sa.BigInteger(), nullable=False),
+                    sa.Column("access_hash", sa.BigInteger(), nullable=False),
+                    sa.Column("file_reference", sa.LargeBinary(), nullable=False),
+                    sa.Column("timestamp", sa.BigInteger(), nullable=True),
+                    sa.PrimaryKeyConstraint("owner", "content_hash"))
+    op.create_index("ix_uploaded_file_owner_mxc", "uploaded_file", ["owner", "mxc"])
+
+
+def downgrade():
+    op.drop_index("ix_uploaded_file_owner_mxc", "uploaded_file")
+    op.drop_table("uploaded_file")
@@ -0,0 +1,35 @@
+"""Add indexes for lookups by username, custom mxid and portal
+
+Revision ID: f6a7b8c9d0e1
+Revises: e5f6a7b8c9d0
+Create Date: 2019-03-12 10:18:52.472913
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = "f6a7b8c9d0e1"
+down_revision = "e5f6a7b8c9d0"
+branch_labels = None
+depends_on = None
+
+indexes = [
+    ("ix_portal_username", "portal", ["username"]),
+    ("ix_puppet_custom_mxid", "puppet", ["custom_mxid"]),
+    ("ix_puppet_username", "puppet", ["username"]),
+    ("ix_puppet_displayname", "puppet", ["displayname"]),
+    ("ix_user_tg_username", "user", ["tg_username"]),
+    # The primary key starts with the user, so the cascades from the portal table need their own.
+    ("ix_user_portal_portal", "user_portal", ["portal", "portal_receiver"]),
+]
+
+
+def upgrade():
+    for name, table, columns in indexes:
+        op.create_index(name, table, columns)
+
+
+def downgrade():
+    for name, table, _ in reversed(indexes):
+        op.drop_index(name, table)
@@ -30,17 +30,20 @@ from alchemysession import AlchemySessionContainer
 
 from .web.provisioning import ProvisioningAPI
 from .web.public import PublicBridgeWebsite
-from .abstract_user import init as init_abstract_user
+from .abstract_user import AbstractUser, init as init_abstract_user
 from .bot import init as init_bot
 from .config import Config
 from .context import Context
-from .db import Base, init as init_db
+from .db import Base, DedupClaim, Message, init as init_db
 from .formatter import init as init_formatter
 from .matrix import MatrixHandler
+from .metrics import init as init_metrics
 from .portal import init as init_portal
 from .puppet import init as init_puppet
+from .sharding import ShardRouter
 from .sqlstatestore import SQLStateStore
 from .user import User, init as init_user
+from .util import RequestScheduler, init_file_transfer, stop_file_transfer
 from . import __version__
 
 parser = argparse.ArgumentParser(
@@ -55,11 +58,15 @@ parser.add_argument("-g", "--generate-registration", action="store_true",
                     help="generate registration and quit")
 parser.add_argument("-r", "--registration", type=str, default="registration.yaml",
                     metavar="<path>", help="the path to save the generated registration to")
+parser.add_argument("--shard", type=int, default=0, metavar="<index>",
+                    help="run as the given worker shard "
+                         "(used internally when sharding is enabled)")
 args = parser.parse_args()
 
 config = Config(args.config, args.registration, args.base_config)
 config.load()
-config.update()
+if args.shard == 0:
+    config.update()
 
 if args.generate_registration:
     config.generate_registration()
@@ -69,7 +76,8 @@ if args.generate_registration:
 
 logging.config.dictConfig(copy.deepcopy(config["logging"]))
 log = logging.getLogger("mau.init")  # type: logging.Logger
-log.debug(f"Initializing mautrix-telegram {__version__}")
+log.debug(f"Initializing mautrix-telegram {__version__}"
+          + (f" (shard {args.shard})" if args.shard else ""))
 
 db_engine = sql.create_engine(config["appservice.database"] or "sqlite:///mautrix-telegram.db")
 Base.metadata.bind = db_engine
@@ -88,7 +96,11 @@ except ImportError:
 
 loop = asyncio.get_event_loop()  # type: asyncio.AbstractEventLoop
 
-state_store = SQLStateStore()
+# Only the front process writes the room state, as the worker shards may see state events later.
+state_store = SQLStateStore(config["appservice.state_store_preload"] or "lazy",
+                            config["appservice.state_store_write_buffer.max_size"] or 0,
+                            config["appservice.state_store_write_buffer.max_delay"] or 1,
+                            persist=args.shard == 0)
 mebibyte = 1024 ** 2
 appserv = AppService(config["homeserver.address"], config["homeserver.domain"],
                      config["appservice.as_token"], config["appservice.hs_token"],
@@ -98,31 +110,93 @@ appserv = AppService(config["homeserver.address"], config["homeserver.domain"],
                      aiohttp_params={
                          "client_max_size": config["appservice.max_body_size"] * mebibyte
                      })
-bot = init_bot(config)
+shards = ShardRouter(loop, config["appservice.sharding.shards"] or 1, args.shard,
+                     config["appservice.port"], config["appservice.hs_token"],
+                     config["appservice.sharding.reload_interval"] or 0)
+shards.add_routes(appserv.app)
+# The relaybot and the web endpoints only run in the front process.
+bot = init_bot(config) if shards.is_front else None
 context = Context(appserv, config, loop, session_container, bot)
-
-if config["appservice.public.enabled"]:
+context.shards = shards
+
+if config["homeserver.request_scheduler.enabled"]:
+    context.request_scheduler = RequestScheduler(
+        loop, max_concurrent=config["homeserver.request_scheduler.max_concurrent"] or 32,
+        rate=config["homeserver.request_scheduler.rate"] or 0,
+        burst=config["homeserver.request_scheduler.burst"] or 1,
+        user_rate=config["homeserver.request_scheduler.user_rate"] or 0,
+        user_burst=config["homeserver.request_scheduler.user_burst"] or 1,
+        max_retries=config["homeserver.request_scheduler.max_retries"] or 0)
+    context.request_scheduler.install()
+
+if shards.is_front and config["appservice.public.enabled"]:
     public_website = PublicBridgeWebsite(loop)
     appserv.app.add_subapp(config["appservice.public.prefix"] or "/public", public_website.app)
     context.public_website = public_website
 
-if config["appservice.provisioning.enabled"]:
+if shards.is_front and config["appservice.provisioning.enabled"]:
     provisioning_api = ProvisioningAPI(context)
     appserv.app.add_subapp(config["appservice.provisioning.prefix"] or "/_matrix/provisioning",
                            provisioning_api.app)
     context.provisioning_api = provisioning_api
 
 context.mx = MatrixHandler(context)
+init_metrics(context)
+
+
+async def flush_message_writes(interval: float) -> None:
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await Message.aio.flush()
+        except Exception:
+            log.exception("Failed to flush buffered message writes")
+
+
+async def prune_dedup_claims(max_age: int) -> None:
+    while True:
+        await asyncio.sleep(60 * 60)
+        try:
+            await DedupClaim.aio.prune(max_age)
+        except Exception:
+            log.exception("Failed to prune message dedup claims")
+
+
+if shards.is_front:
+    listen_host, listen_port = config["appservice.hostname"], config["appservice.port"]
+else:
+    listen_host, listen_port = "127.0.0.1", config["appservice.port"] + args.shard
 
-with appserv.run(config["appservice.hostname"], config["appservice.port"]) as start:
+with appserv.run(listen_host, listen_port) as start:
     start_ts = time()
-    init_db(db_engine)
+    init_db(db_engine, loop, config["appservice.database_threads"] or 1)
+    if state_store.preload == "startup":
+        loop.run_until_complete(state_store.preload_all())
+    if not shards.enabled:
+        # The other shards write to the same tables, so in-memory copies would go stale.
+        Message.enable_cache(config["appservice.message_cache_size"] or 0)
+        Message.enable_write_buffer(config["appservice.message_write_buffer.max_size"] or 0)
+    if Message.write_buffer:
+        asyncio.ensure_future(flush_message_writes(
+            config["appservice.message_write_buffer.max_delay"] or 1), loop=loop)
     init_abstract_user(context)
     init_formatter(context)
+    init_file_transfer(context)
     init_portal(context)
     startup_actions = (init_puppet(context) +
                        init_user(context) +
-                       [start, context.mx.init_as_bot()])  # type: List[Awaitable[Any]]
+                       [start])  # type: List[Awaitable[Any]]
+
+    if shards.is_front:
+        startup_actions.append(context.mx.init_as_bot())
+        if shards.enabled:
+            shards.start_workers(["-c", args.config, "-b", args.base_config,
+                                  "-r", args.registration])
+        if shards.enabled or config["bridge.deduplication.persist"]:
+            asyncio.ensure_future(prune_dedup_claims(config["bridge.deduplication.max_age"]),
+                                  loop=loop)
+    else:
+        asyncio.ensure_future(shards.watch_front(), loop=loop)
 
     if context.bot:
         startup_actions.append(context.bot.start())
@@ -141,10 +215,31 @@ with appserv.run(config["appservice.hostname"], config["appservice.port"]) as st
                   " now running forever")
         loop.run_forever()
     except KeyboardInterrupt:
-        log.debug("Interrupt received, stopping clients")
+        log.debug("Interrupt received, stopping updates")
+        loop.run_until_complete(shards.stop())
+        # The queued handlers may still need the clients, so they're disconnected afterwards.
+        for user in User.by_tgid.values():
+            user.stop_receiving_updates()
+        if context.bot:
+            context.bot.stop_receiving_updates()
+        log.debug("Waiting for queued updates")
+        loop.run_until_complete(AbstractUser.update_dispatcher.drain(timeout=10))
+        AbstractUser.update_dispatcher.stop()
+        log.debug("Updates handled, stopping clients")
         loop.run_until_complete(
             asyncio.gather(*[user.stop() for user in User.by_tgid.values()], loop=loop))
-        log.debug("Clients stopped, shutting down")
+        log.debug("Clients stopped, waiting for queued redactions")
+        try:
+            loop.run_until_complete(
+                asyncio.wait_for(AbstractUser.redaction_queue.join(), timeout=10))
+        except asyncio.TimeoutError:
+            log.warning(f"{AbstractUser.redaction_queue.pending} queued redactions were not sent")
+        log.debug("Redactions sent, waiting for pending database queries")
+        Base.executor.shutdown(wait=True)
+        Message.flush()
+        state_store.flush()
+        stop_file_transfer()
+        log.debug("Database queries finished, shutting down")
         sys.exit(0)
     except Exception as e:
         log.exception("Unexpected error")
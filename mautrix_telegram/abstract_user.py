@@ -14,7 +14,7 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
-from typing import Tuple, Optional, List, Union, TYPE_CHECKING
+from typing import Hashable, Tuple, Optional, List, Union, TYPE_CHECKING
 from abc import ABC, abstractmethod
 import asyncio
 import logging
@@ -27,15 +27,17 @@ from telethon.tl.types import (
     UpdateChatParticipants, UpdateChatUserTyping, UpdateDeleteChannelMessages, UpdateDeleteMessages,
     UpdateEditChannelMessage, UpdateEditMessage, UpdateNewChannelMessage, UpdateNewMessage,
     UpdateReadHistoryOutbox, UpdateShortChatMessage, UpdateShortMessage, UpdateUserName,
-    UpdateUserPhoto, UpdateUserStatus, UpdateUserTyping, User, UserStatusOffline, UserStatusOnline)
+    UpdateUserPhoto, UpdateUserStatus, UpdateUserTyping, User, UserStatusOffline, UserStatusOnline,
+    PeerChat, PeerChannel)
 
-from mautrix_appservice import MatrixRequestError, AppService
+from mautrix_appservice import AppService
 from alchemysession import AlchemySessionContainer
 
 from . import portal as po, puppet as pu, __version__
 from .db import Message as DBMessage
 from .types import TelegramID, MatrixUserID
 from .tgclient import MautrixTelegramClient
+from .util import EphemeralCoalescer, RedactionQueue, UpdateDispatcher
 
 if TYPE_CHECKING:
     from .context import Context
@@ -44,7 +46,9 @@ if TYPE_CHECKING:
 
 config = None  # type: Config
 # Value updated from config in init()
-MAX_DELETIONS = 10  # type: int
+MAX_DELETIONS = 1000  # type: int
+# Matrix and Telegram both consider users offline after a while without presence updates.
+PRESENCE_REFRESH = 60  # type: float
 
 UpdateMessage = Union[UpdateShortChatMessage, UpdateShortMessage, UpdateNewChannelMessage,
                       UpdateNewMessage, UpdateEditMessage, UpdateEditChannelMessage]
@@ -58,6 +62,9 @@ class AbstractUser(ABC):
     az = None  # type: AppService
     bot = None  # type: Bot
     ignore_incoming_bot_events = True  # type: bool
+    update_dispatcher = None  # type: UpdateDispatcher
+    redaction_queue = None  # type: RedactionQueue
+    ephemeral = None  # type: EphemeralCoalescer
 
     def __init__(self) -> None:
         self.is_admin = False  # type: bool
@@ -150,13 +157,78 @@ class AbstractUser(ABC):
     def unregister_portal(self, portal: po.Portal) -> None:
         raise NotImplementedError()
 
+    @abstractmethod
+    def has_portal(self, tgid_full: Tuple[TelegramID, TelegramID]) -> bool:
+        raise NotImplementedError()
+
     async def _update_catch(self, update: TypeUpdate) -> None:
+        if (isinstance(update, (UpdateUserTyping, UpdateChatUserTyping, UpdateUserStatus))
+                and self.ephemeral.overloaded):
+            # Typing and status updates are dropped first so that they don't delay messages.
+            self.ephemeral.shed += 1
+            return
+        key = self._get_update_queue_key(update)
+        if isinstance(update, UpdateDeleteMessages):
+            # The deleted messages could be in any private chat or normal group, so the deletion
+            # has to wait until the messages that were received before it have been handled.
+            await self.update_dispatcher.dispatch_after(self._is_non_channel_queue_key, key,
+                                                        lambda: self._handle_update(update))
+            return
+        await self.update_dispatcher.dispatch(key, lambda: self._handle_update(update))
+
+    async def _handle_update(self, update: TypeUpdate) -> None:
         try:
             if not await self.update(update):
                 await self._update(update)
         except Exception:
             self.log.exception("Failed to handle Telegram update")
 
+    def _get_update_queue_key(self, update: TypeUpdate) -> Hashable:
+        """Get the ``tgid_full`` of the portal an update belongs to without touching the database.
+
+        Updates that can't be mapped to a portal (e.g. private chat deletions, which only contain
+        message IDs) are queued per-user instead, and deletions also wait for the handlers that
+        were queued before them in the user's other queues.
+        """
+        if isinstance(update, (UpdateShortMessage, UpdateUserTyping)):
+            return update.user_id, self.tgid
+        elif isinstance(update, (UpdateShortChatMessage, UpdateChatUserTyping,
+                                 UpdateChatParticipantAdmin, UpdateChatPinnedMessage)):
+            return update.chat_id, update.chat_id
+        elif isinstance(update, UpdateChatParticipants):
+            return update.participants.chat_id, update.participants.chat_id
+        elif isinstance(update, (UpdateDeleteChannelMessages, UpdateChannelPinnedMessage)):
+            return update.channel_id, update.channel_id
+        elif isinstance(update, UpdateReadHistoryOutbox):
+            if isinstance(update.peer, PeerUser):
+                return update.peer.user_id, self.tgid
+            elif isinstance(update.peer, PeerChat):
+                return update.peer.chat_id, update.peer.chat_id
+            elif isinstance(update.peer, PeerChannel):
+                return update.peer.channel_id, update.peer.channel_id
+        elif isinstance(update, (UpdateUserName, UpdateUserPhoto, UpdateUserStatus)):
+            # These update the puppet, not a portal.
+            return "puppet", update.user_id
+        elif isinstance(update, (UpdateNewMessage, UpdateNewChannelMessage, UpdateEditMessage,
+                                 UpdateEditChannelMessage)):
+            to_id = getattr(update.message, "to_id", None)
+            if isinstance(to_id, PeerChannel):
+                return to_id.channel_id, to_id.channel_id
+            elif isinstance(to_id, PeerChat):
+                return to_id.chat_id, to_id.chat_id
+            elif isinstance(to_id, PeerUser):
+                if update.message.out:
+                    return to_id.user_id, self.tgid
+                return update.message.from_id, self.tgid
+        return self.tgid
+
+    def _is_non_channel_queue_key(self, key: Hashable) -> bool:
+        # The dispatcher is shared by all users, so only the queues of this user's chats are
+        # included. Normal groups and channels have the same kind of key, so the user's channels
+        # are included too.
+        return key == self.tgid or (isinstance(key, tuple) and key[0] != "puppet"
+                                    and (key[1] == self.tgid or self.has_portal(key)))
+
     async def get_dialogs(self, limit: int = None) -> List[Union[Chat, Channel]]:
         if self.is_bot:
             return []
@@ -194,6 +266,12 @@ class AbstractUser(ABC):
             await self.start(delete_unless_authenticated=not even_if_no_session)
         return self
 
+    def stop_receiving_updates(self) -> None:
+        """Stop queueing new Telegram updates. The client stays connected, so that the updates
+        that are already queued can still be handled."""
+        if self.client:
+            self.client.remove_event_handler(self._update_catch)
+
     async def stop(self) -> None:
         await self.client.disconnect()
         self.client = None
@@ -250,7 +328,7 @@ class AbstractUser(ABC):
             return
 
         # We check that these are user read receipts, so tg_space is always the user ID.
-        message = DBMessage.get_by_tgid(TelegramID(update.max_id), self.tgid)
+        message = await DBMessage.aio.get_by_tgid(TelegramID(update.max_id), self.tgid)
         if not message:
             return
 
@@ -280,6 +358,8 @@ class AbstractUser(ABC):
     async def update_others_info(self, update: Union[UpdateUserName, UpdateUserPhoto]) -> None:
         # TODO duplication not checked
         puppet = pu.Puppet.get(TelegramID(update.user_id))
+        if puppet.shards.enabled:
+            await puppet.reload()
         if isinstance(update, UpdateUserName):
             puppet.username = update.username
             if await puppet.update_displayname(self, update):
@@ -291,14 +371,18 @@ class AbstractUser(ABC):
             self.log.warning("Unexpected other user info update: %s", update)
 
     async def update_status(self, update: UpdateUserStatus) -> None:
-        puppet = pu.Puppet.get(TelegramID(update.user_id))
         if isinstance(update.status, UserStatusOnline):
-            await puppet.default_mxid_intent.set_presence("online")
+            presence = "online"
         elif isinstance(update.status, UserStatusOffline):
-            await puppet.default_mxid_intent.set_presence("offline")
+            presence = "offline"
         else:
             self.log.warning("Unexpected user status update: %s", update)
-        return
+            return
+        puppet = pu.Puppet.get(TelegramID(update.user_id))
+        intent = puppet.default_mxid_intent
+        self.ephemeral.set(("presence", puppet.default_mxid), presence,
+                           lambda: intent.set_presence(presence, ignore_cache=True),
+                           refresh=PRESENCE_REFRESH)
 
     def get_message_details(self, update: UpdateMessage) -> Tuple[UpdateMessageContent,
                                                                   Optional[pu.Puppet],
@@ -324,43 +408,48 @@ class AbstractUser(ABC):
             return update, None, None
         return update, sender, portal
 
-    @staticmethod
-    async def _try_redact(portal: po.Portal, message: DBMessage) -> None:
-        if not portal:
-            return
-        try:
-            await portal.main_intent.redact(message.mx_room, message.mxid)
-        except MatrixRequestError:
-            pass
+    def _redact(self, portal: Optional[po.Portal], message: DBMessage) -> None:
+        if portal and portal.mxid:
+            self.redaction_queue.redact(portal.main_intent, message.mx_room, message.mxid)
 
-    async def delete_message(self, update: UpdateDeleteMessages) -> None:
+    def _too_many_deletions(self, update: Union[UpdateDeleteMessages, UpdateDeleteChannelMessages]
+                            ) -> bool:
         if len(update.messages) > MAX_DELETIONS:
+            self.log.debug(f"Ignoring deletion of {len(update.messages)} messages "
+                           f"(limit is {MAX_DELETIONS})")
+            return True
+        return False
+
+    async def delete_message(self, update: UpdateDeleteMessages) -> None:
+        if self._too_many_deletions(update):
             return
 
-        for message in update.messages:
-            message = DBMessage.get_by_tgid(TelegramID(message), self.tgid)
-            if not message:
-                continue
-            message.delete()
-            number_left = DBMessage.count_spaces_by_mxid(message.mxid, message.mx_room)
-            if number_left == 0:
-                portal = po.Portal.get_by_mxid(message.mx_room)
-                await self._try_redact(portal, message)
+        messages = await DBMessage.aio.get_many_by_tgid([TelegramID(message_id) for message_id
+                                                         in update.messages], self.tgid)
+        if not messages:
+            return
+        await DBMessage.aio.delete_many(messages)
+        spaces_left = await DBMessage.aio.count_spaces_by_mxids((message.mxid, message.mx_room)
+                                                                for message in messages)
+        for message in messages:
+            if spaces_left[(message.mxid, message.mx_room)] == 0:
+                self._redact(po.Portal.get_by_mxid(message.mx_room), message)
 
     async def delete_channel_message(self, update: UpdateDeleteChannelMessages) -> None:
-        if len(update.messages) > MAX_DELETIONS:
+        if self._too_many_deletions(update):
             return
 
         portal = po.Portal.get_by_tgid(TelegramID(update.channel_id))
         if not portal:
             return
 
-        for message in update.messages:
-            message = DBMessage.get_by_tgid(TelegramID(message), portal.tgid)
-            if not message:
-                continue
-            message.delete()
-            await self._try_redact(portal, message)
+        messages = await DBMessage.aio.get_many_by_tgid([TelegramID(message_id) for message_id
+                                                         in update.messages], portal.tgid)
+        if not messages:
+            return
+        await DBMessage.aio.delete_many(messages)
+        for message in messages:
+            self._redact(portal, message)
 
     async def update_message(self, original_update: UpdateMessage) -> None:
         update, sender, portal = self.get_message_details(original_update)
@@ -402,4 +491,17 @@ def init(context: "Context") -> None:
     AbstractUser.az, config, AbstractUser.loop, AbstractUser.relaybot = context.core
     AbstractUser.ignore_incoming_bot_events = config["bridge.relaybot.ignore_own_incoming_events"]
     AbstractUser.session_container = context.session_container
-    MAX_DELETIONS = config.get("bridge.max_telegram_delete", 10)
+    AbstractUser.update_dispatcher = UpdateDispatcher(
+        AbstractUser.loop, workers=config.get("bridge.update_queue.workers", 8),
+        max_queued=config.get("bridge.update_queue.max_queued", 1000))
+    AbstractUser.redaction_queue = RedactionQueue(
+        AbstractUser.loop, concurrency=config.get("bridge.redaction_queue.concurrency", 5),
+        rate=config.get("bridge.redaction_queue.rate", 10))
+    AbstractUser.ephemeral = EphemeralCoalescer(
+        AbstractUser.loop, delay=config.get("bridge.ephemeral.delay", 0.5),
+        max_tracked=config.get("bridge.ephemeral.max_tracked", 10000))
+    AbstractUser.ephemeral.overload_checks.append(lambda: AbstractUser.update_dispatcher.saturated)
+    if context.request_scheduler:
+        AbstractUser.ephemeral.overload_checks.append(
+            lambda: context.request_scheduler.saturated)
+    MAX_DELETIONS = config.get("bridge.max_telegram_delete", 1000)
@@ -14,7 +14,8 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
-from typing import Awaitable, Callable, Dict, List, Optional, Pattern, TYPE_CHECKING
+from typing import (Awaitable, Callable, Dict, List, Optional, Pattern, Tuple,
+                    TYPE_CHECKING)
 import logging
 import re
 
@@ -115,6 +116,9 @@ class Bot(AbstractUser):
     def unregister_portal(self, portal: po.Portal) -> None:
         self.remove_chat(portal.tgid)
 
+    def has_portal(self, tgid_full: Tuple[TelegramID, TelegramID]) -> bool:
+        return tgid_full[0] in self.chats
+
     def add_chat(self, chat_id: TelegramID, chat_type: str) -> None:
         if chat_id not in self.chats:
             self.chats[chat_id] = chat_type
@@ -55,11 +55,11 @@ async def clear_db_cache(evt: CommandEvent) -> Dict:
     except IndexError:
         return await evt.reply("**Usage:** `$cmdprefix+sp clear-db-cache <section>`")
     if section == "portal":
-        po.Portal.by_tgid = {}
-        po.Portal.by_mxid = {}
+        po.Portal.by_tgid.clear()
+        po.Portal.by_mxid.clear()
         await evt.reply("Cleared portal cache")
     elif section == "puppet":
-        pu.Puppet.cache = {}
+        pu.Puppet.cache.clear()
         for puppet in pu.Puppet.by_custom_mxid.values():
             puppet.sync_task.cancel()
         pu.Puppet.by_custom_mxid = {}
@@ -68,10 +68,9 @@ async def clear_db_cache(evt: CommandEvent) -> Dict:
             loop=evt.loop)
         await evt.reply("Cleared puppet cache and restarted custom puppet syncers")
     elif section == "user":
-        u.User.by_mxid = {
-            user.mxid: user
-            for user in u.User.by_tgid.values()
-        }
+        for mxid, user in u.User.by_mxid.items():
+            if not user.tgid:
+                del u.User.by_mxid[mxid]
         await evt.reply("Cleared non-logged-in user cache")
     else:
         return await evt.reply("**Usage:** `$cmdprefix+sp clear-db-cache <section>`")
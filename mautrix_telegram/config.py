@@ -153,6 +153,13 @@ class Config(DictWithRecursion):
         copy("homeserver.address")
         copy("homeserver.domain")
         copy("homeserver.verify_ssl")
+        copy("homeserver.request_scheduler.enabled")
+        copy("homeserver.request_scheduler.max_concurrent")
+        copy("homeserver.request_scheduler.rate")
+        copy("homeserver.request_scheduler.burst")
+        copy("homeserver.request_scheduler.user_rate")
+        copy("homeserver.request_scheduler.user_burst")
+        copy("homeserver.request_scheduler.max_retries")
 
         if "appservice.protocol" in self and "appservice.address" not in self:
             protocol, hostname, port = (self["appservice.protocol"], self["appservice.hostname"],
@@ -165,6 +172,18 @@ class Config(DictWithRecursion):
         copy("appservice.max_body_size")
 
         copy("appservice.database")
+        copy("appservice.database_threads")
+        copy("appservice.message_cache_size")
+        copy("appservice.state_store_preload")
+        copy("appservice.state_store_write_buffer.max_size")
+        copy("appservice.state_store_write_buffer.max_delay")
+        copy("appservice.instance_cache.portals")
+        copy("appservice.instance_cache.puppets")
+        copy("appservice.instance_cache.users")
+        copy("appservice.message_write_buffer.max_size")
+        copy("appservice.message_write_buffer.max_delay")
+        copy("appservice.sharding.shards")
+        copy("appservice.sharding.reload_interval")
 
         copy("appservice.public.enabled")
         copy("appservice.public.prefix")
@@ -173,6 +192,9 @@ class Config(DictWithRecursion):
         copy("appservice.provisioning.enabled")
         copy("appservice.provisioning.prefix")
         copy("appservice.provisioning.shared_secret")
+
+        copy("appservice.metrics.enabled")
+        copy("appservice.metrics.path")
         if base["appservice.provisioning.shared_secret"] == "generate":
             base["appservice.provisioning.shared_secret"] = self._new_token()
 
@@ -191,11 +213,21 @@ class Config(DictWithRecursion):
         copy("bridge.displayname_preference")
 
         copy("bridge.max_initial_member_sync")
+        copy("bridge.member_sync_concurrency")
         copy("bridge.sync_channel_members")
         copy("bridge.skip_deleted_members")
         copy("bridge.startup_sync")
         copy("bridge.sync_dialog_limit")
         copy("bridge.max_telegram_delete")
+        copy("bridge.redaction_queue.concurrency")
+        copy("bridge.redaction_queue.rate")
+        copy("bridge.ephemeral.delay")
+        copy("bridge.ephemeral.max_tracked")
+        copy("bridge.startup.max_concurrent")
+        copy("bridge.startup.jitter")
+        copy("bridge.startup.lazy_connect_after_days")
+        copy("bridge.update_queue.workers")
+        copy("bridge.update_queue.max_queued")
         copy("bridge.sync_matrix_state")
         copy("bridge.allow_matrix_login")
         copy("bridge.plaintext_highlights")
@@ -207,6 +239,11 @@ class Config(DictWithRecursion):
         copy("bridge.telegram_link_preview")
         copy("bridge.inline_images")
         copy("bridge.image_as_file_size")
+        copy("bridge.media_processing.workers")
+        copy("bridge.media_processing.max_concurrent")
+        copy("bridge.media_processing.timeout")
+        copy("bridge.media_cache.path")
+        copy("bridge.media_cache.max_size")
 
         copy("bridge.bot_messages_as_notices")
         if isinstance(self["bridge.bridge_notices"], bool):
@@ -218,7 +255,9 @@ class Config(DictWithRecursion):
             copy("bridge.bridge_notices")
 
         copy("bridge.deduplication.pre_db_check")
-        copy("bridge.deduplication.cache_queue_length")
+        copy("bridge.deduplication.max_entries")
+        copy("bridge.deduplication.max_age")
+        copy("bridge.deduplication.persist")
 
         if "bridge.message_formats.m_text" in self:
             del self["bridge.message_formats"]
@@ -26,6 +26,8 @@ if TYPE_CHECKING:
     from .config import Config
     from .bot import Bot
     from .matrix import MatrixHandler
+    from .sharding import ShardRouter
+    from .util import RequestScheduler
 
 
 class Context:
@@ -39,6 +41,8 @@ class Context:
         self.session_container = session_container  # type: AlchemySessionContainer
         self.public_website = None  # type: Optional[PublicBridgeWebsite]
         self.provisioning_api = None  # type: Optional[ProvisioningAPI]
+        self.shards = None  # type: Optional[ShardRouter]
+        self.request_scheduler = None  # type: Optional[RequestScheduler]
 
     @property
     def core(self) -> Tuple['AppService', 'Config', 'asyncio.AbstractEventLoop', Optional['Bot']]:
@@ -14,20 +14,31 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import Optional
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+
 from .base import Base
 from .bot_chat import BotChat
+from .dedup_claim import DedupClaim
 from .message import Message
+from .participant_page import ParticipantPage
 from .portal import Portal
 from .puppet import Puppet
 from .room_state import RoomState
 from .telegram_file import TelegramFile
+from .uploaded_file import UploadedFile, UploadedFileMXC
 from .user import User, UserPortal, Contact
 from .user_profile import UserProfile
 
 
-def init(db_engine) -> None:
+def init(db_engine, loop: Optional[asyncio.AbstractEventLoop] = None,
+         executor_threads: int = 1) -> None:
     for table in (Portal, Message, User, Contact, UserPortal, Puppet, TelegramFile, UserProfile,
-                  RoomState, BotChat):
+                  RoomState, BotChat, UploadedFile, UploadedFileMXC, DedupClaim,
+                  ParticipantPage):
         table.db = db_engine
         table.t = table.__table__
         table.c = table.t.c
+    Base.loop = loop
+    Base.executor = ThreadPoolExecutor(max_workers=max(executor_threads, 1))
@@ -14,7 +14,13 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import Any, Awaitable, Callable, Optional
+from concurrent.futures import ThreadPoolExecutor
 from abc import abstractmethod
+from types import GeneratorType
+import functools
+import asyncio
+import time
 
 from sqlalchemy import Table
 from sqlalchemy.engine.base import Engine
@@ -22,6 +28,56 @@ from sqlalchemy.engine.result import RowProxy
 from sqlalchemy.sql.base import ImmutableColumnCollection
 from sqlalchemy.ext.declarative import declarative_base
 
+from .. import metrics
+
+# The maximum number of values in one IN clause. SQLite allows at most 999 variables per statement.
+SELECT_CHUNK_SIZE = 500  # type: int
+
+
+class ExecutorProxy:
+    """Exposes the methods of a model class or instance as coroutines that run in the DB executor.
+
+    For example, ``await Message.aio.get_by_tgid(tgid, space)`` runs ``Message.get_by_tgid`` in a
+    worker thread instead of blocking the event loop.
+    """
+
+    def __init__(self, target: Any) -> None:
+        self._target = target
+
+    def __getattr__(self, name: str) -> Callable[..., Awaitable[Any]]:
+        func = getattr(self._target, name)
+        if metrics.enabled:
+            model = self._target if isinstance(self._target, type) else type(self._target)
+            func = _timed_call(func, f"{model.__name__}.{name}")
+        return functools.partial(self._target.run_in_executor, func)
+
+
+class _ExecutorProxyDescriptor:
+    def __get__(self, instance: Optional['BaseBase'], owner: type) -> ExecutorProxy:
+        return ExecutorProxy(instance if instance is not None else owner)
+
+
+def _call_and_collect(func: Callable[..., Any], *args, **kwargs) -> Any:
+    result = func(*args, **kwargs)
+    if isinstance(result, GeneratorType):
+        # Generators are lazy, so they need to be consumed in the worker thread too.
+        return list(result)
+    return result
+
+
+def _timed_call(func: Callable[..., Any], method: str) -> Callable[..., Any]:
+    histogram = metrics.DB_QUERY_TIME.labels(method=method)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs) -> Any:
+        start = time.perf_counter()
+        try:
+            return _call_and_collect(func, *args, **kwargs)
+        finally:
+            histogram.observe(time.perf_counter() - start)
+
+    return wrapper
+
 
 class BaseBase:
     db = None  # type: Engine
@@ -29,6 +85,16 @@ class BaseBase:
     __table__ = None  # type: Table
     c = None  # type: ImmutableColumnCollection
 
+    loop = None  # type: Optional[asyncio.AbstractEventLoop]
+    executor = None  # type: Optional[ThreadPoolExecutor]
+    aio = _ExecutorProxyDescriptor()  # type: ExecutorProxy
+
+    @classmethod
+    def run_in_executor(cls, func: Callable[..., Any], *args, **kwargs) -> Awaitable[Any]:
+        loop = cls.loop or asyncio.get_event_loop()
+        return loop.run_in_executor(cls.executor,
+                                    functools.partial(_call_and_collect, func, *args, **kwargs))
+
     @classmethod
     @abstractmethod
     def _one_or_none(cls, rows: RowProxy):
@@ -1,4 +1,7 @@
+from typing import Any, Awaitable, Callable, Optional
+from concurrent.futures import ThreadPoolExecutor
 from abc import abstractmethod
+import asyncio
 
 from sqlalchemy import Table
 from sqlalchemy.engine.base import Engine
@@ -6,12 +9,22 @@ from sqlalchemy.engine.result import RowProxy
 from sqlalchemy.sql.base import ImmutableColumnCollection
 from sqlalchemy.ext.declarative import declarative_base
 
+class ExecutorProxy:
+    def __getattr__(self, name: str) -> Callable[..., Awaitable[Any]]: ...
+
 class Base(declarative_base):
 	db: Engine
 	t: Table
 	__table__: Table
 	c: ImmutableColumnCollection
 
+	loop: Optional[asyncio.AbstractEventLoop]
+	executor: Optional[ThreadPoolExecutor]
+	aio: ExecutorProxy
+
+	@classmethod
+	def run_in_executor(cls, func: Callable[..., Any], *args, **kwargs) -> Awaitable[Any]: ...
+
     @classmethod
     @abstractmethod
     def _one_or_none(cls, rows: RowProxy): ...
@@ -0,0 +1,111 @@
+# -*- coding: future_fstrings -*-
+# mautrix-telegram - A Matrix-Telegram puppeting bridge
+# Copyright (C) 2019 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import Iterator, Optional
+import time
+
+from sqlalchemy import Column, Index, Integer, String, and_
+from sqlalchemy.engine.result import RowProxy
+from sqlalchemy.exc import IntegrityError
+
+from ..types import MatrixEventID, TelegramID
+from .base import Base
+
+
+class DedupClaim(Base):
+    """A Telegram message that has been bridged (or claimed for bridging), shared by all bridge
+    processes and kept across restarts.
+
+    When the bridge is sharded, several processes may receive the same group message from
+    different users' clients. The first one to insert a claim bridges the message and the others
+    ignore it. The Matrix event ID is filled in once the message has been sent, so that the other
+    processes can map their copies of the message to it.
+    """
+    __tablename__ = "dedup_claim"
+
+    tgid = Column(Integer, primary_key=True)  # type: TelegramID
+    tg_receiver = Column(Integer, primary_key=True)  # type: TelegramID
+    evt_hash = Column(String, primary_key=True)
+    timestamp = Column(Integer, nullable=False)
+    mxid = Column(String, nullable=True)  # type: Optional[MatrixEventID]
+    tg_space = Column(Integer, nullable=True)  # type: Optional[TelegramID]
+
+    __table_args__ = (Index("ix_dedup_claim_timestamp", "timestamp"),)
+
+    @classmethod
+    def scan(cls, row) -> 'DedupClaim':
+        tgid, tg_receiver, evt_hash, timestamp, mxid, tg_space = row
+        return cls(tgid=tgid, tg_receiver=tg_receiver, evt_hash=evt_hash, timestamp=timestamp,
+                   mxid=mxid, tg_space=tg_space)
+
+    @classmethod
+    def _one_or_none(cls, rows: RowProxy) -> Optional['DedupClaim']:
+        try:
+            return cls.scan(next(rows))
+        except StopIteration:
+            return None
+
+    @classmethod
+    def get(cls, tgid: TelegramID, tg_receiver: TelegramID, evt_hash: str
+            ) -> Optional['DedupClaim']:
+        return cls._one_or_none(cls.db.execute(cls.t.select().where(
+            and_(cls.c.tgid == tgid, cls.c.tg_receiver == tg_receiver,
+                 cls.c.evt_hash == evt_hash))))
+
+    @classmethod
+    def get_recent(cls, max_age: int, limit: int) -> Iterator['DedupClaim']:
+        """Get the newest claims that are at most ``max_age`` seconds old, newest first."""
+        rows = cls.db.execute(cls.t.select()
+                              .where(cls.c.timestamp >= int(time.time()) - max_age)
+                              .order_by(cls.c.timestamp.desc())
+                              .limit(limit))
+        for row in rows:
+            yield cls.scan(row)
+
+    @classmethod
+    def claim(cls, tgid: TelegramID, tg_receiver: TelegramID, evt_hash: str) -> bool:
+        """Claim a message. Returns ``False`` if another process already claimed it."""
+        try:
+            with cls.db.begin() as conn:
+                conn.execute(cls.t.insert().values(tgid=tgid, tg_receiver=tg_receiver,
+                                                   evt_hash=evt_hash,
+                                                   timestamp=int(time.time())))
+        except IntegrityError:
+            return False
+        return True
+
+    @classmethod
+    def store(cls, tgid: TelegramID, tg_receiver: TelegramID, evt_hash: str,
+              mxid: Optional[MatrixEventID], tg_space: Optional[TelegramID]) -> None:
+        """Insert a bridged message, or set the Matrix event of an existing claim."""
+        try:
+            with cls.db.begin() as conn:
+                conn.execute(cls.t.insert().values(tgid=tgid, tg_receiver=tg_receiver,
+                                                   evt_hash=evt_hash, timestamp=int(time.time()),
+                                                   mxid=mxid, tg_space=tg_space))
+        except IntegrityError:
+            with cls.db.begin() as conn:
+                conn.execute(cls.t.update()
+                             .where(and_(cls.c.tgid == tgid, cls.c.tg_receiver == tg_receiver,
+                                         cls.c.evt_hash == evt_hash))
+                             .values(mxid=mxid, tg_space=tg_space))
+
+    @classmethod
+    def prune(cls, max_age: int) -> int:
+        """Delete claims older than ``max_age`` seconds and return how many were deleted."""
+        with cls.db.begin() as conn:
+            return conn.execute(cls.t.delete().where(
+                cls.c.timestamp < int(time.time()) - max_age)).rowcount
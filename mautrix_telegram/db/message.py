@@ -16,10 +16,12 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 from sqlalchemy import Column, UniqueConstraint, Integer, String, and_, func, select
 from sqlalchemy.engine.result import RowProxy
-from typing import Optional, List
+from typing import Dict, Iterable, Optional, List, Tuple
 
 from ..types import MatrixRoomID, MatrixEventID, TelegramID
-from .base import Base
+from .base import Base, SELECT_CHUNK_SIZE
+from .message_cache import MessageCache
+from .write_buffer import MessageWriteBuffer
 
 
 class Message(Base):
@@ -32,6 +34,22 @@ class Message(Base):
 
     __table_args__ = (UniqueConstraint("mxid", "mx_room", "tg_space", name="_mx_id_room"),)
 
+    write_buffer = None  # type: Optional[MessageWriteBuffer]
+    cache = None  # type: Optional[MessageCache]
+
+    @classmethod
+    def enable_cache(cls, max_size: int) -> None:
+        cls.cache = MessageCache(cls, max_size) if max_size > 0 else None
+
+    @classmethod
+    def enable_write_buffer(cls, max_size: int) -> None:
+        cls.write_buffer = MessageWriteBuffer(cls, max_size) if max_size > 0 else None
+
+    @classmethod
+    def flush(cls) -> None:
+        if cls.write_buffer:
+            cls.write_buffer.flush()
+
     @classmethod
     def _one_or_none(cls, rows: RowProxy) -> Optional['Message']:
         try:
@@ -45,12 +63,116 @@ class Message(Base):
         return [Message(mxid=row[0], mx_room=row[1], tgid=row[2], tg_space=row[3])
                 for row in rows]
 
+    @classmethod
+    def _select_buffered(cls, clause, matches) -> Optional['Message']:
+        rows = cls.write_buffer.select(clause, matches)
+        return rows[0] if rows else None
+
     @classmethod
     def get_by_tgid(cls, tgid: TelegramID, tg_space: TelegramID) -> Optional['Message']:
-        return cls._select_one_or_none(and_(cls.c.tgid == tgid, cls.c.tg_space == tg_space))
+        if not cls.cache:
+            return cls._get_by_tgid(tgid, tg_space)
+        message = cls.cache.get_by_tgid(tgid, tg_space)
+        if not message:
+            version = cls.cache.version
+            message = cls._get_by_tgid(tgid, tg_space)
+            if message:
+                cls.cache.put_if_unchanged(message, version)
+        return message
+
+    @classmethod
+    def _get_by_tgid(cls, tgid: TelegramID, tg_space: TelegramID) -> Optional['Message']:
+        clause = and_(cls.c.tgid == tgid, cls.c.tg_space == tg_space)
+        if cls.write_buffer:
+            return cls._select_buffered(clause, lambda msg: (msg.tgid == tgid
+                                                             and msg.tg_space == tg_space))
+        return cls._select_one_or_none(clause)
+
+    @classmethod
+    def get_many_by_tgid(cls, tgids: List[TelegramID], tg_space: TelegramID
+                         ) -> List['Message']:
+        """Get the messages with any of the given IDs in one space, skipping missing ones."""
+        messages = []  # type: List[Message]
+        missing = tgids
+        version = 0
+        if cls.cache:
+            version = cls.cache.version
+            missing = []
+            for tgid in tgids:
+                message = cls.cache.get_by_tgid(tgid, tg_space)
+                if message:
+                    messages.append(message)
+                else:
+                    missing.append(tgid)
+        for i in range(0, len(missing), SELECT_CHUNK_SIZE):
+            chunk = missing[i:i + SELECT_CHUNK_SIZE]
+            clause = and_(cls.c.tg_space == tg_space, cls.c.tgid.in_(chunk))
+            if cls.write_buffer:
+                chunk_set = set(chunk)
+                rows = cls.write_buffer.select(clause, lambda msg: (msg.tg_space == tg_space
+                                                                    and msg.tgid in chunk_set))
+            else:
+                rows = cls._all(cls.db.execute(cls.t.select().where(clause)))
+            if cls.cache:
+                for row in rows:
+                    cls.cache.put_if_unchanged(row, version)
+            messages += rows
+        return messages
+
+    @classmethod
+    def delete_many(cls, messages: Iterable['Message']) -> None:
+        """Delete many messages with one statement per space."""
+        by_space = {}  # type: Dict[TelegramID, List[TelegramID]]
+        for message in messages:
+            by_space.setdefault(message.tg_space, []).append(message.tgid)
+        for tg_space, tgids in by_space.items():
+            for i in range(0, len(tgids), SELECT_CHUNK_SIZE):
+                chunk = tgids[i:i + SELECT_CHUNK_SIZE]
+                clause = and_(cls.c.tg_space == tg_space, cls.c.tgid.in_(chunk))
+                if cls.write_buffer:
+                    chunk_set = set(chunk)
+                    cls.write_buffer.delete(clause,
+                                            lambda msg, space=tg_space, keys=chunk_set:
+                                            msg.tg_space == space and msg.tgid in keys)
+                else:
+                    with cls.db.begin() as conn:
+                        conn.execute(cls.t.delete().where(clause))
+                if cls.cache:
+                    for tgid in chunk:
+                        cls.cache.remove(tgid, tg_space)
+
+    @classmethod
+    def count_spaces_by_mxids(cls, events: Iterable[Tuple[MatrixEventID, MatrixRoomID]]
+                              ) -> Dict[Tuple[MatrixEventID, MatrixRoomID], int]:
+        """Count the spaces that each Matrix event is still bridged to, with one grouped query."""
+        keys = set(events)
+        mxids = list({mxid for mxid, _ in keys})
+        counts = {key: 0 for key in keys}
+        for i in range(0, len(mxids), SELECT_CHUNK_SIZE):
+            chunk = mxids[i:i + SELECT_CHUNK_SIZE]
+            if cls.write_buffer:
+                chunk_set = set(chunk)
+                rows = cls.write_buffer.select(cls.c.mxid.in_(chunk),
+                                               lambda msg: msg.mxid in chunk_set)
+                for row in rows:
+                    key = (row.mxid, row.mx_room)
+                    if key in counts:
+                        counts[key] += 1
+                continue
+            rows = cls.db.execute(select([cls.c.mxid, cls.c.mx_room, func.count(cls.c.tg_space)])
+                                  .where(cls.c.mxid.in_(chunk))
+                                  .group_by(cls.c.mxid, cls.c.mx_room))
+            for mxid, mx_room, count in rows:
+                if (mxid, mx_room) in counts:
+                    counts[(mxid, mx_room)] = count
+        return counts
 
     @classmethod
     def count_spaces_by_mxid(cls, mxid: MatrixEventID, mx_room: MatrixRoomID) -> int:
+        if cls.write_buffer:
+            return len(cls.write_buffer.select(
+                and_(cls.c.mxid == mxid, cls.c.mx_room == mx_room),
+                lambda msg: msg.mxid == mxid and msg.mx_room == mx_room))
         rows = cls.db.execute(select([func.count(cls.c.tg_space)])
                               .where(and_(cls.c.mxid == mxid, cls.c.mx_room == mx_room)))
         try:
@@ -62,29 +184,84 @@ class Message(Base):
     @classmethod
     def get_by_mxid(cls, mxid: MatrixEventID, mx_room: MatrixRoomID, tg_space: TelegramID
                     ) -> Optional['Message']:
-        return cls._select_one_or_none(and_(cls.c.mxid == mxid,
-                                            cls.c.mx_room == mx_room,
-                                            cls.c.tg_space == tg_space))
+        if not cls.cache:
+            return cls._get_by_mxid(mxid, mx_room, tg_space)
+        message = cls.cache.get_by_mxid(mxid, mx_room, tg_space)
+        if not message:
+            version = cls.cache.version
+            message = cls._get_by_mxid(mxid, mx_room, tg_space)
+            if message:
+                cls.cache.put_if_unchanged(message, version)
+        return message
+
+    @classmethod
+    def _get_by_mxid(cls, mxid: MatrixEventID, mx_room: MatrixRoomID, tg_space: TelegramID
+                     ) -> Optional['Message']:
+        clause = and_(cls.c.mxid == mxid, cls.c.mx_room == mx_room, cls.c.tg_space == tg_space)
+        if cls.write_buffer:
+            return cls._select_buffered(clause, lambda msg: (msg.mxid == mxid
+                                                             and msg.mx_room == mx_room
+                                                             and msg.tg_space == tg_space))
+        return cls._select_one_or_none(clause)
 
     @classmethod
     def update_by_tgid(cls, s_tgid: TelegramID, s_tg_space: TelegramID, **values) -> None:
-        with cls.db.begin() as conn:
-            conn.execute(cls.t.update()
-                         .where(and_(cls.c.tgid == s_tgid, cls.c.tg_space == s_tg_space))
-                         .values(**values))
+        clause = and_(cls.c.tgid == s_tgid, cls.c.tg_space == s_tg_space)
+        if cls.write_buffer:
+            cls.write_buffer.update(clause, lambda msg: (msg.tgid == s_tgid
+                                                         and msg.tg_space == s_tg_space),
+                                    values, only_key=(s_tgid, s_tg_space))
+        else:
+            with cls.db.begin() as conn:
+                conn.execute(cls.t.update().where(clause).values(**values))
+        if cls.cache:
+            cls.cache.update_by_tgid(s_tgid, s_tg_space, values)
 
     @classmethod
     def update_by_mxid(cls, s_mxid: MatrixEventID, s_mx_room: MatrixRoomID, **values) -> None:
-        with cls.db.begin() as conn:
-            conn.execute(cls.t.update()
-                         .where(and_(cls.c.mxid == s_mxid, cls.c.mx_room == s_mx_room))
-                         .values(**values))
+        clause = and_(cls.c.mxid == s_mxid, cls.c.mx_room == s_mx_room)
+        if cls.write_buffer:
+            cls.write_buffer.update(clause, lambda msg: (msg.mxid == s_mxid
+                                                         and msg.mx_room == s_mx_room),
+                                    values)
+        else:
+            with cls.db.begin() as conn:
+                conn.execute(cls.t.update().where(clause).values(**values))
+        if cls.cache:
+            cls.cache.update_by_mxid(s_mxid, s_mx_room, values)
 
     @property
     def _edit_identity(self):
         return and_(self.c.tgid == self.tgid, self.c.tg_space == self.tg_space)
 
+    def _matches_identity(self, other: 'Message') -> bool:
+        return other.tgid == self.tgid and other.tg_space == self.tg_space
+
+    def update(self, **values) -> None:
+        if self.write_buffer:
+            self.write_buffer.update(self._edit_identity, self._matches_identity, values,
+                                     only_key=(self.tgid, self.tg_space))
+            for key, value in values.items():
+                setattr(self, key, value)
+        else:
+            super().update(**values)
+        if self.cache:
+            self.cache.update_by_tgid(self.tgid, self.tg_space, values)
+
+    def delete(self) -> None:
+        if self.write_buffer:
+            self.write_buffer.delete(self._edit_identity, self._matches_identity)
+        else:
+            super().delete()
+        if self.cache:
+            self.cache.remove(self.tgid, self.tg_space)
+
     def insert(self) -> None:
-        with self.db.begin() as conn:
-            conn.execute(self.t.insert().values(mxid=self.mxid, mx_room=self.mx_room,
-                                                tgid=self.tgid, tg_space=self.tg_space))
+        if self.write_buffer:
+            self.write_buffer.insert(self)
+        else:
+            with self.db.begin() as conn:
+                conn.execute(self.t.insert().values(mxid=self.mxid, mx_room=self.mx_room,
+                                                    tgid=self.tgid, tg_space=self.tg_space))
+        if self.cache:
+            self.cache.put(self)
@@ -0,0 +1,176 @@
+# -*- coding: future_fstrings -*-
+# mautrix-telegram - A Matrix-Telegram puppeting bridge
+# Copyright (C) 2019 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import Dict, Optional, Tuple, TYPE_CHECKING
+from collections import OrderedDict
+import threading
+
+from ..types import MatrixEventID, MatrixRoomID, TelegramID
+
+if TYPE_CHECKING:
+    from .message import Message
+
+TelegramKey = Tuple[TelegramID, TelegramID]
+MatrixKey = Tuple[MatrixEventID, MatrixRoomID]
+
+
+class CachedMessage:
+    """The cached copy of a message row. Model instances carry SQLAlchemy state that's much bigger
+    than the row itself, so they're only created when a row is read from the cache."""
+    __slots__ = ("mxid", "mx_room", "tgid", "tg_space")
+
+    def __init__(self, mxid: MatrixEventID, mx_room: MatrixRoomID, tgid: TelegramID,
+                 tg_space: TelegramID) -> None:
+        self.mxid = mxid  # type: MatrixEventID
+        self.mx_room = mx_room  # type: MatrixRoomID
+        self.tgid = tgid  # type: TelegramID
+        self.tg_space = tg_space  # type: TelegramID
+
+
+class MessageCache:
+    """A bounded LRU cache of message mappings that can be looked up from either side.
+
+    Rows are stored by ``(tgid, tg_space)`` and indexed by ``(mxid, mx_room)`` → ``tg_space``.
+    The cache only ever contains rows that were read from or written to the database, so a miss
+    means that the database has to be checked. Rows are copied in and out, which means callers
+    can't change the cached data by modifying the objects they get.
+
+    Every write bumps :attr:`version`. Rows read from the database are only cached with
+    :meth:`put_if_unchanged`, so a read that raced with a write in another thread can't put a
+    stale row in the cache.
+    """
+
+    def __init__(self, message_class: type, max_size: int = 10000) -> None:
+        self.cls = message_class
+        self.max_size = max_size  # type: int
+        self._lock = threading.RLock()
+        self._by_tgid = OrderedDict()  # type: Dict[TelegramKey, CachedMessage]
+        self._by_mxid = {}  # type: Dict[MatrixKey, Dict[TelegramID, TelegramKey]]
+        self.version = 0  # type: int
+
+        self.hits = 0  # type: int
+        self.misses = 0  # type: int
+        self.evictions = 0  # type: int
+
+    @property
+    def size(self) -> int:
+        return len(self._by_tgid)
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "size": self.size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hit_rate,
+        }
+
+    def _to_model(self, message: CachedMessage) -> 'Message':
+        return self.cls(mxid=message.mxid, mx_room=message.mx_room, tgid=message.tgid,
+                        tg_space=message.tg_space)
+
+    def _get(self, key: Optional[TelegramKey]) -> Optional['Message']:
+        try:
+            message = self._by_tgid[key]
+        except KeyError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._by_tgid.move_to_end(key)
+        return self._to_model(message)
+
+    def get_by_tgid(self, tgid: TelegramID, tg_space: TelegramID) -> Optional['Message']:
+        with self._lock:
+            return self._get((tgid, tg_space))
+
+    def get_by_mxid(self, mxid: MatrixEventID, mx_room: MatrixRoomID, tg_space: TelegramID
+                    ) -> Optional['Message']:
+        with self._lock:
+            return self._get(self._by_mxid.get((mxid, mx_room), {}).get(tg_space))
+
+    def _index(self, message: CachedMessage) -> None:
+        key = (message.tgid, message.tg_space)
+        self._by_mxid.setdefault((message.mxid, message.mx_room), {})[message.tg_space] = key
+
+    def _unindex(self, message: CachedMessage) -> None:
+        mx_key = (message.mxid, message.mx_room)
+        spaces = self._by_mxid.get(mx_key)
+        if spaces is None:
+            return
+        spaces.pop(message.tg_space, None)
+        if not spaces:
+            del self._by_mxid[mx_key]
+
+    def put_if_unchanged(self, message: 'Message', version: int) -> None:
+        with self._lock:
+            if version == self.version:
+                self._put(message)
+
+    def put(self, message: 'Message') -> None:
+        with self._lock:
+            self.version += 1
+            self._put(message)
+
+    def _put(self, message: 'Message') -> None:
+        key = (message.tgid, message.tg_space)
+        old = self._by_tgid.pop(key, None)
+        if old:
+            self._unindex(old)
+        message = CachedMessage(message.mxid, message.mx_room, message.tgid, message.tg_space)
+        self._by_tgid[key] = message
+        self._index(message)
+        while len(self._by_tgid) > self.max_size:
+            _, evicted = self._by_tgid.popitem(last=False)
+            self._unindex(evicted)
+            self.evictions += 1
+
+    def _update(self, message: CachedMessage, values: Dict) -> None:
+        self._unindex(message)
+        for attr, value in values.items():
+            setattr(message, attr, value)
+        self._index(message)
+
+    def update_by_tgid(self, tgid: TelegramID, tg_space: TelegramID, values: Dict) -> None:
+        with self._lock:
+            self.version += 1
+            message = self._by_tgid.get((tgid, tg_space))
+            if message:
+                self._update(message, values)
+
+    def update_by_mxid(self, mxid: MatrixEventID, mx_room: MatrixRoomID, values: Dict) -> None:
+        with self._lock:
+            self.version += 1
+            keys = list(self._by_mxid.get((mxid, mx_room), {}).values())
+            for key in keys:
+                self._update(self._by_tgid[key], values)
+
+    def remove(self, tgid: TelegramID, tg_space: TelegramID) -> None:
+        with self._lock:
+            self.version += 1
+            message = self._by_tgid.pop((tgid, tg_space), None)
+            if message:
+                self._unindex(message)
+
+    def clear(self) -> None:
+        with self._lock:
+            self.version += 1
+            self._by_tgid.clear()
+            self._by_mxid.clear()
@@ -0,0 +1,72 @@
+# -*- coding: future_fstrings -*-
+# mautrix-telegram - A Matrix-Telegram puppeting bridge
+# Copyright (C) 2019 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import Iterable, List
+
+from sqlalchemy import Column, Integer, LargeBinary
+from telethon.extensions import BinaryReader
+
+from ..types import TelegramID
+from .base import Base
+
+
+class ParticipantPage(Base):
+    """A cached page of the participant list of a channel.
+
+    The hash of each page is sent when the participant list is fetched again, so that Telegram
+    only sends the pages that have changed.
+    """
+    __tablename__ = "participant_page"
+
+    channel_id = Column(Integer, primary_key=True)  # type: TelegramID
+    offset = Column(Integer, primary_key=True)
+    hash = Column(Integer, nullable=False)
+    participants = Column(LargeBinary, nullable=False)
+
+    @classmethod
+    def scan(cls, row) -> 'ParticipantPage':
+        channel_id, offset, page_hash, participants = row
+        return cls(channel_id=channel_id, offset=offset, hash=page_hash,
+                   participants=participants)
+
+    @classmethod
+    def get_all(cls, channel_id: TelegramID) -> List['ParticipantPage']:
+        rows = cls.db.execute(cls.t.select()
+                              .where(cls.c.channel_id == channel_id)
+                              .order_by(cls.c.offset))
+        return [cls.scan(row) for row in rows]
+
+    @classmethod
+    def replace_all(cls, channel_id: TelegramID, pages: Iterable['ParticipantPage']) -> None:
+        with cls.db.begin() as conn:
+            conn.execute(cls.t.delete().where(cls.c.channel_id == channel_id))
+            values = [dict(channel_id=channel_id, offset=page.offset, hash=page.hash,
+                           participants=page.participants) for page in pages]
+            if values:
+                conn.execute(cls.t.insert(), values)
+
+    @staticmethod
+    def serialize(participants: List) -> bytes:
+        return b"".join(bytes(participant) for participant in participants)
+
+    def deserialize(self) -> List:
+        if not self.participants:
+            return []
+        reader = BinaryReader(self.participants)
+        participants = []
+        while reader.tell_position() < len(self.participants):
+            participants.append(reader.tgread_object())
+        return participants
@@ -14,7 +14,7 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
-from sqlalchemy import Column, Integer, String, Boolean, Text, and_
+from sqlalchemy import Column, Index, Integer, String, Boolean, Text, and_
 from sqlalchemy.engine.result import RowProxy
 from typing import Optional
 
@@ -42,6 +42,8 @@ class Portal(Base):
     about = Column(String, nullable=True)
     photo_id = Column(String, nullable=True)
 
+    __table_args__ = (Index("ix_portal_username", "username"),)
+
     @classmethod
     def scan(cls, row) -> Optional['Portal']:
         (tgid, tg_receiver, peer_type, megagroup, mxid, config, username, title, about,
@@ -73,6 +75,21 @@ class Portal(Base):
     def _edit_identity(self):
         return and_(self.c.tgid == self.tgid, self.c.tg_receiver == self.tg_receiver)
 
+    def claim_mxid(self, mxid: MatrixRoomID) -> bool:
+        """Set the room ID, unless another process has already set one.
+
+        Returns:
+            ``True`` if the room ID was set, ``False`` if the portal already had one.
+        """
+        with self.db.begin() as conn:
+            result = conn.execute(self.t.update()
+                                  .where(and_(self._edit_identity, self.c.mxid.is_(None)))
+                                  .values(mxid=mxid))
+        if result.rowcount == 0:
+            return False
+        self.mxid = mxid
+        return True
+
     def insert(self) -> None:
         with self.db.begin() as conn:
             conn.execute(self.t.insert().values(
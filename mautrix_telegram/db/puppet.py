@@ -14,7 +14,7 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
-from sqlalchemy import Column, Integer, String, Boolean
+from sqlalchemy import Column, Index, Integer, String, Boolean
 from sqlalchemy.engine.result import RowProxy
 from sqlalchemy.sql import expression
 from typing import Optional, Iterable
@@ -33,16 +33,21 @@ class Puppet(Base):
     displayname_source = Column(Integer, nullable=True)  # type: Optional[TelegramID]
     username = Column(String, nullable=True)
     photo_id = Column(String, nullable=True)
+    name_hash = Column(String, nullable=True)
     is_bot = Column(Boolean, nullable=True)
     matrix_registered = Column(Boolean, nullable=False, server_default=expression.false())
 
+    __table_args__ = (Index("ix_puppet_custom_mxid", "custom_mxid"),
+                      Index("ix_puppet_username", "username"),
+                      Index("ix_puppet_displayname", "displayname"))
+
     @classmethod
     def scan(cls, row) -> Optional['Puppet']:
         (id, custom_mxid, access_token, displayname, displayname_source, username, photo_id,
-         is_bot, matrix_registered) = row
+         name_hash, is_bot, matrix_registered) = row
         return cls(id=id, custom_mxid=custom_mxid, access_token=access_token,
                    displayname=displayname, displayname_source=displayname_source,
-                   username=username, photo_id=photo_id, is_bot=is_bot,
+                   username=username, photo_id=photo_id, name_hash=name_hash, is_bot=is_bot,
                    matrix_registered=matrix_registered)
 
     @classmethod
@@ -83,5 +88,5 @@ class Puppet(Base):
             conn.execute(self.t.insert().values(
                 id=self.id, custom_mxid=self.custom_mxid, access_token=self.access_token,
                 displayname=self.displayname, displayname_source=self.displayname_source,
-                username=self.username, photo_id=self.photo_id, is_bot=self.is_bot,
-                matrix_registered=self.matrix_registered))
+                username=self.username, photo_id=self.photo_id, name_hash=self.name_hash,
+                is_bot=self.is_bot, matrix_registered=self.matrix_registered))
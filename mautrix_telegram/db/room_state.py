@@ -14,12 +14,13 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
-from sqlalchemy import Column, String, Text
-from typing import Dict, Optional
+from sqlalchemy import Column, String, Text, bindparam, select
+from sqlalchemy.engine.result import RowProxy
+from typing import Dict, Iterable, List, Optional, Set
 import json
 
 from ..types import MatrixRoomID
-from .base import Base
+from .base import Base, SELECT_CHUNK_SIZE
 
 
 class RoomState(Base):
@@ -36,22 +37,54 @@ class RoomState(Base):
     def has_power_levels(self) -> bool:
         return bool(self.power_levels)
 
+    @classmethod
+    def scan(cls, row: RowProxy) -> 'RoomState':
+        room_id, power_levels_text = row
+        return cls(room_id=room_id, power_levels=(json.loads(power_levels_text)
+                                                  if power_levels_text else None))
+
     @classmethod
     def get(cls, room_id: MatrixRoomID) -> Optional['RoomState']:
         rows = cls.db.execute(cls.t.select().where(cls.c.room_id == room_id))
         try:
-            room_id, power_levels_text = next(rows)
-            return cls(room_id=room_id, power_levels=(json.loads(power_levels_text)
-                                                      if power_levels_text else None))
+            return cls.scan(next(rows))
         except StopIteration:
             return None
 
+    @classmethod
+    def all(cls) -> Iterable['RoomState']:
+        rows = cls.db.execute(cls.t.select())
+        for row in rows:
+            yield cls.scan(row)
+
     def update(self) -> None:
         with self.db.begin() as conn:
             conn.execute(self.t.update()
                          .where(self.c.room_id == self.room_id)
                          .values(power_levels=self._power_levels_text))
 
+    @classmethod
+    def bulk_upsert(cls, room_states: List['RoomState']) -> None:
+        """Write many room states in one transaction, with one update and one insert statement."""
+        room_ids = [room_state.room_id for room_state in room_states]
+        with cls.db.begin() as conn:
+            existing = set()  # type: Set[MatrixRoomID]
+            for i in range(0, len(room_ids), SELECT_CHUNK_SIZE):
+                rows = conn.execute(select([cls.c.room_id]).where(
+                    cls.c.room_id.in_(room_ids[i:i + SELECT_CHUNK_SIZE])))
+                existing.update(room_id for room_id, in rows)
+            updates = [dict(_room_id=room_state.room_id,
+                            power_levels=room_state._power_levels_text)
+                       for room_state in room_states if room_state.room_id in existing]
+            inserts = [dict(room_id=room_state.room_id,
+                            power_levels=room_state._power_levels_text)
+                       for room_state in room_states if room_state.room_id not in existing]
+            if updates:
+                conn.execute(cls.t.update().where(cls.c.room_id == bindparam("_room_id")),
+                             updates)
+            if inserts:
+                conn.execute(cls.t.insert(), inserts)
+
     @property
     def _edit_identity(self):
         return self.c.room_id == self.room_id
@@ -0,0 +1,105 @@
+# -*- coding: future_fstrings -*-
+# mautrix-telegram - A Matrix-Telegram puppeting bridge
+# Copyright (C) 2019 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import Optional
+
+from sqlalchemy import Column, Integer, BigInteger, String, Boolean, LargeBinary, and_, select
+from sqlalchemy.engine.result import RowProxy
+
+from ..types import TelegramID
+from .base import Base
+
+
+class UploadedFile(Base):
+    """A file that was uploaded to Telegram from Matrix, so that sending the same file again can
+    reuse the uploaded photo or document instead of uploading it again."""
+    __tablename__ = "uploaded_file"
+
+    owner = Column(Integer, primary_key=True)  # type: TelegramID
+    content_hash = Column(String, primary_key=True)
+    mime_type = Column(String, nullable=True)
+    is_photo = Column(Boolean, nullable=False)
+    id = Column(BigInteger, nullable=False)
+    access_hash = Column(BigInteger, nullable=False)
+    file_reference = Column(LargeBinary, nullable=False)
+    timestamp = Column(BigInteger)
+    # The attributes the document was uploaded with. Telegram keeps them for every message the
+    # document is sent in, so they're compared before reusing it. Photos don't have them.
+    file_name = Column(String, nullable=True)
+    width = Column(Integer, nullable=True)
+    height = Column(Integer, nullable=True)
+
+    @classmethod
+    def scan(cls, row) -> 'UploadedFile':
+        (owner, content_hash, mime_type, is_photo, file_id, access_hash, file_reference,
+         timestamp, file_name, width, height) = row
+        return cls(owner=owner, content_hash=content_hash, mime_type=mime_type,
+                   is_photo=is_photo, id=file_id, access_hash=access_hash,
+                   file_reference=file_reference, timestamp=timestamp, file_name=file_name,
+                   width=width, height=height)
+
+    @classmethod
+    def _one_or_none(cls, rows: RowProxy) -> Optional['UploadedFile']:
+        try:
+            return cls.scan(next(rows))
+        except StopIteration:
+            return None
+
+    @classmethod
+    def get_by_hash(cls, owner: TelegramID, content_hash: str) -> Optional['UploadedFile']:
+        return cls._select_one_or_none(and_(cls.c.owner == owner,
+                                            cls.c.content_hash == content_hash))
+
+    @classmethod
+    def get_by_mxc(cls, owner: TelegramID, mxc: str, msgtype: str) -> Optional['UploadedFile']:
+        alias = UploadedFileMXC.c
+        return cls._one_or_none(cls.db.execute(
+            select([cls.t]).select_from(cls.t.join(UploadedFileMXC.t, and_(
+                alias.owner == cls.c.owner, alias.content_hash == cls.c.content_hash)))
+            .where(and_(alias.owner == owner, alias.mxc == mxc, alias.msgtype == msgtype))))
+
+    @property
+    def _edit_identity(self):
+        return and_(self.c.owner == self.owner, self.c.content_hash == self.content_hash)
+
+    def insert(self) -> None:
+        with self.db.begin() as conn:
+            # The same file may have been uploaded again after its reference expired.
+            conn.execute(self.t.delete().where(self._edit_identity))
+            conn.execute(self.t.insert().values(
+                owner=self.owner, content_hash=self.content_hash, mime_type=self.mime_type,
+                is_photo=self.is_photo, id=self.id, access_hash=self.access_hash,
+                file_reference=self.file_reference, timestamp=self.timestamp,
+                file_name=self.file_name, width=self.width, height=self.height))
+
+
+class UploadedFileMXC(Base):
+    """A Matrix file that has the same content as an uploaded file. The same content can be sent
+    from Matrix under many mxc URIs (and message types), which all reuse the same upload."""
+    __tablename__ = "uploaded_file_mxc"
+
+    owner = Column(Integer, primary_key=True)  # type: TelegramID
+    mxc = Column(String, primary_key=True)
+    msgtype = Column(String, primary_key=True)
+    content_hash = Column(String, nullable=False)
+
+    @classmethod
+    def set(cls, owner: TelegramID, mxc: str, msgtype: str, content_hash: str) -> None:
+        identity = and_(cls.c.owner == owner, cls.c.mxc == mxc, cls.c.msgtype == msgtype)
+        with cls.db.begin() as conn:
+            conn.execute(cls.t.delete().where(identity))
+            conn.execute(cls.t.insert().values(owner=owner, mxc=mxc, msgtype=msgtype,
+                                               content_hash=content_hash))
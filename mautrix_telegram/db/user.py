@@ -14,7 +14,7 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
-from sqlalchemy import Column, ForeignKey, ForeignKeyConstraint, Integer, String
+from sqlalchemy import Column, ForeignKey, ForeignKeyConstraint, Index, Integer, String
 from sqlalchemy.engine.result import RowProxy
 from typing import Optional, Iterable, Tuple
 
@@ -31,6 +31,8 @@ class User(Base):
     tg_phone = Column(String, nullable=True)
     saved_contacts = Column(Integer, default=0, nullable=False)
 
+    __table_args__ = (Index("ix_user_tg_username", "tg_username"),)
+
     @classmethod
     def _one_or_none(cls, rows: RowProxy) -> Optional['User']:
         try:
@@ -120,7 +122,8 @@ class UserPortal(Base):
 
     __table_args__ = (ForeignKeyConstraint(("portal", "portal_receiver"),
                                            ("portal.tgid", "portal.tg_receiver"),
-                                           onupdate="CASCADE", ondelete="CASCADE"),)
+                                           onupdate="CASCADE", ondelete="CASCADE"),
+                      Index("ix_user_portal_portal", "portal", "portal_receiver"))
 
 
 class Contact(Base):
@@ -14,11 +14,12 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
-from sqlalchemy import Column, String, and_
-from typing import Dict, Optional
+from sqlalchemy import Column, String, and_, bindparam, select
+from sqlalchemy.engine.result import RowProxy
+from typing import Dict, Iterable, List, Optional, Set, Tuple
 
 from ..types import MatrixUserID, MatrixRoomID
-from .base import Base
+from .base import Base, SELECT_CHUNK_SIZE
 
 
 class UserProfile(Base):
@@ -37,17 +38,33 @@ class UserProfile(Base):
             "avatar_url": self.avatar_url,
         }
 
+    @classmethod
+    def scan(cls, row: RowProxy) -> 'UserProfile':
+        room_id, user_id, membership, displayname, avatar_url = row
+        return cls(room_id=room_id, user_id=user_id, membership=membership,
+                   displayname=displayname, avatar_url=avatar_url)
+
     @classmethod
     def get(cls, room_id: MatrixRoomID, user_id: MatrixUserID) -> Optional['UserProfile']:
         rows = cls.db.execute(
             cls.t.select().where(and_(cls.c.room_id == room_id, cls.c.user_id == user_id)))
         try:
-            room_id, user_id, membership, displayname, avatar_url = next(rows)
-            return cls(room_id=room_id, user_id=user_id, membership=membership,
-                       displayname=displayname, avatar_url=avatar_url)
+            return cls.scan(next(rows))
         except StopIteration:
             return None
 
+    @classmethod
+    def all(cls) -> Iterable['UserProfile']:
+        rows = cls.db.execute(cls.t.select())
+        for row in rows:
+            yield cls.scan(row)
+
+    @classmethod
+    def all_in_room(cls, room_id: MatrixRoomID) -> Iterable['UserProfile']:
+        rows = cls.db.execute(cls.t.select().where(cls.c.room_id == room_id))
+        for row in rows:
+            yield cls.scan(row)
+
     @classmethod
     def delete_all(cls, room_id: MatrixRoomID) -> None:
         with cls.db.begin() as conn:
@@ -57,6 +74,37 @@ class UserProfile(Base):
         super().update(membership=self.membership, displayname=self.displayname,
                        avatar_url=self.avatar_url)
 
+    @classmethod
+    def bulk_upsert(cls, profiles: List['UserProfile']) -> None:
+        """Write many profiles in one transaction, with one update and one insert statement."""
+        by_room = {}  # type: Dict[MatrixRoomID, List[MatrixUserID]]
+        for profile in profiles:
+            by_room.setdefault(profile.room_id, []).append(profile.user_id)
+        with cls.db.begin() as conn:
+            existing = set()  # type: Set[Tuple[MatrixRoomID, MatrixUserID]]
+            for room_id, user_ids in by_room.items():
+                for i in range(0, len(user_ids), SELECT_CHUNK_SIZE):
+                    rows = conn.execute(select([cls.c.user_id]).where(and_(
+                        cls.c.room_id == room_id,
+                        cls.c.user_id.in_(user_ids[i:i + SELECT_CHUNK_SIZE]))))
+                    existing.update((room_id, user_id) for user_id, in rows)
+            updates, inserts = [], []  # type: List[Dict], List[Dict]
+            for profile in profiles:
+                values = dict(membership=profile.membership, displayname=profile.displayname,
+                              avatar_url=profile.avatar_url)
+                if (profile.room_id, profile.user_id) in existing:
+                    updates.append(dict(values, _room_id=profile.room_id,
+                                        _user_id=profile.user_id))
+                else:
+                    inserts.append(dict(values, room_id=profile.room_id,
+                                        user_id=profile.user_id))
+            if updates:
+                conn.execute(cls.t.update().where(and_(cls.c.room_id == bindparam("_room_id"),
+                                                       cls.c.user_id == bindparam("_user_id"))),
+                             updates)
+            if inserts:
+                conn.execute(cls.t.insert(), inserts)
+
     @property
     def _edit_identity(self):
         return and_(self.c.room_id == self.room_id, self.c.user_id == self.user_id)
@@ -0,0 +1,271 @@
+# -*- coding: future_fstrings -*-
+# mautrix-telegram - A Matrix-Telegram puppeting bridge
+# Copyright (C) 2019 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import Callable, Dict, List, Optional, Tuple, Union, TYPE_CHECKING
+from collections import OrderedDict
+import threading
+import logging
+import time
+
+from sqlalchemy import or_
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.sql.expression import ClauseElement
+
+from ..types import TelegramID
+
+if TYPE_CHECKING:
+    from .message import Message
+
+Predicate = Callable[['Message'], bool]
+MessageKey = Tuple[TelegramID, TelegramID]
+
+
+class _Insert:
+    def __init__(self, message: 'Message') -> None:
+        self.message = message
+
+
+class _Update:
+    def __init__(self, clause: ClauseElement, matches: Predicate, values: Dict) -> None:
+        self.clause = clause
+        self.matches = matches
+        self.values = values
+
+
+class _Delete:
+    def __init__(self, clause: ClauseElement, matches: Predicate) -> None:
+        self.clause = clause
+        self.matches = matches
+
+
+Operation = Union[_Insert, _Update, _Delete]
+
+# How long full buffers wait before trying to write again after a failed write.
+RETRY_DELAY = 5  # type: float
+
+
+class MessageWriteBuffer:
+    """A write-behind buffer for the ``message`` table.
+
+    Inserts, updates and deletes are queued in memory and written in a single transaction when
+    ``max_size`` changes are queued or when :meth:`flush` is called (periodically and at shutdown).
+    Consecutive inserts are written as one multi-row statement.
+
+    Reads go through :meth:`select`, which applies the queued changes on top of the database rows,
+    so callers see the same data they would without the buffer. This assumes that updates never
+    change the primary key (``tgid`` and ``tg_space``). Inserts only check the queue and the
+    message cache for duplicates, so that they don't need a query. A duplicate of a row that's
+    already in the database is found when the batch is written, and is logged and dropped.
+
+    If a write fails for another reason, the batch is put back in the queue and written again
+    with the next flush, and the error is only raised from an explicit :meth:`flush`.
+
+    All methods are thread-safe, as they're usually called from the database executor. The lock
+    is only held while the queue is changed or copied, never during database I/O. The changes
+    that are being written stay visible to reads until the write is done.
+    """
+    log = logging.getLogger("mau.db.write_buffer")  # type: logging.Logger
+
+    def __init__(self, message_class: type, max_size: int = 100) -> None:
+        self.cls = message_class
+        self.max_size = max_size  # type: int
+        self._lock = threading.RLock()
+        # Held for the whole flush, so that batches are written in order.
+        self._flush_lock = threading.Lock()
+        self._ops = []  # type: List[Operation]
+        self._inserts = OrderedDict()  # type: Dict[MessageKey, Message]
+        self._flushing_ops = []  # type: List[Operation]
+        self._flushing_inserts = OrderedDict()  # type: Dict[MessageKey, Message]
+        self._retry_at = 0.0  # type: float
+
+        self.flushes = 0  # type: int
+        self.flushed_ops = 0  # type: int
+        self.failed_ops = 0  # type: int
+
+    @property
+    def pending(self) -> int:
+        return len(self._ops)
+
+    @staticmethod
+    def _key(message: 'Message') -> MessageKey:
+        return message.tgid, message.tg_space
+
+    def _copy(self, message: 'Message') -> 'Message':
+        return self.cls(mxid=message.mxid, mx_room=message.mx_room, tgid=message.tgid,
+                        tg_space=message.tg_space)
+
+    def _flush_if_full(self) -> None:
+        if len(self._ops) < self.max_size or time.monotonic() < self._retry_at:
+            return
+        try:
+            self.flush()
+        except Exception:
+            # The change that filled the buffer was queued, so its caller doesn't need to know.
+            self.log.exception("Failed to write buffered message changes, retrying later")
+
+    def insert(self, message: 'Message') -> None:
+        key = self._key(message)
+        if self.cls.cache and self.cls.cache.get_by_tgid(*key):
+            raise IntegrityError("INSERT INTO message", key,
+                                 ValueError(f"Message {key} already exists"))
+        with self._lock:
+            if key in self._inserts or key in self._flushing_inserts:
+                raise IntegrityError("INSERT INTO message", key,
+                                     ValueError(f"Message {key} is already queued for insert"))
+            message = self._copy(message)
+            self._inserts[key] = message
+            self._ops.append(_Insert(message))
+        self._flush_if_full()
+
+    def update(self, clause: ClauseElement, matches: Predicate, values: Dict,
+               only_key: Optional[MessageKey] = None) -> None:
+        """Queue an update.
+
+        Args:
+            clause: The SQL where clause of the update.
+            matches: A Python predicate equivalent to ``clause``.
+            values: The new values.
+            only_key: The primary key, if the update can only match a single row.
+        """
+        with self._lock:
+            for message in self._inserts.values():
+                if matches(message):
+                    for key, value in values.items():
+                        setattr(message, key, value)
+            if only_key and only_key in self._inserts:
+                # The row isn't in the database yet, so updating the queued insert is enough.
+                return
+            self._ops.append(_Update(clause, matches, values))
+        self._flush_if_full()
+
+    def delete(self, clause: ClauseElement, matches: Predicate) -> None:
+        with self._lock:
+            deleted = [key for key, message in self._inserts.items() if matches(message)]
+            for key in deleted:
+                del self._inserts[key]
+            if deleted:
+                self._ops = [op for op in self._ops if not isinstance(op, _Insert)
+                             or self._key(op.message) not in deleted]
+            # The queued insert may have been a duplicate of a row that's in the database, so the
+            # delete is queued even if it matched one.
+            self._ops.append(_Delete(clause, matches))
+        self._flush_if_full()
+
+    @staticmethod
+    def _apply(rows: Dict[MessageKey, 'Message'], changes: List[Operation]) -> None:
+        for op in changes:
+            for key, row in list(rows.items()):
+                if not op.matches(row):
+                    continue
+                elif isinstance(op, _Delete):
+                    del rows[key]
+                else:
+                    for attr, value in op.values.items():
+                        setattr(row, attr, value)
+
+    def select(self, clause: ClauseElement, matches: Predicate) -> List['Message']:
+        """Find the rows matching a where clause, taking queued changes into account.
+
+        Args:
+            clause: The SQL where clause.
+            matches: A Python predicate equivalent to ``clause``.
+        """
+        with self._lock:
+            flushing_changes = [op for op in self._flushing_ops if not isinstance(op, _Insert)]
+            flushing_inserts = [self._copy(message)
+                                for message in self._flushing_inserts.values()]
+            changes = [op for op in self._ops if not isinstance(op, _Insert)]
+            inserts = [self._copy(message) for message in self._inserts.values()]
+        # Queued updates may make rows match the clause, so fetch the rows they'd touch too.
+        update_clauses = [op.clause for op in flushing_changes + changes
+                          if isinstance(op, _Update)]
+        if update_clauses:
+            clause = or_(clause, *update_clauses)
+        rows = OrderedDict((self._key(row), row) for row
+                           in self.cls._all(self.cls.db.execute(self.cls.t.select()
+                                                                .where(clause))))
+        # The changes that are being written may or may not be in the rows yet. Applying them
+        # again is harmless, and the queued inserts already contain the updates made to them.
+        self._apply(rows, flushing_changes)
+        for message in flushing_inserts:
+            rows[self._key(message)] = message
+        self._apply(rows, changes)
+        for message in inserts:
+            rows[self._key(message)] = message
+        return [row for row in rows.values() if matches(row)]
+
+    def _execute(self, conn, ops: List[Operation]) -> None:
+        inserts = []  # type: List[Dict]
+        for op in ops:
+            if isinstance(op, _Insert):
+                inserts.append(dict(mxid=op.message.mxid, mx_room=op.message.mx_room,
+                                    tgid=op.message.tgid, tg_space=op.message.tg_space))
+                continue
+            elif inserts:
+                conn.execute(self.cls.t.insert(), inserts)
+                inserts = []
+            if isinstance(op, _Update):
+                conn.execute(self.cls.t.update().where(op.clause).values(**op.values))
+            else:
+                conn.execute(self.cls.t.delete().where(op.clause))
+        if inserts:
+            conn.execute(self.cls.t.insert(), inserts)
+
+    def flush(self) -> None:
+        with self._flush_lock:
+            with self._lock:
+                if not self._ops:
+                    return
+                ops = self._flushing_ops = self._ops
+                self._flushing_inserts = self._inserts
+                self._ops = []
+                self._inserts = OrderedDict()
+            try:
+                self._write(ops)
+            except Exception:
+                with self._lock:
+                    # Changes queued during the write go after the batch, like they would have.
+                    self._ops = ops + self._ops
+                    inserts, self._inserts = self._flushing_inserts, self._inserts
+                    inserts.update(self._inserts)
+                    self._inserts = inserts
+                    self._retry_at = time.monotonic() + RETRY_DELAY
+                raise
+            finally:
+                with self._lock:
+                    self._flushing_ops = []
+                    self._flushing_inserts = OrderedDict()
+            self.flushes += 1
+            self.flushed_ops += len(ops)
+
+    def _write(self, ops: List[Operation]) -> None:
+        try:
+            with self.cls.db.begin() as conn:
+                self._execute(conn, ops)
+        except IntegrityError:
+            self.log.warning(f"Batch of {len(ops)} message changes conflicted with existing "
+                             "rows, retrying one by one")
+            for op in ops:
+                try:
+                    with self.cls.db.begin() as conn:
+                        self._execute(conn, [op])
+                except IntegrityError:
+                    self.failed_ops += 1
+                    self.log.exception("Failed to write buffered message change")
+            if self.cls.cache:
+                # The cache was written through with changes that didn't make it to the
+                # database, so it can't be trusted anymore.
+                self.cls.cache.clear()
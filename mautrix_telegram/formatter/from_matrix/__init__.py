@@ -85,8 +85,8 @@ def matrix_to_telegram(html: str) -> ParsedMessage:
         raise FormatError(f"Failed to convert Matrix format: {html}") from e
 
 
-def matrix_reply_to_telegram(content: Dict[str, Any], tg_space: TelegramID,
-                             room_id: Optional[MatrixRoomID] = None) -> Optional[TelegramID]:
+async def matrix_reply_to_telegram(content: Dict[str, Any], tg_space: TelegramID,
+                                   room_id: Optional[MatrixRoomID] = None) -> Optional[TelegramID]:
     try:
         reply = content.get("m.relates_to", {}).get("m.in_reply_to", {})
         if not reply:
@@ -101,7 +101,7 @@ def matrix_reply_to_telegram(content: Dict[str, Any], tg_space: TelegramID,
             pass
         content["body"] = trim_reply_fallback_text(content["body"])
 
-        message = DBMessage.get_by_mxid(event_id, room_id, tg_space)
+        message = await DBMessage.aio.get_by_mxid(event_id, room_id, tg_space)
         if message:
             return message.tgid
     except KeyError:
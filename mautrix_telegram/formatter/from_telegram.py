@@ -48,12 +48,12 @@ log = logging.getLogger("mau.fmt.tg")  # type: logging.Logger
 should_highlight_edits = False  # type: bool
 
 
-def telegram_reply_to_matrix(evt: Message, source: 'AbstractUser') -> Dict:
+async def telegram_reply_to_matrix(evt: Message, source: 'AbstractUser') -> Dict:
     if evt.reply_to_msg_id:
         space = (evt.to_id.channel_id
                  if isinstance(evt, Message) and isinstance(evt.to_id, PeerChannel)
                  else source.tgid)
-        msg = DBMessage.get_by_tgid(evt.reply_to_msg_id, space)
+        msg = await DBMessage.aio.get_by_tgid(evt.reply_to_msg_id, space)
         if msg:
             return {
                 "m.in_reply_to": {
@@ -136,7 +136,7 @@ async def _add_reply_header(source: "AbstractUser", text: str, html: str, evt: M
              if isinstance(evt, Message) and isinstance(evt.to_id, PeerChannel)
              else source.tgid)
 
-    msg = DBMessage.get_by_tgid(evt.reply_to_msg_id, space)
+    msg = await DBMessage.aio.get_by_tgid(evt.reply_to_msg_id, space)
     if not msg:
         return text, html
 
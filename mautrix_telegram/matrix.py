@@ -22,10 +22,12 @@ import re
 from mautrix_appservice import MatrixRequestError, IntentError
 
 from .types import MatrixEvent, MatrixEventID, MatrixRoomID, MatrixUserID
+from .abstract_user import PRESENCE_REFRESH
 from . import user as u, portal as po, puppet as pu, commands as com
 
 if TYPE_CHECKING:
     from .context import Context
+    from .sharding import ShardRouter
 
 
 class MatrixHandler:
@@ -34,9 +36,16 @@ class MatrixHandler:
     def __init__(self, context: 'Context') -> None:
         self.az, self.config, _, self.tgbot = context.core
         self.commands = com.CommandProcessor(context)  # type: com.CommandProcessor
-        self.previously_typing = []  # type: List[MatrixUserID]
+        self.previously_typing = {}  # type: Dict[MatrixRoomID, Set[MatrixUserID]]
+        self.shards = context.shards  # type: ShardRouter
 
-        self.az.matrix_event_handler(self.handle_event)
+        if self.shards.enabled and self.shards.is_front:
+            self.az.matrix_event_handler(self.route_event)
+        elif self.shards.enabled:
+            self.az.matrix_event_handler(self.handle_shard_event)
+        else:
+            self.az.matrix_event_handler(self.handle_event)
+        self.shards.local_handler = self.try_handle_event
 
     async def init_as_bot(self) -> None:
         displayname = self.config["appservice.bot_displayname"]
@@ -230,6 +239,16 @@ class MatrixHandler:
         if not is_command and portal and (await sender.is_logged_in() or portal.has_bot):
             await portal.handle_matrix_message(sender, message, event_id)
             return
+        elif not is_command and portal and not self.shards.is_front:
+            # The relaybot only runs in the front process.
+            await self.shards.relay_to_front({
+                "type": "m.room.message",
+                "room_id": room,
+                "sender": sender_id,
+                "event_id": event_id,
+                "content": message,
+            })
+            return
 
         if not sender.whitelisted or message.get("msgtype", "m.unknown") != "m.text":
             return
@@ -338,30 +357,43 @@ class MatrixHandler:
             await portal.mark_read(user, event_id)
 
     @staticmethod
-    async def handle_presence(user_id: MatrixUserID, presence: str) -> None:
+    async def _send_presence(user_id: MatrixUserID, online: bool) -> None:
         user = await u.User.get_by_mxid(user_id).ensure_started()
         if not await user.is_logged_in():
             return
-        await user.set_presence(presence == "online")
+        await user.set_presence(online)
+
+    @classmethod
+    async def handle_presence(cls, user_id: MatrixUserID, presence: str) -> None:
+        online = presence == "online"
+        u.User.ephemeral.set(("tg_presence", user_id), online,
+                             lambda: cls._send_presence(user_id, online),
+                             refresh=PRESENCE_REFRESH)
+
+    @staticmethod
+    async def _send_typing(portal: po.Portal, user_id: MatrixUserID, is_typing: bool) -> None:
+        user = await u.User.get_by_mxid(user_id).ensure_started()
+        if not await user.is_logged_in():
+            return
+        await portal.set_typing(user, is_typing)
 
     async def handle_typing(self, room_id: MatrixRoomID, now_typing: List[MatrixUserID]) -> None:
         portal = po.Portal.get_by_mxid(room_id)
         if not portal:
             return
 
-        for user_id in set(self.previously_typing + now_typing):
-            is_typing = user_id in now_typing
-            was_typing = user_id in self.previously_typing
-            if is_typing and was_typing:
-                continue
+        typing = set(now_typing)
+        previously_typing = self.previously_typing.get(room_id, set())
+        for user_id in typing ^ previously_typing:
+            is_typing = user_id in typing
+            u.User.ephemeral.set(("tg_typing", room_id, user_id), is_typing,
+                                 lambda user_id=user_id, is_typing=is_typing:
+                                 self._send_typing(portal, user_id, is_typing))
 
-            user = await u.User.get_by_mxid(user_id).ensure_started()
-            if not await user.is_logged_in():
-                continue
-
-            await portal.set_typing(user, is_typing)
-
-        self.previously_typing = now_typing
+        if typing:
+            self.previously_typing[room_id] = typing
+        else:
+            self.previously_typing.pop(room_id, None)
 
     def filter_matrix_event(self, event: MatrixEvent) -> bool:
         sender = event.get("sender", None)
@@ -376,6 +408,24 @@ class MatrixHandler:
         except Exception:
             self.log.exception("Error handling manually received Matrix event")
 
+    async def route_event(self, evt: MatrixEvent) -> None:
+        if self.filter_matrix_event(evt):
+            # Events from the bridge's own users aren't handled, but the state store of every
+            # shard needs their membership and power level changes.
+            self.shards.broadcast_state(evt)
+            return
+        elif self.shards.route(evt):
+            return
+        await self.handle_event(evt)
+
+    async def handle_shard_event(self, evt: MatrixEvent) -> None:
+        # The appservice has already updated the state store. State events are forwarded to every
+        # shard for that, but only handled by the shard that owns the sender.
+        sender = evt.get("sender", None)
+        if sender and not self.shards.owns(sender):
+            return
+        await self.handle_event(evt)
+
     async def handle_event(self, evt: MatrixEvent) -> None:
         if self.filter_matrix_event(evt):
             return
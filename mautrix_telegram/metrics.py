@@ -0,0 +1,175 @@
+# -*- coding: future_fstrings -*-
+# mautrix-telegram - A Matrix-Telegram puppeting bridge
+# Copyright (C) 2019 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import Any, Awaitable, Callable, Optional, TYPE_CHECKING
+import functools
+import logging
+import asyncio
+import time
+
+from aiohttp import web
+
+try:
+    from prometheus_client import (Counter, Gauge, Histogram, REGISTRY, generate_latest,
+                                   CONTENT_TYPE_LATEST)
+except ImportError:
+    Counter = Gauge = Histogram = REGISTRY = generate_latest = CONTENT_TYPE_LATEST = None
+
+if TYPE_CHECKING:
+    from .context import Context
+
+log = logging.getLogger("mau.metrics")  # type: logging.Logger
+
+enabled = False  # type: bool
+
+FILE_SIZE_BUCKETS = (1024, 16 * 1024, 128 * 1024, 512 * 1024, 1024 ** 2, 4 * 1024 ** 2,
+                     16 * 1024 ** 2, 64 * 1024 ** 2, 256 * 1024 ** 2, 1024 ** 3, float("inf"))
+
+if Histogram:
+    TELEGRAM_MESSAGE_TIME = Histogram("bridge_telegram_message_seconds",
+                                      "Time spent bridging a Telegram message to Matrix")
+    MATRIX_MESSAGE_TIME = Histogram("bridge_matrix_message_seconds",
+                                    "Time spent bridging a Matrix message to Telegram")
+    FILE_TRANSFER_TIME = Histogram("bridge_file_transfer_seconds",
+                                   "Time spent transferring a file", ["direction"])
+    FILE_TRANSFER_SIZE = Histogram("bridge_file_transfer_bytes", "Size of transferred files",
+                                   ["direction"], buckets=FILE_SIZE_BUCKETS)
+    DB_QUERY_TIME = Histogram("bridge_db_query_seconds",
+                              "Time spent running a database method in the executor", ["method"])
+    DEDUP_LOOKUPS = Counter("bridge_dedup_lookups_total",
+                            "Incoming Telegram events checked for duplicates",
+                            ["kind", "result"])
+    LOOP_LAG = Histogram("bridge_event_loop_lag_seconds",
+                         "How late the event loop runs a callback that was scheduled in advance")
+    CONNECTED_CLIENTS = Gauge("bridge_connected_clients",
+                              "Number of Telegram clients of Matrix users that are connected")
+    PROFILE_UPDATES = Counter("bridge_puppet_profile_updates_total",
+                              "Puppet displayname and avatar updates that were applied or skipped "
+                              "because nothing had changed", ["kind", "result"])
+    INSTANCE_CACHE_SIZE = Gauge("bridge_instance_cache_entries",
+                                "Number of portals, puppets or users in an in-memory registry",
+                                ["cache"])
+    INSTANCE_CACHE_MEMORY = Gauge("bridge_instance_cache_memory_bytes",
+                                  "Estimated memory used by the objects in a registry", ["cache"])
+    INSTANCE_CACHE_EVICTIONS = Counter("bridge_instance_cache_evictions_total",
+                                       "Objects evicted from a registry", ["cache"])
+    DEDUP_ENTRIES = Gauge("bridge_dedup_entries",
+                          "Number of recent Telegram events remembered for deduplication")
+    MATRIX_QUEUE_DEPTH = Gauge("bridge_matrix_request_queue_depth",
+                               "Number of Matrix requests waiting for the request scheduler",
+                               ["lane"])
+    MATRIX_REQUESTS_IN_FLIGHT = Gauge("bridge_matrix_requests_in_flight",
+                                      "Number of Matrix requests being sent")
+    MATRIX_RATE_LIMITED = Counter("bridge_matrix_rate_limited_requests_total",
+                                  "Matrix requests that got a 429 response")
+else:
+    TELEGRAM_MESSAGE_TIME = MATRIX_MESSAGE_TIME = FILE_TRANSFER_TIME = FILE_TRANSFER_SIZE = None
+    DB_QUERY_TIME = DEDUP_LOOKUPS = LOOP_LAG = CONNECTED_CLIENTS = DEDUP_ENTRIES = None
+    PROFILE_UPDATES = INSTANCE_CACHE_SIZE = INSTANCE_CACHE_MEMORY = INSTANCE_CACHE_EVICTIONS = None
+    MATRIX_QUEUE_DEPTH = MATRIX_REQUESTS_IN_FLIGHT = MATRIX_RATE_LIMITED = None
+
+
+def timed(histogram: Optional['Histogram']) -> Callable:
+    """Decorate a coroutine function to observe how long each call takes."""
+
+    def decorator(func: Callable[..., Awaitable[Any]]) -> Callable[..., Awaitable[Any]]:
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs) -> Any:
+            if not enabled:
+                return await func(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - start)
+
+        return wrapper if histogram else func
+
+    return decorator
+
+
+def observe_file_transfer(direction: str, size: int, duration: float) -> None:
+    if enabled:
+        FILE_TRANSFER_TIME.labels(direction=direction).observe(duration)
+        FILE_TRANSFER_SIZE.labels(direction=direction).observe(size)
+
+
+def count_dedup(kind: str, hit: bool) -> None:
+    if enabled:
+        DEDUP_LOOKUPS.labels(kind=kind, result="hit" if hit else "miss").inc()
+
+
+def count_profile_update(kind: str, applied: bool) -> None:
+    if enabled:
+        PROFILE_UPDATES.labels(kind=kind, result="applied" if applied else "skipped").inc()
+
+
+def count_instance_cache_eviction(cache: str) -> None:
+    if enabled:
+        INSTANCE_CACHE_EVICTIONS.labels(cache=cache).inc()
+
+
+def count_matrix_rate_limit() -> None:
+    if enabled:
+        MATRIX_RATE_LIMITED.inc()
+
+
+async def handle_metrics(_: web.Request) -> web.Response:
+    return web.Response(body=generate_latest(), headers={"Content-Type": CONTENT_TYPE_LATEST})
+
+
+async def measure_loop_lag(loop: asyncio.AbstractEventLoop, interval: float = 1) -> None:
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        LOOP_LAG.observe(max(loop.time() - start - interval, 0))
+
+
+def _count_connected_clients() -> int:
+    from .user import User
+    return sum(1 for user in User.by_tgid.values() if user.connected)
+
+
+def _count_dedup_entries() -> int:
+    from .portal import Portal
+    return Portal.dedup.size if Portal.dedup else 0
+
+
+def init(context: 'Context') -> None:
+    global enabled
+    config = context.config
+    if not config["appservice.metrics.enabled"]:
+        return
+    elif not Histogram:
+        log.warning("Metrics are enabled in the config, but prometheus_client is not installed")
+        return
+    enabled = True
+    context.az.app.router.add_route("GET", config["appservice.metrics.path"] or "/metrics",
+                                    handle_metrics)
+    CONNECTED_CLIENTS.set_function(_count_connected_clients)
+    DEDUP_ENTRIES.set_function(_count_dedup_entries)
+    from .util import InstanceCache
+    for cache in InstanceCache.all:
+        INSTANCE_CACHE_SIZE.labels(cache=cache.name).set_function(cache.__len__)
+        INSTANCE_CACHE_MEMORY.labels(cache=cache.name).set_function(cache.estimate_memory)
+    scheduler = context.request_scheduler
+    if scheduler:
+        from .util.request_scheduler import LANES
+        for lane, name in enumerate(LANES):
+            MATRIX_QUEUE_DEPTH.labels(lane=name).set_function(
+                lambda lane=lane: scheduler.queue_depth(lane))
+        MATRIX_REQUESTS_IN_FLIGHT.set_function(lambda: scheduler.in_flight)
+    asyncio.ensure_future(measure_loop_lag(context.loop), loop=context.loop)
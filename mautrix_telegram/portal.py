@@ -15,19 +15,20 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 from typing import Awaitable, Dict, List, Optional, Pattern, Tuple, Union, cast, TYPE_CHECKING, Any
-from collections import deque
 from datetime import datetime
 from string import Template
 from html import escape as escape_html
+import functools
 import asyncio
 import random
 import mimetypes
 import codecs
 import unicodedata
 import base64
-import hashlib
 import logging
 import json
+import time
+import os
 import re
 
 import magic
@@ -42,8 +43,9 @@ from telethon.tl.functions.channels import (
     GetParticipantsRequest, InviteToChannelRequest, JoinChannelRequest, LeaveChannelRequest,
     UpdateUsernameRequest)
 from telethon.tl.functions.messages import ReadHistoryRequest as ReadMessageHistoryRequest
+from telethon.tl.types.channels import ChannelParticipantsNotModified
 from telethon.tl.functions.channels import ReadHistoryRequest as ReadChannelHistoryRequest
-from telethon.errors import ChatAdminRequiredError, ChatNotModifiedError
+from telethon.errors import ChatAdminRequiredError, ChatNotModifiedError, RPCError
 from telethon.tl.patched import Message, MessageService
 from telethon.tl.types import (
     Channel, ChatAdminRights, ChatBannedRights, ChannelFull, ChannelParticipantAdmin,
@@ -55,8 +57,8 @@ from telethon.tl.types import (
     MessageActionChannelCreate, MessageActionChatAddUser, MessageActionChatCreate,
     MessageActionChatDeletePhoto, MessageActionChatDeleteUser, MessageActionChatEditPhoto,
     MessageActionChatEditTitle, MessageActionChatJoinedByLink, MessageActionChatMigrateTo,
-    MessageActionPinMessage, MessageActionGameScore, MessageMediaContact, MessageMediaDocument,
-    MessageMediaGeo, MessageMediaPhoto, MessageMediaUnsupported, MessageMediaGame, MessageMediaPoll,
+    MessageActionPinMessage, MessageActionGameScore, MessageMediaDocument, MessageMediaGeo,
+    MessageMediaPhoto, MessageMediaUnsupported, MessageMediaGame, MessageMediaPoll,
     PeerChannel, PeerChat, PeerUser, Photo, PhotoCachedSize, SendMessageCancelAction,
     SendMessageTypingAction, TypeChannelParticipant, TypeChat, TypeChatParticipant,
     TypeDocumentAttribute, TypeInputPeer, TypeMessageAction, TypeMessageEntity, TypePeer,
@@ -66,15 +68,18 @@ from mautrix_appservice import MatrixRequestError, IntentError, AppService, Inte
 
 from .types import MatrixEventID, MatrixRoomID, MatrixUserID, TelegramID
 from .context import Context
-from .db import Portal as DBPortal, Message as DBMessage, TelegramFile as DBTelegramFile
+from .db import (Portal as DBPortal, Message as DBMessage, TelegramFile as DBTelegramFile,
+                 UploadedFile as DBUploadedFile, DedupClaim as DBDedupClaim,
+                 ParticipantPage as DBParticipantPage)
 from .util import ignore_coro
-from . import puppet as p, user as u, formatter, util
+from . import puppet as p, user as u, formatter, metrics, util
 
 if TYPE_CHECKING:
     from .bot import Bot
     from .abstract_user import AbstractUser
     from .config import Config
     from .tgclient import MautrixTelegramClient
+    from .sharding import ShardRouter
 
 mimetypes.init()
 
@@ -83,14 +88,30 @@ config = None  # type: Config
 TypeMessage = Union[Message, MessageService]
 TypeParticipant = Union[TypeChatParticipant, TypeChannelParticipant]
 DedupMXID = Tuple[MatrixEventID, TelegramID]
+DedupKey = Tuple[TelegramID, TelegramID, str]
 InviteList = Union[MatrixUserID, List[MatrixUserID]]
 
+# Telegram clients repeat typing notifications every few seconds while the user is typing, so the
+# Matrix typing notifications are refreshed a bit before they time out.
+TYPING_TIMEOUT = 6000  # type: int
+TYPING_REFRESH = 4  # type: float
+
 
 class Portal:
+    # Any new instance attributes must be added here, see Puppet.__slots__.
+    __slots__ = ("mxid", "tgid", "tg_receiver", "peer_type", "username", "megagroup", "title",
+                 "about", "photo_id", "local_config", "_db_instance", "deleted", "log",
+                 "_main_intent", "_room_create_lock", "_temp_pinned_message_id",
+                 "_temp_pinned_message_id_space", "_temp_pinned_message_sender", "_send_locks",
+                 "_loaded_at", "_pending_participant_pages")
+
     base_log = logging.getLogger("mau.portal")  # type: logging.Logger
     az = None  # type: AppService
     bot = None  # type: Bot
     loop = None  # type: asyncio.AbstractEventLoop
+    media_cache = None  # type: Optional[util.MediaCache]
+    dedup = None  # type: util.DedupStore
+    shards = None  # type: ShardRouter
 
     # Config cache
     filter_mode = None  # type: str
@@ -100,17 +121,21 @@ class Portal:
     max_initial_member_sync = -1  # type: int
     sync_channel_members = True  # type: bool
     sync_matrix_state = True  # type: bool
+    member_sync_concurrency = 10  # type: int
+    member_sync_progress_interval = 30  # type: float
 
     dedup_pre_db_check = False  # type: bool
-    dedup_cache_queue_length = 20  # type: int
+    dedup_shared = False  # type: bool
+    dedup_claim_wait = 60  # type: float
 
     alias_template = None  # type: str
     mx_alias_regex = None  # type: Pattern
     hs_domain = None  # type: str
 
     # Instance cache
-    by_mxid = {}  # type: Dict[MatrixRoomID, Portal]
-    by_tgid = {}  # type: Dict[Tuple[TelegramID, TelegramID], Portal]
+    by_mxid = util.InstanceCache("portals_by_mxid")  # type: Dict[MatrixRoomID, Portal]
+    by_tgid = util.InstanceCache(
+        "portals_by_tgid")  # type: Dict[Tuple[TelegramID, TelegramID], Portal]
 
     def __init__(self, tgid: TelegramID, peer_type: str, tg_receiver: Optional[TelegramID] = None,
                  mxid: Optional[MatrixRoomID] = None, username: Optional[str] = None,
@@ -137,11 +162,10 @@ class Portal:
         self._temp_pinned_message_id_space = None  # type: Optional[TelegramID]
         self._temp_pinned_message_sender = None  # type: Optional[p.Puppet]
 
-        self._dedup = deque()  # type: deque
-        self._dedup_mxid = {}  # type: Dict[str, DedupMXID]
-        self._dedup_action = deque()  # type: deque
-
         self._send_locks = {}  # type: Dict[int, asyncio.Lock]
+        self._loaded_at = time.monotonic()  # type: float
+        # Fetched participant pages that are cached once their members have been synced.
+        self._pending_participant_pages = None  # type: Optional[List[DBParticipantPage]]
 
         if tgid:
             self.by_tgid[self.tgid_full] = self
@@ -150,6 +174,17 @@ class Portal:
 
     # region Propegrties
 
+    @property
+    def is_busy(self) -> bool:
+        """Whether the portal is being created or is sending a message, so it must stay cached."""
+        return (self._room_create_lock.locked()
+                or any(lock.locked() for lock in self._send_locks.values()))
+
+    def _uncache(self) -> None:
+        self.by_tgid.discard(self.tgid_full, self)
+        if self.mxid:
+            self.by_mxid.discard(self.mxid, self)
+
     @property
     def tgid_full(self) -> Tuple[TelegramID, TelegramID]:
         return self.tgid, self.tg_receiver
@@ -215,73 +250,84 @@ class Portal:
     # endregion
     # region Deduplication
 
-    @staticmethod
-    def _hash_event(event: TypeMessage) -> str:
+    def _dedup_key(self, event: TypeMessage, force_hash: bool = False) -> DedupKey:
         # Non-channel messages are unique per-user (wtf telegram), so we have no other choice than
-        # to deduplicate based on a hash of the message content.
-
-        # The timestamp is only accurate to the second, so we can't rely solely on that either.
-        if isinstance(event, MessageService):
-            hash_content = [event.date.timestamp(), event.from_id, event.action]
-        else:
-            hash_content = [event.date.timestamp(), event.message]
-            if event.fwd_from:
-                hash_content += [event.fwd_from.from_id, event.fwd_from.channel_id]
-            elif isinstance(event, Message) and event.media:
-                try:
-                    hash_content += {
-                        MessageMediaContact: lambda media: [media.user_id],
-                        MessageMediaDocument: lambda media: [media.document.id],
-                        MessageMediaPhoto: lambda media: [media.photo.id],
-                        MessageMediaGeo: lambda media: [media.geo.long, media.geo.lat],
-                    }[type(event.media)](event.media)
-                except KeyError:
-                    pass
-        return hashlib.md5("-"
-                           .join(str(a) for a in hash_content)
-                           .encode("utf-8")
-                           ).hexdigest()
-
-    def is_duplicate_action(self, event: TypeMessage) -> bool:
-        evt_hash = self._hash_event(event) if self.peer_type != "channel" else event.id
-        if evt_hash in self._dedup_action:
-            return True
-
-        self._dedup_action.append(evt_hash)
-
-        if len(self._dedup_action) > self.dedup_cache_queue_length:
-            self._dedup_action.popleft()
-        return False
+        # to deduplicate based on a fingerprint of the message content.
+        evt_hash = (util.fingerprint_event(event)
+                    if self.peer_type != "channel" or force_hash
+                    else str(event.id))
+        return self.tgid, self.tg_receiver, evt_hash
+
+    def _action_dedup_key(self, event: TypeMessage) -> DedupKey:
+        tgid, tg_receiver, evt_hash = self._dedup_key(event)
+        return tgid, tg_receiver, f"a:{evt_hash}"
+
+    def _edit_dedup_key(self, event: TypeMessage) -> DedupKey:
+        tgid, tg_receiver, evt_hash = self._dedup_key(event, force_hash=True)
+        return tgid, tg_receiver, f"e:{evt_hash}"
+
+    def is_duplicate_action(self, event: TypeMessage, persist: bool = True) -> bool:
+        found, _ = self.dedup.check(self._action_dedup_key(event), None, kind="action",
+                                    persist=persist)
+        return found
+
+    async def claim_shared(self, key: DedupKey) -> bool:
+        """Claim a Telegram event in the database that all shards share.
+
+        Returns:
+            ``False`` if another shard already claimed the event, ``True`` otherwise.
+        """
+        return not self.dedup_shared or await DBDedupClaim.aio.claim(*key)
+
+    async def _wait_for_claimed_mxid(self, key: DedupKey) -> Optional[DedupMXID]:
+        # The shard that won the claim stores the Matrix event once it has sent it.
+        deadline = self.loop.time() + self.dedup_claim_wait
+        while True:
+            claim = await DBDedupClaim.aio.get(*key)
+            if claim and claim.mxid:
+                return claim.mxid, claim.tg_space
+            elif not claim or self.loop.time() >= deadline:
+                return None
+            await asyncio.sleep(1)
+
+    async def _map_claimed_message(self, key: DedupKey, evt: Message, tg_space: TelegramID,
+                                   temporary_identifier: MatrixEventID, edit: bool = False
+                                   ) -> None:
+        """Point this shard's copy of a message at the Matrix event that another shard sent.
+
+        Non-channel messages have a different ID for every user, so without this, later edits and
+        deletions received by this shard's users couldn't be bridged.
+        """
+        tgid = TelegramID(evt.id)
+        try:
+            found = await self._wait_for_claimed_mxid(key)
+            if not found:
+                self.log.debug(f"Shard that claimed {tgid}@{tg_space} didn't store an event ID")
+                return
+            mxid, other_tg_space = found
+            # Copies received by other users of this shard were mapped to the temporary ID.
+            self.update_duplicate(evt, found, (temporary_identifier, tg_space), force_hash=edit)
+            if tg_space != other_tg_space:
+                if edit:
+                    await DBMessage.aio.update_by_tgid(tgid, tg_space, mxid=mxid,
+                                                       mx_room=self.mxid)
+                else:
+                    await DBMessage(tgid=tgid, mx_room=self.mxid, mxid=mxid,
+                                    tg_space=tg_space).aio.insert()
+            await DBMessage.aio.update_by_mxid(temporary_identifier, self.mxid, mxid=mxid)
+        except Exception:
+            self.log.exception(f"Failed to map {tgid}@{tg_space} to the event of another shard")
 
     def update_duplicate(self, event: TypeMessage, mxid: DedupMXID = None,
                          expected_mxid: Optional[DedupMXID] = None, force_hash: bool = False
                          ) -> Optional[DedupMXID]:
-        evt_hash = self._hash_event(
-            event) if self.peer_type != "channel" or force_hash else event.id
-        try:
-            found_mxid = self._dedup_mxid[evt_hash]
-        except KeyError:
-            return MatrixEventID("None"), TelegramID(0)
+        return self.dedup.update(self._dedup_key(event, force_hash), mxid, expected_mxid)
 
-        if found_mxid != expected_mxid:
-            return found_mxid
-        self._dedup_mxid[evt_hash] = mxid
-        return None
-
-    def is_duplicate(self, event: TypeMessage, mxid: DedupMXID = None, force_hash: bool = False
-                     ) -> Optional[DedupMXID]:
-        evt_hash = (self._hash_event(event)
-                    if self.peer_type != "channel" or force_hash
-                    else event.id)
-        if evt_hash in self._dedup:
-            return self._dedup_mxid[evt_hash]
-
-        self._dedup_mxid[evt_hash] = mxid
-        self._dedup.append(evt_hash)
-
-        if len(self._dedup) > self.dedup_cache_queue_length:
-            del self._dedup_mxid[self._dedup.popleft()]
-        return None
+    def is_duplicate(self, event: TypeMessage, mxid: DedupMXID = None, force_hash: bool = False,
+                     persist: bool = True) -> Optional[DedupMXID]:
+        _, found_mxid = self.dedup.check(self._dedup_key(event, force_hash), mxid,
+                                         persist=persist)
+        return found_mxid
 
     def get_input_entity(self, user: 'AbstractUser') -> Awaitable[TypeInputPeer]:
         return user.client.get_input_entity(self.peer)
@@ -320,8 +366,8 @@ class Portal:
         if not direct:
             await self.update_info(user, entity)
             if not users or not participants:
-                users, participants = await self._get_users(user, entity)
-            await self.sync_telegram_users(user, users)
+                users, participants = await self._get_users(user, entity, only_changed=True)
+            await self.sync_telegram_users(user, users, participants)
             await self.update_telegram_participants(participants, levels)
         else:
             if not puppet:
@@ -352,6 +398,8 @@ class Portal:
                                   ) -> Optional[MatrixRoomID]:
         direct = self.peer_type == "user"
 
+        if self.shards.enabled and not await self.reload():
+            return None
         if self.mxid:
             return self.mxid
 
@@ -404,6 +452,16 @@ class Portal:
         if not room_id:
             raise Exception(f"Failed to create room")
 
+        if not await self.db_instance.aio.claim_mxid(room_id):
+            self.log.warning(f"Another shard created a room for this portal at the same time, "
+                             f"leaving {room_id}")
+            await self.reload()
+            if alias and self.mxid:
+                # The alias was moved from the other shard's room to ours when it was created.
+                await self.main_intent.remove_room_alias(alias)
+                await self.main_intent.add_room_alias(self.mxid, alias)
+            await self.main_intent.leave_room(room_id)
+            return self.mxid
         self.mxid = MatrixRoomID(room_id)
         self.by_mxid[self.mxid] = self
         self.save()
@@ -481,22 +539,46 @@ class Portal:
         if user and user.is_bot:
             user.register_portal(self)
 
-    async def sync_telegram_users(self, source: 'AbstractUser', users: List[User]) -> None:
-        allowed_tgids = set()
+    async def _sync_telegram_user(self, source: 'AbstractUser', entity: User) -> None:
+        puppet = p.Puppet.get(TelegramID(entity.id))
+        # Both of these skip the network calls when the puppet is already joined and its info
+        # hasn't changed, so an interrupted sync continues from where it stopped when it's run
+        # again.
+        await puppet.intent.ensure_joined(self.mxid)
+        await puppet.update_info(source, entity)
+
+        user = u.User.get_by_tgid(TelegramID(entity.id))
+        if user:
+            await self.invite_to_matrix(user.mxid)
+
+    async def sync_telegram_users(self, source: 'AbstractUser', users: List[User],
+                                  participants: Optional[List[TypeParticipant]] = None) -> None:
+        # The participant list may contain members that aren't in the user list because they
+        # were already synced earlier.
+        allowed_tgids = {participant.user_id for participant in participants or []}
+        entities = []
         skip_deleted = config["bridge.skip_deleted_members"]
         for entity in users:
             if skip_deleted and entity.deleted:
+                allowed_tgids.discard(entity.id)
                 continue
-            puppet = p.Puppet.get(TelegramID(entity.id))
             if entity.bot:
                 self.add_bot_chat(entity)
             allowed_tgids.add(entity.id)
-            await puppet.intent.ensure_joined(self.mxid)
-            await puppet.update_info(source, entity)
-
-            user = u.User.get_by_tgid(TelegramID(entity.id))
-            if user:
-                await self.invite_to_matrix(user.mxid)
+            entities.append(entity)
+        pages, self._pending_participant_pages = self._pending_participant_pages, None
+        tasks = [functools.partial(self._sync_telegram_user, source, entity)
+                 for entity in entities]
+        failed = await util.run_staggered("members", tasks,
+                                          max_concurrent=self.member_sync_concurrency, jitter=0,
+                                          progress_interval=self.member_sync_progress_interval,
+                                          action="sync", logger=self.log)
+        if pages is not None:
+            if failed:
+                # The members on changed pages are only returned again if the pages aren't cached.
+                self.log.debug("Not caching participant list, as some members failed to sync")
+            else:
+                await DBParticipantPage.aio.replace_all(self.tgid, pages)
 
         # We can't trust the member list if any of the following cases is true:
         #  * There are close to 10 000 users, because Telegram might not be sending all members.
@@ -641,8 +723,20 @@ class Portal:
         return False
 
     async def _get_users(self, user: 'AbstractUser',
-                         entity: Union[TypeInputPeer, InputUser, TypeChat, TypeUser]
+                         entity: Union[TypeInputPeer, InputUser, TypeChat, TypeUser],
+                         only_changed: bool = False
                          ) -> Tuple[List[TypeUser], List[TypeParticipant]]:
+        """Get the members of the chat.
+
+        Args:
+            user: The user whose client to use.
+            entity: The chat entity.
+            only_changed: If the full participant list of a channel is cached, only return the
+                users who joined after it was cached. The participant list is always complete.
+
+        Returns:
+            The users to sync and the participants of the chat.
+        """
         if self.peer_type == "chat":
             chat = await user.client(GetFullChatRequest(chat_id=self.tgid))
             return chat.users, chat.full_chat.participants.participants
@@ -659,13 +753,14 @@ class Portal:
                     response = await user.client(GetParticipantsRequest(
                         entity, ChannelParticipantsRecent(), offset=0, limit=limit, hash=0))
                     return response.users, response.participants
-                elif limit > 200 or limit == -1:
+                elif limit == -1:
+                    return await self._get_all_channel_users(user, entity, only_changed)
+                elif limit > 200:
                     users = []  # type: List[TypeUser]
                     participants = []  # type: List[TypeParticipant]
                     offset = 0
-                    remaining_quota = limit if limit > 0 else 1000000
-                    query = (ChannelParticipantsSearch("") if limit == -1
-                             else ChannelParticipantsRecent())
+                    remaining_quota = limit
+                    query = ChannelParticipantsRecent()
                     while True:
                         if remaining_quota <= 0:
                             break
@@ -684,6 +779,50 @@ class Portal:
             return [entity], []
         return [], []
 
+    async def _get_all_channel_users(self, user: 'AbstractUser', entity: TypeInputPeer,
+                                     only_changed: bool
+                                     ) -> Tuple[List[TypeUser], List[TypeParticipant]]:
+        if only_changed:
+            cached_pages = {page.offset: page
+                            for page in await DBParticipantPage.aio.get_all(self.tgid)}
+            known_ids = {participant.user_id for page in cached_pages.values()
+                         for participant in page.deserialize()}
+        else:
+            # The users on pages that haven't changed are needed too, so don't send the hashes.
+            cached_pages = {}  # type: Dict[int, DBParticipantPage]
+            known_ids = set()
+        users = []  # type: List[TypeUser]
+        participants = []  # type: List[TypeParticipant]
+        pages = []  # type: List[DBParticipantPage]
+        offset = changed = 0
+        while True:
+            cached = cached_pages.get(offset)
+            response = await user.client(GetParticipantsRequest(
+                entity, ChannelParticipantsSearch(""), offset=offset, limit=100,
+                hash=cached.hash if cached else 0))
+            if isinstance(response, ChannelParticipantsNotModified):
+                page_participants = cached.deserialize()
+                pages.append(cached)
+            elif not response.participants:
+                break
+            else:
+                changed += 1
+                page_participants = response.participants
+                users += [tg_user for tg_user in response.users if tg_user.id not in known_ids]
+                pages.append(DBParticipantPage(
+                    channel_id=self.tgid, offset=offset,
+                    hash=util.vector_hash(participant.user_id
+                                          for participant in page_participants),
+                    participants=DBParticipantPage.serialize(page_participants)))
+            participants += page_participants
+            offset += len(page_participants)
+        if changed or len(pages) != len(cached_pages):
+            # Saved by sync_telegram_users after the new members have been synced.
+            self._pending_participant_pages = pages
+        self.log.debug(f"Fetched {len(participants)} participants, {changed}/{len(pages)} pages "
+                       f"had changed")
+        return users, participants
+
     async def get_invite_link(self, user: 'u.User') -> str:
         if self.peer_type == "user":
             raise ValueError("You can't invite users to private chats.")
@@ -803,16 +942,16 @@ class Portal:
 
     async def sync_matrix_members(self) -> None:
         resp = await self.main_intent.get_room_joined_memberships(self.mxid)
-        members = resp["joined"]
-        for mxid, info in members.items():
-            member = {
+        members = {}  # type: Dict[MatrixUserID, Dict[str, str]]
+        for mxid, info in resp["joined"].items():
+            member = members[mxid] = {
                 "membership": "join",
             }
             if "display_name" in info:
                 member["displayname"] = info["display_name"]
             if "avatar_url" in info:
                 member["avatar_url"] = info["avatar_url"]
-            self.az.state_store.set_member(self.mxid, mxid, member)
+        self.az.state_store.set_members(self.mxid, members)
 
     def set_typing(self, user: 'u.User', typing: bool = True,
                    action: type = SendMessageTypingAction) -> Awaitable[bool]:
@@ -823,7 +962,7 @@ class Portal:
         if user.is_bot:
             return
         space = self.tgid if self.peer_type == "channel" else user.tgid
-        message = DBMessage.get_by_mxid(event_id, self.mxid, space)
+        message = await DBMessage.aio.get_by_mxid(event_id, self.mxid, space)
         if not message:
             return
         if self.peer_type == "channel":
@@ -958,44 +1097,125 @@ class Portal:
             response = await client.send_message(self.peer, message, reply_to=reply_to,
                                                  parse_mode=self._matrix_event_to_entities,
                                                  link_preview=lp)
-            self._add_telegram_message_to_db(event_id, space, response)
+            await self._add_telegram_message_to_db(event_id, space, response)
+
+    async def _send_uploaded_file(self, upload: DBUploadedFile, sender_id: TelegramID,
+                                  event_id: MatrixEventID, space: TelegramID,
+                                  client: 'MautrixTelegramClient', message: dict,
+                                  reply_to: TelegramID, size: Optional[Tuple[int, int]],
+                                  by_hash: bool = False) -> bool:
+        file_name = self._get_file_meta(message["mxtg_filename"], upload.mime_type)
+        if not util.has_upload_attributes(upload, file_name, size):
+            return False
+        caption = message["body"] if message["body"].lower() != file_name.lower() else None
+        lock = self.require_send_lock(sender_id)
+        try:
+            async with lock:
+                response = await client.send_media(self.peer, util.get_input_media(upload),
+                                                   reply_to=reply_to, caption=caption)
+                await self._add_telegram_message_to_db(event_id, space, response)
+        except RPCError as e:
+            if not util.is_stale_upload_error(e):
+                raise
+            self.log.debug(f"Previously uploaded file {upload.content_hash} can't be reused "
+                           f"({e}), uploading it again")
+            await upload.aio.delete()
+            return False
+        await util.refresh_upload(upload, message["url"] if by_hash else None,
+                                  message["msgtype"], response.media if response else None)
+        return True
+
+    @staticmethod
+    def _get_image_size(info: Dict[str, Any]) -> Optional[Tuple[int, int]]:
+        if info.get("w") and info.get("h"):
+            return info["w"], info["h"]
+        return None
 
     async def _handle_matrix_file(self, msgtype: str, sender_id: TelegramID,
                                   event_id: MatrixEventID, space: TelegramID,
                                   client: 'MautrixTelegramClient', message: dict,
                                   reply_to: TelegramID) -> None:
-        file = await self.main_intent.download_file(message["url"])
-
         info = message.get("info", {})
         mime = info.get("mimetype", None)
 
-        w, h = None, None
+        if msgtype == "m.sticker" and mime == "image/gif":
+            # Remove sticker description
+            message["mxtg_filename"] = "sticker.gif"
+            message["body"] = ""
+
+        upload = await DBUploadedFile.aio.get_by_mxc(sender_id, message["url"], msgtype)
+        if upload:
+            if msgtype == "m.sticker" and mime != "image/gif":
+                # The size comes from converting the sticker, which gives the same result for the
+                # same file.
+                size = (upload.width, upload.height) if upload.width else None
+            else:
+                size = self._get_image_size(info)
+            if await self._send_uploaded_file(upload, sender_id, event_id, space, client,
+                                              message, reply_to, size):
+                return
+
+        start = time.perf_counter()
+        if not self.media_cache:
+            file = await self.main_intent.download_file(message["url"])
+            await self._upload_matrix_file(msgtype, sender_id, event_id, space, client, message,
+                                           reply_to, file, start)
+            return
+        # A path to the cached file, which is hashed and uploaded without reading it all into
+        # memory. It's pinned in the cache until the upload is done.
+        file = await self.media_cache.acquire(self.main_intent, message["url"])
+        try:
+            await self._upload_matrix_file(msgtype, sender_id, event_id, space, client, message,
+                                           reply_to, file, start)
+        finally:
+            self.media_cache.release(message["url"])
+
+    async def _upload_matrix_file(self, msgtype: str, sender_id: TelegramID,
+                                  event_id: MatrixEventID, space: TelegramID,
+                                  client: 'MautrixTelegramClient', message: dict,
+                                  reply_to: TelegramID, file: Union[bytes, str],
+                                  start: float) -> None:
+        info = message.get("info", {})
+        mime = info.get("mimetype", None)
+        size = None  # type: Optional[Tuple[int, int]]
 
         if msgtype == "m.sticker":
             if mime != "image/gif":
-                mime, file, w, h = util.convert_image(file, source_mime=mime, target_type="webp")
-            else:
-                # Remove sticker description
-                message["mxtg_filename"] = "sticker.gif"
-                message["body"] = ""
-        elif "w" in info and "h" in info:
-            w, h = info["w"], info["h"]
+                if isinstance(file, str):
+                    with open(file, "rb") as sticker_file:
+                        file = sticker_file.read()
+                mime, file, w, h = await util.convert_image(file, source_mime=mime,
+                                                            target_type="webp")
+                size = (w, h) if w and h else None
+        else:
+            size = self._get_image_size(info)
+
+        content_hash = await self.loop.run_in_executor(None, util.hash_file, file)
+        upload = await DBUploadedFile.aio.get_by_hash(sender_id, content_hash)
+        if upload and await self._send_uploaded_file(upload, sender_id, event_id, space, client,
+                                                     message, reply_to, size, by_hash=True):
+            return
 
         file_name = self._get_file_meta(message["mxtg_filename"], mime)
         attributes = [DocumentAttributeFilename(file_name=file_name)]
-        if w and h:
-            attributes.append(DocumentAttributeImageSize(w, h))
+        if size:
+            attributes.append(DocumentAttributeImageSize(*size))
 
         caption = message["body"] if message["body"].lower() != file_name.lower() else None
 
         media = await client.upload_file_direct(
             file, mime, attributes, file_name,
             max_image_size=config["bridge.image_as_file_size"] * 1000 ** 2)
+        size = os.path.getsize(file) if isinstance(file, str) else len(file)
+        metrics.observe_file_transfer("matrix_to_telegram", size, time.perf_counter() - start)
         lock = self.require_send_lock(sender_id)
         async with lock:
             response = await client.send_media(self.peer, media, reply_to=reply_to,
                                                caption=caption)
-            self._add_telegram_message_to_db(event_id, space, response)
+            await self._add_telegram_message_to_db(event_id, space, response)
+        if response:
+            await util.store_upload(sender_id, content_hash, message["url"], msgtype, mime,
+                                    response.media, file_name, size)
 
     async def _handle_matrix_location(self, sender_id: TelegramID, event_id: MatrixEventID,
                                       space: TelegramID, client: 'MautrixTelegramClient',
@@ -1013,18 +1233,19 @@ class Portal:
         async with lock:
             response = await client.send_media(self.peer, media, reply_to=reply_to,
                                                caption=caption, entities=entities)
-            self._add_telegram_message_to_db(event_id, space, response)
+            await self._add_telegram_message_to_db(event_id, space, response)
 
-    def _add_telegram_message_to_db(self, event_id: MatrixEventID, space: TelegramID,
-                                    response: TypeMessage) -> None:
+    async def _add_telegram_message_to_db(self, event_id: MatrixEventID, space: TelegramID,
+                                          response: TypeMessage) -> None:
         self.log.debug("Handled Matrix message: %s", response)
         self.is_duplicate(response, (event_id, space))
-        DBMessage(
+        await DBMessage(
             tgid=TelegramID(response.id),
             tg_space=space,
             mx_room=self.mxid,
-            mxid=event_id).insert()
+            mxid=event_id).aio.insert()
 
+    @metrics.timed(metrics.MATRIX_MESSAGE_TIME)
     async def handle_matrix_message(self, sender: 'u.User', message: Dict[str, Any],
                                     event_id: MatrixEventID) -> None:
         if "body" not in message or "msgtype" not in message:
@@ -1041,7 +1262,7 @@ class Portal:
         sender_id = sender.tgid if logged_in else self.bot.tgid
         space = (self.tgid if self.peer_type == "channel"  # Channels have their own ID space
                  else (sender.tgid if logged_in else self.bot.tgid))
-        reply_to = formatter.matrix_reply_to_telegram(message, space, room_id=self.mxid)
+        reply_to = await formatter.matrix_reply_to_telegram(message, space, room_id=self.mxid)
 
         message["mxtg_filename"] = message["body"]
         await self._pre_process_matrix_message(sender, not logged_in, message)
@@ -1073,7 +1294,7 @@ class Portal:
                 await sender.client(UpdatePinnedMessageRequest(peer=self.peer, id=0))
             else:
                 tg_space = self.tgid if self.peer_type == "channel" else sender.tgid
-                message = DBMessage.get_by_mxid(pinned_message, self.mxid, tg_space)
+                message = await DBMessage.aio.get_by_mxid(pinned_message, self.mxid, tg_space)
                 if message is None:
                     self.log.warning(f"Could not find pinned {pinned_message} in {self.mxid}")
                     return
@@ -1084,7 +1305,7 @@ class Portal:
     async def handle_matrix_deletion(self, deleter: 'u.User', event_id: MatrixEventID) -> None:
         real_deleter = deleter if not await deleter.needs_relaybot(self) else self.bot
         space = self.tgid if self.peer_type == "channel" else real_deleter.tgid
-        message = DBMessage.get_by_mxid(event_id, self.mxid, space)
+        message = await DBMessage.aio.get_by_mxid(event_id, self.mxid, space)
         if not message:
             return
         await real_deleter.client.delete_messages(self.peer, [message.tgid])
@@ -1196,7 +1417,7 @@ class Portal:
                 "Failed to fully migrate to upgraded Matrix room: no Telegram user found.")
             return
         users, participants = await self._get_users(self.bot, entity)
-        await self.sync_telegram_users(user, users)
+        await self.sync_telegram_users(user, users, participants)
         levels = await self.main_intent.get_power_levels(self.mxid)
         await self.update_telegram_participants(participants, levels)
         self.log.info(f"Upgraded room from {old_room} to {self.mxid}")
@@ -1306,7 +1527,17 @@ class Portal:
 
     async def handle_telegram_typing(self, user: p.Puppet,
                                      _: Union[UpdateUserTyping, UpdateChatUserTyping]) -> None:
-        await user.intent.set_typing(self.mxid, is_typing=True)
+        intent = user.intent
+        u.User.ephemeral.set(("typing", self.mxid, intent.mxid), True,
+                             lambda: intent.set_typing(self.mxid, is_typing=True,
+                                                       timeout=TYPING_TIMEOUT, ignore_cache=True),
+                             refresh=TYPING_REFRESH)
+
+    async def _stop_typing(self, intent: IntentAPI) -> None:
+        # Also drops a queued typing notification, so that it isn't sent after the message.
+        await u.User.ephemeral.set_now(("typing", self.mxid, intent.mxid), False,
+                                       lambda: intent.set_typing(self.mxid, is_typing=False),
+                                       default=False)
 
     def get_external_url(self, evt: Message) -> Optional[str]:
         if self.peer_type == "channel" and self.username is not None:
@@ -1316,7 +1547,8 @@ class Portal:
     async def handle_telegram_photo(self, source: 'AbstractUser', intent: IntentAPI, evt: Message,
                                     relates_to: Dict = None) -> Optional[Dict]:
         largest_size = self._get_largest_photo_size(evt.media.photo)
-        file = await util.transfer_file_to_matrix(source.client, intent, largest_size.location)
+        file = await util.transfer_file_to_matrix(source.client, intent, largest_size.location,
+                                                  file_size=getattr(largest_size, "size", None))
         if not file:
             return None
         if self.get_config("inline_images") and (evt.message
@@ -1325,7 +1557,7 @@ class Portal:
                 evt, source, self.main_intent,
                 prefix_html=f"<img src='{file.mxc}' alt='Inline Telegram photo'/><br/>",
                 prefix_text="Inline image: ")
-            await intent.set_typing(self.mxid, is_typing=False)
+            await self._stop_typing(intent)
             return await intent.send_text(self.mxid, text, html=html, relates_to=relates_to,
                                           timestamp=evt.date,
                                           external_url=self.get_external_url(evt))
@@ -1341,7 +1573,7 @@ class Portal:
             "image/jpeg": ".jpg"
         }
         name = "image" + ext_override.get(file.mime_type, mimetypes.guess_extension(file.mime_type))
-        await intent.set_typing(self.mxid, is_typing=False)
+        await self._stop_typing(intent)
         result = await intent.send_image(self.mxid, file.mxc, info=info, text=name,
                                          relates_to=relates_to, timestamp=evt.date,
                                          external_url=self.get_external_url(evt))
@@ -1426,7 +1658,7 @@ class Portal:
 
         info, name = self._parse_telegram_document_meta(evt, file, attrs, thumb)
 
-        await intent.set_typing(self.mxid, is_typing=False)
+        await self._stop_typing(intent)
 
         kwargs = {
             "room_id": self.mxid,
@@ -1484,7 +1716,7 @@ class Portal:
                                    evt: Message) -> dict:
         self.log.debug(f"Sending {evt.message} to {self.mxid} by {intent.mxid}")
         text, html, relates_to = await formatter.telegram_to_matrix(evt, source, self.main_intent)
-        await intent.set_typing(self.mxid, is_typing=False)
+        await self._stop_typing(intent)
         msgtype = "m.notice" if is_bot and self.get_config("bot_messages_as_notices") else "m.text"
         return await intent.send_text(self.mxid, text, html=html, relates_to=relates_to,
                                       msgtype=msgtype, timestamp=evt.date,
@@ -1497,7 +1729,7 @@ class Portal:
                          "bridge administrator about possible updates.")
         text, html, relates_to = await formatter.telegram_to_matrix(
             evt, source, self.main_intent, override_text=override_text)
-        await intent.set_typing(self.mxid, is_typing=False)
+        await self._stop_typing(intent)
         return await intent.send_message(self.mxid, {
             "body": text,
             "msgtype": "m.notice",
@@ -1530,7 +1762,7 @@ class Portal:
                             for answer in poll.answers) +
                 "</ol>\n"
                 f"Vote with <code>!tg vote {poll_id} &lt;choice number&gt;</code>")
-        await intent.set_typing(self.mxid, is_typing=False)
+        await self._stop_typing(intent)
         return await intent.send_text(self.mxid, text, html=html, relates_to=relates_to,
                                       msgtype="m.text", timestamp=evt.date,
                                       external_url=self.get_external_url(evt))
@@ -1568,7 +1800,7 @@ class Portal:
         text, html, relates_to = await formatter.telegram_to_matrix(
             evt, source, self.main_intent,
             override_text=override_text, override_entities=override_entities)
-        await intent.set_typing(self.mxid, is_typing=False)
+        await self._stop_typing(intent)
         return await intent.send_message(self.mxid, {
             "body": text,
             "msgtype": "m.notice",
@@ -1598,34 +1830,46 @@ class Portal:
 
         temporary_identifier = MatrixEventID(
             f"${random.randint(1000000000000, 9999999999999)}TGBRIDGEDITEMP")
-        duplicate_found = self.is_duplicate(evt, (temporary_identifier, tg_space), force_hash=True)
+        duplicate_found = self.is_duplicate(evt, (temporary_identifier, tg_space), force_hash=True,
+                                            persist=False)
         if duplicate_found:
             mxid, other_tg_space = duplicate_found
             if tg_space != other_tg_space:
-                DBMessage.update_by_tgid(TelegramID(evt.id), tg_space,
-                                         mxid=mxid,
-                                         mx_room=self.mxid)
+                await DBMessage.aio.update_by_tgid(TelegramID(evt.id), tg_space,
+                                                   mxid=mxid,
+                                                   mx_room=self.mxid)
+            return
+        edit_key = self._edit_dedup_key(evt)
+        if not await self.claim_shared(edit_key):
+            self.log.debug(f"Ignoring edit of {evt.id}@{tg_space} (src {source.tgid}) "
+                           "as it was already claimed by another shard")
+            asyncio.ensure_future(self._map_claimed_message(edit_key, evt, tg_space,
+                                                            temporary_identifier, edit=True),
+                                  loop=self.loop)
             return
 
         evt.reply_to_msg_id = evt.id
         text, html, relates_to = await formatter.telegram_to_matrix(evt, source, self.main_intent,
                                                                     is_edit=True)
         intent = sender.intent if sender else self.main_intent
-        await intent.set_typing(self.mxid, is_typing=False)
+        await self._stop_typing(intent)
         response = await intent.send_text(self.mxid, text, html=html, relates_to=relates_to,
                                           external_url=self.get_external_url(evt))
 
         mxid = response["event_id"]
+        if self.dedup_shared:
+            await DBDedupClaim.aio.store(*edit_key, mxid, tg_space)
 
-        msg = DBMessage.get_by_tgid(TelegramID(evt.id), tg_space)
+        msg = await DBMessage.aio.get_by_tgid(TelegramID(evt.id), tg_space)
         if not msg:
             self.log.info(f"Didn't find edited message {evt.id}@{tg_space} (src {source.tgid}) "
                           "in database.")
             # Oh crap
             return
-        msg.update(mxid=mxid, mx_room=self.mxid)
-        DBMessage.update_by_mxid(temporary_identifier, self.mxid, mxid=mxid)
+        await msg.aio.update(mxid=mxid, mx_room=self.mxid)
+        await DBMessage.aio.update_by_mxid(temporary_identifier, self.mxid, mxid=mxid)
 
+    @metrics.timed(metrics.TELEGRAM_MESSAGE_TIME)
     async def handle_telegram_message(self, source: 'AbstractUser', sender: p.Puppet,
                                       evt: Message) -> None:
         if not self.mxid:
@@ -1640,23 +1884,32 @@ class Portal:
 
         temporary_identifier = MatrixEventID(
             f"${random.randint(1000000000000, 9999999999999)}TGBRIDGETEMP")
-        duplicate_found = self.is_duplicate(evt, (temporary_identifier, tg_space))
+        duplicate_found = self.is_duplicate(evt, (temporary_identifier, tg_space), persist=False)
         if duplicate_found:
             mxid, other_tg_space = duplicate_found
             self.log.debug(f"Ignoring message {evt.id}@{tg_space} (src {source.tgid}) "
                            f"as it was already handled (in space {other_tg_space})")
             if tg_space != other_tg_space:
-                DBMessage(tgid=TelegramID(evt.id), mx_room=self.mxid, mxid=mxid,
-                          tg_space=tg_space).insert()
+                await DBMessage(tgid=TelegramID(evt.id), mx_room=self.mxid, mxid=mxid,
+                                tg_space=tg_space).aio.insert()
+            return
+
+        # Other bridge processes may have received the same message from their users.
+        if not await self.claim_shared(self._dedup_key(evt)):
+            self.log.debug(f"Ignoring message {evt.id}@{tg_space} (src {source.tgid}) "
+                           "as it was already claimed by another shard")
+            asyncio.ensure_future(self._map_claimed_message(self._dedup_key(evt), evt, tg_space,
+                                                            temporary_identifier),
+                                  loop=self.loop)
             return
 
         if self.dedup_pre_db_check and self.peer_type == "channel":
-            msg = DBMessage.get_by_tgid(TelegramID(evt.id), tg_space)
+            msg = await DBMessage.aio.get_by_tgid(TelegramID(evt.id), tg_space)
             if msg:
                 self.log.debug(f"Ignoring message {evt.id} (src {source.tgid}) as it was already"
                                f"handled into {msg.mxid}. This duplicate was catched in the db "
                                "check. If you get this message often, consider increasing"
-                               "bridge.deduplication.cache_queue_length in the config.")
+                               "bridge.deduplication.max_entries in the config.")
                 return
 
         if sender and not sender.displayname:
@@ -1682,7 +1935,7 @@ class Portal:
                 MessageMediaUnsupported: self.handle_telegram_unsupported,
                 MessageMediaGame: self.handle_telegram_game,
             }[type(media)](source, intent, evt,
-                           relates_to=formatter.telegram_reply_to_matrix(evt, source))
+                           relates_to=await formatter.telegram_reply_to_matrix(evt, source))
         else:
             self.log.debug("Unhandled Telegram message: %s", evt)
             return
@@ -1705,13 +1958,13 @@ class Portal:
 
         self.log.debug("Handled Telegram message: %s", evt)
         try:
-            DBMessage(tgid=TelegramID(evt.id), mx_room=self.mxid, mxid=mxid,
-                      tg_space=tg_space).insert()
-            DBMessage.update_by_mxid(temporary_identifier, self.mxid, mxid=mxid)
+            await DBMessage(tgid=TelegramID(evt.id), mx_room=self.mxid, mxid=mxid,
+                            tg_space=tg_space).aio.insert()
+            await DBMessage.aio.update_by_mxid(temporary_identifier, self.mxid, mxid=mxid)
         except IntegrityError as e:
             self.log.exception(f"{e.__class__.__name__} while saving message mapping. "
                                "This might mean that an update was handled after it left the "
-                               "dedup cache queue. You can try enabling bridge.deduplication."
+                               "dedup cache. You can try enabling bridge.deduplication."
                                "pre_db_check in the config.")
             await intent.redact(self.mxid, mxid)
 
@@ -1732,9 +1985,14 @@ class Portal:
                                      update: MessageService) -> None:
         action = update.action
         should_ignore = ((not self.mxid and not await self._create_room_on_action(source, action))
-                         or self.is_duplicate_action(update))
+                         # The shared claim is persisted instead of the local entry.
+                         or self.is_duplicate_action(update, persist=not self.dedup_shared))
         if should_ignore or not self.mxid:
             return
+        elif not await self.claim_shared(self._action_dedup_key(update)):
+            self.log.debug(f"Ignoring action {update.id} (src {source.tgid}) "
+                           "as it was already claimed by another shard")
+            return
         # TODO figure out how to see changes to about text / channel username
         if isinstance(action, MessageActionChatEditTitle):
             await self.update_title(action.title, save=True)
@@ -1785,7 +2043,7 @@ class Portal:
         self._temp_pinned_message_id = None
         self._temp_pinned_message_sender = None
 
-        message = DBMessage.get_by_tgid(msg_id, self._temp_pinned_message_id_space)
+        message = await DBMessage.aio.get_by_tgid(msg_id, self._temp_pinned_message_id_space)
         if message:
             await intent.set_pinned_messages(self.mxid, [message.mxid])
         else:
@@ -1908,10 +2166,13 @@ class Portal:
         except KeyError:
             pass
         self.db_instance.update(tgid=new_id, tg_receiver=new_id)
-        old_id = self.tgid
+        old_id, old_tgid_full = self.tgid, self.tgid_full
         self.tgid = new_id
         self.tg_receiver = new_id
         self.by_tgid[self.tgid_full] = self
+        self.shards.invalidate("portal", *old_tgid_full)
+        self.shards.invalidate("portal", *self.tgid_full)
+        u.User.portal_moved(old_tgid_full, self.tgid_full)
         self.log = self.base_log.getChild(str(self.tgid))
         self.log.info(f"Telegram chat upgraded from {old_id}")
 
@@ -1923,11 +2184,67 @@ class Portal:
         self.mxid = new_id
         self.db_instance.update(mxid=self.mxid)
         self.by_mxid[self.mxid] = self
+        self.shards.invalidate("portal", *self.tgid_full)
 
     def save(self) -> None:
-        self.db_instance.update(mxid=self.mxid, username=self.username, title=self.title,
-                                about=self.about, photo_id=self.photo_id,
-                                config=json.dumps(self.local_config))
+        values = dict(username=self.username, title=self.title, about=self.about,
+                      photo_id=self.photo_id, config=json.dumps(self.local_config))
+        if self.mxid:
+            # A portal that was loaded before another shard created the room must not unset it.
+            values["mxid"] = self.mxid
+        self.db_instance.update(**values)
+        self.shards.invalidate("portal", *self.tgid_full)
+
+    async def reload(self) -> bool:
+        """Reload the fields that other shards may have changed from the database.
+
+        Returns:
+            ``False`` if the portal has been deleted from the database, ``True`` otherwise.
+        """
+        self._loaded_at = time.monotonic()
+        db_portal = await DBPortal.aio.get_by_tgid(self.tgid, self.tg_receiver)
+        if not db_portal:
+            self._uncache()
+            self.deleted = True
+            return False
+        if db_portal.mxid != self.mxid:
+            if self.mxid:
+                self.by_mxid.discard(self.mxid, self)
+            self.mxid = db_portal.mxid
+            if self.mxid:
+                self.by_mxid[self.mxid] = self
+        self.username = db_portal.username
+        self.megagroup = db_portal.megagroup
+        self.title = db_portal.title
+        self.about = db_portal.about
+        self.photo_id = db_portal.photo_id
+        self.local_config = json.loads(db_portal.config or "{}")
+        self._db_instance = db_portal
+        return True
+
+    def _reload_if_stale(self) -> None:
+        # Lookups are synchronous, so the reload is done in the background. Room creation
+        # reloads the portal before creating a room, so it doesn't depend on this.
+        if (self.shards.enabled and not self._room_create_lock.locked()
+                and self.shards.is_stale(self._loaded_at)):
+            self._loaded_at = time.monotonic()
+            asyncio.ensure_future(self._reload_in_background(), loop=self.loop)
+
+    async def _reload_in_background(self) -> None:
+        try:
+            await self.reload()
+        except Exception:
+            self.log.exception("Failed to reload portal")
+
+    @classmethod
+    async def reload_cached(cls, tgid: TelegramID, tg_receiver: TelegramID) -> None:
+        """Reload a cached portal after another shard changed it."""
+        try:
+            portal = cls.by_tgid[(tgid, tg_receiver)]
+        except KeyError:
+            return
+        if not portal._room_create_lock.locked():
+            await portal.reload()
 
     def delete(self) -> None:
         try:
@@ -1940,6 +2257,8 @@ class Portal:
             pass
         if self._db_instance:
             self._db_instance.delete()
+        self.shards.invalidate("portal", *self.tgid_full)
+        u.User.portal_moved(self.tgid_full, None)
         self.deleted = True
 
     @classmethod
@@ -1956,7 +2275,9 @@ class Portal:
     @classmethod
     def get_by_mxid(cls, mxid: MatrixRoomID) -> Optional['Portal']:
         try:
-            return cls.by_mxid[mxid]
+            portal = cls.by_mxid[mxid]
+            portal._reload_if_stale()
+            return portal
         except KeyError:
             pass
 
@@ -1994,7 +2315,9 @@ class Portal:
         tg_receiver = tg_receiver or tgid
         tgid_full = (tgid, tg_receiver)
         try:
-            return cls.by_tgid[tgid_full]
+            portal = cls.by_tgid[tgid_full]
+            portal._reload_if_stale()
+            return portal
         except KeyError:
             pass
 
@@ -2004,7 +2327,12 @@ class Portal:
 
         if peer_type:
             portal = Portal(tgid, peer_type=peer_type, tg_receiver=tg_receiver)
-            portal.db_instance.insert()
+            try:
+                portal.db_instance.insert()
+            except IntegrityError:
+                # Another shard created the portal at the same time.
+                portal._uncache()
+                return cls.from_db(DBPortal.get_by_tgid(tgid, tg_receiver))
             return portal
 
         return None
@@ -2046,14 +2374,38 @@ def init(context: Context) -> None:
     global config
     Portal.az, config, Portal.loop, Portal.bot = context.core
     Portal.max_initial_member_sync = config["bridge.max_initial_member_sync"]
+    for cache in (Portal.by_tgid, Portal.by_mxid):
+        cache.max_size = config["appservice.instance_cache.portals"] or 0
+        cache.is_pinned = lambda portal: portal.is_busy
+        cache.on_evict = Portal._uncache
     Portal.sync_channel_members = config["bridge.sync_channel_members"]
     Portal.sync_matrix_state = config["bridge.sync_matrix_state"]
+    Portal.member_sync_concurrency = max(config["bridge.member_sync_concurrency"] or 1, 1)
     Portal.public_portals = config["bridge.public_portals"]
     Portal.filter_mode = config["bridge.filter.mode"]
     Portal.filter_list = config["bridge.filter.list"]
     Portal.dedup_pre_db_check = config["bridge.deduplication.pre_db_check"]
-    Portal.dedup_cache_queue_length = config["bridge.deduplication.cache_queue_length"]
+    # Shards that lose a claim read the event ID that the winner persisted.
+    Portal.dedup = util.DedupStore(max_entries=config["bridge.deduplication.max_entries"],
+                                   max_age=config["bridge.deduplication.max_age"],
+                                   persist=(config["bridge.deduplication.persist"]
+                                            or context.shards.enabled),
+                                   loop=context.loop)
+    if Portal.dedup.persist:
+        Portal.dedup.load()
+    Portal.dedup_shared = context.shards.enabled
+    Portal.shards = context.shards
+    context.shards.reloaders["portal"] = Portal.reload_cached
     Portal.alias_template = config.get("bridge.alias_template", "telegram_{groupname}")
     Portal.hs_domain = config["homeserver.domain"]
+    media_cache_path = config["bridge.media_cache.path"]
+    if media_cache_path:
+        media_cache_size = config["bridge.media_cache.max_size"] * 1024 ** 2
+        if context.shards.enabled:
+            # Each process keeps track of the size of its own part of the cache.
+            media_cache_path = os.path.join(media_cache_path, f"shard-{context.shards.index}")
+            media_cache_size //= context.shards.count
+        Portal.media_cache = util.MediaCache(media_cache_path, media_cache_size,
+                                             loop=context.loop)
     Portal.mx_alias_regex = re.compile(
         f"#{Portal.alias_template.format(groupname='(.+)')}:{Portal.hs_domain}")
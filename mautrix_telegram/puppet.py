@@ -14,26 +14,31 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
-from typing import Awaitable, Any, Dict, List, Iterable, Optional, Pattern, Union, TYPE_CHECKING
+from typing import Awaitable, Dict, List, Iterable, Optional, Pattern, Union, TYPE_CHECKING
 from difflib import SequenceMatcher
 from enum import Enum
 from aiohttp import ServerDisconnectedError
 import asyncio
+import hashlib
 import logging
+import time
 import re
 
+from sqlalchemy.exc import IntegrityError
+
 from telethon.tl.types import UserProfilePhoto, User, FileLocation, UpdateUserName, PeerUser
 from mautrix_appservice import AppService, IntentAPI, IntentError, MatrixRequestError
 
 from .types import MatrixUserID, TelegramID
 from .db import Puppet as DBPuppet
-from . import util
+from . import metrics, util
 
 if TYPE_CHECKING:
     from .matrix import MatrixHandler
     from .config import Config
     from .context import Context
     from .abstract_user import AbstractUser
+    from .sharding import ShardRouter
 
 PuppetError = Enum('PuppetError', 'Success OnlyLoginSelf InvalidAccessToken')
 
@@ -41,14 +46,21 @@ config = None  # type: Config
 
 
 class Puppet:
+    # Puppets of every Telegram user the bridge has seen are kept in memory, so they don't have an
+    # attribute dict. Any new instance attributes must be added here.
+    __slots__ = ("id", "access_token", "custom_mxid", "default_mxid", "username", "displayname",
+                 "displayname_source", "photo_id", "name_hash", "is_bot", "is_registered",
+                 "default_mxid_intent", "intent", "sync_task", "_loaded_at")
+
     log = logging.getLogger("mau.puppet")  # type: logging.Logger
     az = None  # type: AppService
     mx = None  # type: MatrixHandler
     loop = None  # type: asyncio.AbstractEventLoop
+    shards = None  # type: ShardRouter
     mxid_regex = None  # type: Pattern
     username_template = None  # type: str
     hs_domain = None  # type: str
-    cache = {}  # type: Dict[TelegramID, Puppet]
+    cache = util.InstanceCache("puppets")  # type: Dict[TelegramID, Puppet]
     by_custom_mxid = {}  # type: Dict[str, Puppet]
 
     def __init__(self,
@@ -61,7 +73,7 @@ class Puppet:
                  photo_id: Optional[str] = None,
                  is_bot: bool = False,
                  is_registered: bool = False,
-                 db_instance: Optional[DBPuppet] = None) -> None:
+                 name_hash: Optional[str] = None) -> None:
         self.id = id  # type: TelegramID
         self.access_token = access_token  # type: Optional[str]
         self.custom_mxid = custom_mxid  # type: Optional[MatrixUserID]
@@ -71,13 +83,14 @@ class Puppet:
         self.displayname = displayname  # type: Optional[str]
         self.displayname_source = displayname_source  # type: Optional[TelegramID]
         self.photo_id = photo_id  # type: Optional[str]
+        self.name_hash = name_hash  # type: Optional[str]
         self.is_bot = is_bot  # type: bool
         self.is_registered = is_registered  # type: bool
-        self._db_instance = db_instance  # type: Optional[DBPuppet]
 
         self.default_mxid_intent = self.az.intent.user(self.default_mxid)
         self.intent = self._fresh_intent()  # type: IntentAPI
         self.sync_task = None  # type: Optional[asyncio.Future]
+        self._loaded_at = time.monotonic()  # type: float
 
         self.cache[id] = self
         if self.custom_mxid:
@@ -91,6 +104,11 @@ class Puppet:
     def tgid(self) -> TelegramID:
         return self.id
 
+    def _uncache(self) -> None:
+        self.cache.discard(self.id, self)
+        # The appservice API keeps a child HTTP API object for every user ID it has been used with.
+        self.az.intent.client.children.pop(self.default_mxid, None)
+
     @property
     def is_real_user(self) -> bool:
         """ Is True when the puppet is a real Matrix user. """
@@ -134,7 +152,7 @@ class Puppet:
         if self.mxid != self.default_mxid:
             self.by_custom_mxid[self.mxid] = self
             await self.leave_rooms_with_default_user()
-        self.save()
+        self.save(custom_mxid=True)
         return PuppetError.Success
 
     async def init_custom_mxid(self) -> PuppetError:
@@ -273,28 +291,71 @@ class Puppet:
 
     @property
     def db_instance(self) -> DBPuppet:
-        if not self._db_instance:
-            self._db_instance = self.new_db_instance()
-        return self._db_instance
+        # The row object isn't stored, as it would double the memory used by each cached puppet.
+        return self.new_db_instance()
 
     def new_db_instance(self) -> DBPuppet:
         return DBPuppet(id=self.id, access_token=self.access_token, custom_mxid=self.custom_mxid,
                         username=self.username, displayname=self.displayname,
                         displayname_source=self.displayname_source, photo_id=self.photo_id,
-                        is_bot=self.is_bot, matrix_registered=self.is_registered)
+                        name_hash=self.name_hash, is_bot=self.is_bot,
+                        matrix_registered=self.is_registered)
 
     @classmethod
     def from_db(cls, db_puppet: DBPuppet) -> 'Puppet':
         return Puppet(db_puppet.id, db_puppet.access_token, db_puppet.custom_mxid,
                       db_puppet.username, db_puppet.displayname, db_puppet.displayname_source,
                       db_puppet.photo_id, db_puppet.is_bot, db_puppet.matrix_registered,
-                      db_instance=db_puppet)
+                      db_puppet.name_hash)
+
+    def save(self, custom_mxid: bool = False) -> None:
+        values = dict(username=self.username, displayname=self.displayname,
+                      displayname_source=self.displayname_source, photo_id=self.photo_id,
+                      name_hash=self.name_hash, is_bot=self.is_bot,
+                      matrix_registered=self.is_registered)
+        if custom_mxid or not self.shards.enabled:
+            # The custom puppet is only changed by the shard that runs it, so the other shards
+            # must not overwrite it with their possibly outdated copy.
+            values.update(access_token=self.access_token, custom_mxid=self.custom_mxid)
+        self.db_instance.update(**values)
+        self.shards.invalidate("puppet", self.id)
+
+    async def reload(self) -> None:
+        """Reload the puppet from the database, as other shards may have changed it."""
+        self._loaded_at = time.monotonic()
+        db_puppet = await DBPuppet.aio.get_by_tgid(self.id)
+        if not db_puppet:
+            return
+        if db_puppet.custom_mxid != self.custom_mxid and not self.sync_task:
+            if self.by_custom_mxid.get(self.custom_mxid) is self:
+                del self.by_custom_mxid[self.custom_mxid]
+            self.custom_mxid = db_puppet.custom_mxid
+            self.access_token = db_puppet.access_token
+            self.intent = self._fresh_intent()
+            if self.custom_mxid:
+                self.by_custom_mxid[self.custom_mxid] = self
+        self.username = db_puppet.username
+        self.displayname = db_puppet.displayname
+        self.displayname_source = db_puppet.displayname_source
+        self.photo_id = db_puppet.photo_id
+        self.name_hash = db_puppet.name_hash
+        self.is_bot = db_puppet.is_bot
+        self.is_registered = db_puppet.matrix_registered
+
+    async def _reload_in_background(self) -> None:
+        try:
+            await self.reload()
+        except Exception:
+            self.log.exception(f"Failed to reload puppet {self.id}")
 
-    def save(self) -> None:
-        self.db_instance.update(access_token=self.access_token, custom_mxid=self.custom_mxid,
-                                username=self.username, displayname=self.displayname,
-                                displayname_source=self.displayname_source, photo_id=self.photo_id,
-                                is_bot=self.is_bot, matrix_registered=self.is_registered)
+    @classmethod
+    async def reload_cached(cls, tgid: TelegramID) -> None:
+        """Reload a cached puppet after another shard changed it."""
+        try:
+            puppet = cls.cache[tgid]
+        except KeyError:
+            return
+        await puppet.reload()
 
     # endregion
     # region Info updating
@@ -334,6 +395,10 @@ class Puppet:
             displayname=name)
 
     async def update_info(self, source: 'AbstractUser', info: User) -> None:
+        if self.shards.enabled:
+            # The displayname and avatar are skipped if they haven't changed since the last
+            # update, which may have been done by another shard.
+            await self.reload()
         changed = False
         if self.username != info.username:
             self.username = info.username
@@ -348,6 +413,28 @@ class Puppet:
         if changed:
             self.save()
 
+    @staticmethod
+    def get_name_hash(info: Union[User, UpdateUserName]) -> Optional[str]:
+        """Get a hash of everything that the displayname is generated from.
+
+        Returns:
+            The hash, or ``None`` if the info doesn't include everything (name updates don't have
+            the phone number).
+        """
+        preferences = config["bridge.displayname_preference"]
+        uses_phone = "phone number" in preferences
+        if isinstance(info, UpdateUserName):
+            if uses_phone:
+                return None
+            phone, deleted = None, False
+        else:
+            phone = info.phone if uses_phone else None
+            deleted = bool(isinstance(info, User) and info.deleted)
+        inputs = (config["bridge.displayname_template"], ",".join(preferences),
+                  info.first_name, info.last_name, info.username, phone, deleted)
+        data = "\0".join("" if value is None else str(value) for value in inputs)
+        return hashlib.blake2b(data.encode("utf-8"), digest_size=8).hexdigest()
+
     async def update_displayname(self, source: 'AbstractUser', info: Union[User, UpdateUserName]
                                  ) -> bool:
         ignore_source = (not source.is_relaybot
@@ -355,19 +442,30 @@ class Puppet:
                          and self.displayname_source != source.tgid)
         if ignore_source:
             return False
+        name_hash = self.get_name_hash(info)
+        if name_hash and name_hash == self.name_hash and self.displayname_source == source.tgid:
+            metrics.count_profile_update("displayname", applied=False)
+            return False
         if isinstance(info, UpdateUserName):
             info = await source.client.get_entity(PeerUser(self.tgid))
+            name_hash = self.get_name_hash(info)
 
+        changed = name_hash != self.name_hash
         displayname = self.get_displayname(info)
         if displayname != self.displayname:
             await self.default_mxid_intent.set_display_name(displayname)
+            metrics.count_profile_update("displayname", applied=True)
             self.displayname = displayname
             self.displayname_source = source.tgid
+            # Only stored once the displayname has been set, so that a failed update is retried.
+            self.name_hash = name_hash
             return True
-        elif source.is_relaybot or self.displayname_source is None:
+        self.name_hash = name_hash
+        metrics.count_profile_update("displayname", applied=False)
+        if source.is_relaybot or self.displayname_source is None:
             self.displayname_source = source.tgid
             return True
-        return False
+        return changed
 
     async def update_avatar(self, source: 'AbstractUser', photo: FileLocation) -> bool:
         photo_id = f"{photo.volume_id}-{photo.local_id}"
@@ -376,8 +474,11 @@ class Puppet:
                                                       photo)
             if file:
                 await self.default_mxid_intent.set_avatar(file.mxc)
+                metrics.count_profile_update("avatar", applied=True)
                 self.photo_id = photo_id
                 return True
+        else:
+            metrics.count_profile_update("avatar", applied=False)
         return False
 
     # endregion
@@ -386,7 +487,12 @@ class Puppet:
     @classmethod
     def get(cls, tgid: TelegramID, create: bool = True) -> Optional['Puppet']:
         try:
-            return cls.cache[tgid]
+            puppet = cls.cache[tgid]
+            if cls.shards.is_stale(puppet._loaded_at):
+                # Lookups are synchronous, so the reload is done in the background.
+                puppet._loaded_at = time.monotonic()
+                asyncio.ensure_future(puppet._reload_in_background(), loop=cls.loop)
+            return puppet
         except KeyError:
             pass
 
@@ -396,7 +502,12 @@ class Puppet:
 
         if create:
             puppet = cls(tgid)
-            puppet.db_instance.insert()
+            try:
+                puppet.db_instance.insert()
+            except IntegrityError:
+                # Another shard created the puppet at the same time.
+                puppet._uncache()
+                return cls.from_db(DBPuppet.get_by_tgid(tgid))
             return puppet
 
         return None
@@ -476,12 +587,22 @@ class Puppet:
     # endregion
 
 
-def init(context: 'Context') -> List[Awaitable[Any]]:  # [None, None, PuppetError]
+def init(context: 'Context') -> List[Awaitable[None]]:
     global config
     Puppet.az, config, Puppet.loop, _ = context.core
     Puppet.mx = context.mx
+    Puppet.shards = context.shards
+    context.shards.reloaders["puppet"] = Puppet.reload_cached
     Puppet.username_template = config.get("bridge.username_template", "telegram_{userid}")
     Puppet.hs_domain = config["homeserver"]["domain"]
+    Puppet.cache.max_size = config["appservice.instance_cache.puppets"] or 0
+    # Custom puppets have a syncer running and are also in by_custom_mxid.
+    Puppet.cache.is_pinned = lambda puppet: bool(puppet.custom_mxid)
+    Puppet.cache.on_evict = Puppet._uncache
     Puppet.mxid_regex = re.compile(
         f"@{Puppet.username_template.format(userid='([0-9]+)')}:{Puppet.hs_domain}")
-    return [puppet.init_custom_mxid() for puppet in Puppet.all_with_custom_mxid()]
+    puppets = [puppet for puppet in Puppet.all_with_custom_mxid()
+               if context.shards.owns(puppet.custom_mxid)]
+    return [util.run_staggered("custom puppets", [puppet.init_custom_mxid for puppet in puppets],
+                               max_concurrent=config.get("bridge.startup.max_concurrent", 10),
+                               jitter=config.get("bridge.startup.jitter", 0.5))]
@@ -0,0 +1,178 @@
+# -*- coding: future_fstrings -*-
+# mautrix-telegram - A Matrix-Telegram puppeting bridge
+# Copyright (C) 2019 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""Check that the database queries of the bridge use indexes.
+
+Every query method of the models is called with placeholder values while the statements are
+rewritten to ``EXPLAIN`` statements, so nothing is actually read or written. The query plans are
+printed, and queries that scan a whole table when they shouldn't are marked. The exit status is 1
+if any such query is found.
+"""
+from typing import Any, Callable, List, Tuple
+import argparse
+import re
+import sys
+
+from sqlalchemy import event
+import sqlalchemy as sql
+
+from mautrix_telegram.config import Config
+from mautrix_telegram.db import (Base, BotChat, DedupClaim, Message, ParticipantPage, Portal,
+                                 Puppet, RoomState, TelegramFile, UploadedFile, UploadedFileMXC,
+                                 User, UserProfile, init as init_db)
+
+parser = argparse.ArgumentParser(description="mautrix-telegram database query plan checker",
+                                 prog="python -m mautrix_telegram.scripts.explain")
+parser.add_argument("-c", "--config", type=str, default="config.yaml",
+                    metavar="<path>", help="the path to your mautrix-telegram config file")
+parser.add_argument("-d", "--database", type=str, metavar="<url>",
+                    help="the database URL, if it's not the one in the config")
+parser.add_argument("-v", "--verbose", action="store_true",
+                    help="print the query plans of all queries instead of only the bad ones")
+args = parser.parse_args()
+
+ROOM = "!explain:example.com"
+USER = "@explain:example.com"
+EVENT = "$explain"
+
+# Query name, function and whether scanning the whole table is expected.
+Query = Tuple[str, Callable[[], Any], bool]
+
+
+def queries() -> List[Query]:
+    message = Message(mxid=EVENT, mx_room=ROOM, tgid=1, tg_space=1)
+    user = User(mxid=USER, tgid=1)
+    profile = UserProfile(room_id=ROOM, user_id=USER, membership="join")
+    return [
+        ("Message.get_by_tgid", lambda: Message.get_by_tgid(1, 1), False),
+        ("Message.get_by_mxid", lambda: Message.get_by_mxid(EVENT, ROOM, 1), False),
+        ("Message.get_many_by_tgid", lambda: Message.get_many_by_tgid([1, 2], 1), False),
+        ("Message.count_spaces_by_mxid", lambda: Message.count_spaces_by_mxid(EVENT, ROOM), False),
+        ("Message.count_spaces_by_mxids",
+         lambda: Message.count_spaces_by_mxids([(EVENT, ROOM)]), False),
+        ("Message.update_by_tgid", lambda: Message.update_by_tgid(1, 1, mxid=EVENT), False),
+        ("Message.update_by_mxid", lambda: Message.update_by_mxid(EVENT, ROOM, mxid=EVENT),
+         False),
+        ("Message.delete", message.delete, False),
+        ("Message.delete_many", lambda: Message.delete_many([message]), False),
+        ("Portal.get_by_tgid", lambda: Portal.get_by_tgid(1, 1), False),
+        ("Portal.get_by_mxid", lambda: Portal.get_by_mxid(ROOM), False),
+        ("Portal.get_by_username", lambda: Portal.get_by_username("explain"), False),
+        ("Portal.claim_mxid", lambda: Portal(tgid=1, tg_receiver=1).claim_mxid(ROOM), False),
+        ("Portal.delete", Portal(tgid=1, tg_receiver=1).delete, False),
+        # Only used at startup, and most databases won't use an index for IS NOT NULL anyway.
+        ("Puppet.all_with_custom_mxid", lambda: list(Puppet.all_with_custom_mxid()), True),
+        ("Puppet.get_by_tgid", lambda: Puppet.get_by_tgid(1), False),
+        ("Puppet.get_by_custom_mxid", lambda: Puppet.get_by_custom_mxid(USER), False),
+        ("Puppet.get_by_username", lambda: Puppet.get_by_username("explain"), False),
+        ("Puppet.get_by_displayname", lambda: Puppet.get_by_displayname("Explain"), False),
+        ("User.all", lambda: list(User.all()), True),
+        ("User.get_by_tgid", lambda: User.get_by_tgid(1), False),
+        ("User.get_by_mxid", lambda: User.get_by_mxid(USER), False),
+        ("User.get_by_username", lambda: User.get_by_username("explain"), False),
+        ("User.contacts", lambda: list(user.contacts), False),
+        ("User.portals", lambda: list(user.portals), False),
+        ("User.delete", user.delete, False),
+        ("UserProfile.get", lambda: UserProfile.get(ROOM, USER), False),
+        ("UserProfile.all", lambda: list(UserProfile.all()), True),
+        ("UserProfile.all_in_room", lambda: list(UserProfile.all_in_room(ROOM)), False),
+        ("UserProfile.delete_all", lambda: UserProfile.delete_all(ROOM), False),
+        ("UserProfile.bulk_upsert", lambda: UserProfile.bulk_upsert([profile]), False),
+        ("RoomState.get", lambda: RoomState.get(ROOM), False),
+        ("RoomState.all", lambda: list(RoomState.all()), True),
+        ("RoomState.bulk_upsert", lambda: RoomState.bulk_upsert([RoomState(room_id=ROOM)]),
+         False),
+        ("TelegramFile.get", lambda: TelegramFile.get("explain"), False),
+        ("UploadedFile.get_by_hash", lambda: UploadedFile.get_by_hash(1, "explain"), False),
+        ("UploadedFile.get_by_mxc", lambda: UploadedFile.get_by_mxc(1, "mxc://explain", "m.file"),
+         False),
+        ("UploadedFileMXC.set",
+         lambda: UploadedFileMXC.set(1, "mxc://explain", "m.file", "explain"), False),
+        ("DedupClaim.get", lambda: DedupClaim.get(1, 1, "explain"), False),
+        ("DedupClaim.get_recent", lambda: list(DedupClaim.get_recent(60, 100)), False),
+        ("DedupClaim.store", lambda: DedupClaim.store(1, 1, "explain", EVENT, 1), False),
+        ("DedupClaim.prune", lambda: DedupClaim.prune(60), False),
+        ("ParticipantPage.get_all", lambda: ParticipantPage.get_all(1), False),
+        ("ParticipantPage.replace_all", lambda: ParticipantPage.replace_all(1, []), False),
+        ("BotChat.all", lambda: list(BotChat.all()), True),
+        ("BotChat.delete", lambda: BotChat.delete(1), False),
+    ]
+
+
+config = Config(args.config, None, None)
+config.load()
+db_engine = sql.create_engine(args.database or config["appservice.database"])
+init_db(db_engine)
+is_sqlite = db_engine.dialect.name == "sqlite"
+plans = []  # type: List[Tuple[str, List[str]]]
+
+
+@event.listens_for(db_engine, "connect")
+def prefer_indexes(dbapi_conn, _) -> None:
+    if not is_sqlite:
+        # Postgres prefers sequential scans for small tables even when there is an index.
+        cursor = dbapi_conn.cursor()
+        cursor.execute("SET enable_seqscan = off")
+        cursor.close()
+
+
+@event.listens_for(db_engine, "before_cursor_execute", retval=True)
+def explain(conn, cursor, statement, parameters, context, executemany):
+    return ("EXPLAIN QUERY PLAN " if is_sqlite else "EXPLAIN ") + statement, parameters
+
+
+@event.listens_for(db_engine, "after_cursor_execute")
+def collect_plan(conn, cursor, statement, parameters, context, executemany) -> None:
+    # SQLite returns (id, parent, notused, detail) rows and Postgres returns one line per row.
+    plans.append((statement, [str(row[-1]) for row in cursor.fetchall()]))
+
+
+def is_table_scan(line: str) -> bool:
+    if is_sqlite:
+        return bool(re.match(r"SCAN (TABLE )?\w+", line)) and "CONSTANT ROW" not in line
+    return "Seq Scan on" in line
+
+
+bad = errors = 0
+for name, func, scan_expected in queries():
+    plans.clear()
+    try:
+        func()
+    except Exception as e:
+        # The statements don't return what the query functions expect, which is fine as long as
+        # the statements have been explained.
+        if not plans:
+            print(f"ERROR {name}: {str(e).splitlines()[0]}")
+            errors += 1
+            continue
+    scans = any(is_table_scan(line) for _, lines in plans for line in lines)
+    is_bad = scans and not scan_expected
+    bad += is_bad
+    status = "SCAN " if is_bad else ("scan " if scans else "OK   ")
+    print(f"{status} {name}")
+    if is_bad or args.verbose:
+        for statement, lines in plans:
+            print("        " + " ".join(statement.split()))
+            for line in lines:
+                print(f"          {line}")
+Base.executor.shutdown()
+if bad:
+    print(f"{bad} queries scan whole tables, make sure the database is up to date with "
+          "`alembic upgrade head` or add indexes for them")
+if errors:
+    print(f"{errors} queries failed, make sure the database is up to date with "
+          "`alembic upgrade head`")
+sys.exit(1 if bad or errors else 0)
@@ -0,0 +1,311 @@
+# -*- coding: future_fstrings -*-
+# mautrix-telegram - A Matrix-Telegram puppeting bridge
+# Copyright (C) 2019 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+import asyncio
+import hashlib
+import logging
+import itertools
+import signal
+import time
+import sys
+import os
+
+from aiohttp import web
+import aiohttp
+
+from .types import MatrixEvent, MatrixUserID
+
+EventHandler = Callable[[MatrixEvent], Awaitable[None]]
+Reloader = Callable[..., Awaitable[None]]
+
+MAX_BATCH_SIZE = 100
+MAX_ATTEMPTS = 5
+
+
+def shard_for(mxid: MatrixUserID, count: int) -> int:
+    """Get the shard that owns the given Matrix user.
+
+    The hash is stable across processes and restarts (unlike :func:`hash`), so every process
+    agrees on the owner without any coordination.
+    """
+    if count <= 1:
+        return 0
+    digest = hashlib.sha1(mxid.encode("utf-8")).digest()
+    return int.from_bytes(digest[:4], "big") % count
+
+
+class ShardRouter:
+    """Routes Matrix events between the bridge processes when sharding is enabled.
+
+    Shard 0 is the front process: it receives the transactions from the homeserver, runs the
+    relaybot and the web endpoints, and forwards each event to the shard that owns the sender.
+    The other shards are worker processes started by the front, which only run the Telegram clients
+    of the users they own. They listen on the appservice port plus their shard index on localhost
+    and receive the forwarded events through the normal transaction endpoint.
+
+    Every process has its own caches of portals, puppets, users and the room state, which other
+    processes can change in the database. State events are forwarded to all shards to keep the
+    state caches up to date, but only the front writes them to the database, as it's the only
+    process that sees them in order. A process that changes a portal, puppet or user in the
+    database tells the others to reload it (see :meth:`invalidate`). Cached objects are also
+    reloaded in the background when they're used after ``reload_interval`` seconds, in case an
+    invalidation was lost.
+    """
+    log = logging.getLogger("mau.shard")  # type: logging.Logger
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, count: int, index: int, port: int,
+                 hs_token: str, reload_interval: float = 10) -> None:
+        self.loop = loop  # type: asyncio.AbstractEventLoop
+        self.count = max(count, 1)  # type: int
+        self.index = index  # type: int
+        self.port = port  # type: int
+        self.hs_token = hs_token  # type: str
+        self.reload_interval = reload_interval  # type: float
+        self.local_handler = None  # type: Optional[EventHandler]
+        self.reloaders = {}  # type: Dict[str, Reloader]
+
+        self._session = None  # type: Optional[aiohttp.ClientSession]
+        self._queues = {}  # type: Dict[Tuple[int, str], asyncio.Queue]
+        self._txn_ids = itertools.count()
+        self._processes = {}  # type: Dict[int, asyncio.subprocess.Process]
+        self._stopping = False  # type: bool
+
+    @property
+    def enabled(self) -> bool:
+        return self.count > 1
+
+    @property
+    def is_front(self) -> bool:
+        return self.index == 0
+
+    def owner(self, mxid: MatrixUserID) -> int:
+        return shard_for(mxid, self.count)
+
+    def owns(self, mxid: MatrixUserID) -> bool:
+        return self.owner(mxid) == self.index
+
+    def is_stale(self, loaded_at: float) -> bool:
+        """Check if an object loaded from the database at the given :func:`time.monotonic` time
+        should be reloaded, because another shard may have changed it since."""
+        return self.enabled and time.monotonic() - loaded_at >= self.reload_interval
+
+    def address(self, shard: int) -> str:
+        return f"http://127.0.0.1:{self.port + shard}"
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        if not self._session:
+            self._session = aiohttp.ClientSession()
+        return self._session
+
+    def _check_token(self, request: web.Request) -> bool:
+        return request.headers.get("Authorization", "") == f"Bearer {self.hs_token}"
+
+    def add_routes(self, app: web.Application) -> None:
+        app.router.add_route("POST", "/_mautrix_telegram/shard/relay", self._http_relay)
+        app.router.add_route("POST", "/_mautrix_telegram/shard/start", self._http_start)
+        app.router.add_route("POST", "/_mautrix_telegram/shard/invalidate",
+                             self._http_invalidate)
+
+    # region Event routing
+
+    def route(self, evt: MatrixEvent) -> bool:
+        """Forward an event to the shard that owns its sender.
+
+        State events are forwarded to every shard (see :meth:`broadcast_state`), but only the
+        owner handles them.
+
+        Returns:
+            ``True`` if the event was forwarded, ``False`` if it should be handled locally.
+        """
+        sender = evt.get("sender", None)
+        if not self.enabled or not self.is_front or not sender:
+            return False
+        shard = self.owner(sender)
+        if self.broadcast_state(evt):
+            return shard != self.index
+        elif shard == self.index:
+            return False
+        self._enqueue(shard, evt)
+        return True
+
+    def broadcast_state(self, evt: MatrixEvent) -> bool:
+        """Forward a state event to every worker shard, so that they can update their state store.
+
+        Returns:
+            ``True`` if the event is a state event and was forwarded, ``False`` otherwise.
+        """
+        if not self.enabled or not self.is_front or "state_key" not in evt:
+            return False
+        for shard in range(1, self.count):
+            self._enqueue(shard, evt)
+        return True
+
+    def _enqueue(self, shard: int, item: Dict[str, Any], channel: str = "events") -> None:
+        try:
+            queue = self._queues[(shard, channel)]
+        except KeyError:
+            queue = self._queues[(shard, channel)] = asyncio.Queue()
+            asyncio.ensure_future(self._forward_loop(shard, channel, queue), loop=self.loop)
+        queue.put_nowait(item)
+
+    async def _forward_loop(self, shard: int, channel: str, queue: asyncio.Queue) -> None:
+        # A single sender per shard keeps the items in order and lets them be batched when the
+        # other process can't keep up.
+        while True:
+            items = [await queue.get()]
+            while not queue.empty() and len(items) < MAX_BATCH_SIZE:
+                items.append(queue.get_nowait())
+            if channel == "invalidate":
+                await self._send(shard, "POST", "/_mautrix_telegram/shard/invalidate",
+                                 {"objects": items}, description=f"{len(items)} invalidations")
+                continue
+            txn_id = f"shard-{int(time.time() * 1000)}-{next(self._txn_ids)}"
+            await self._send(shard, "PUT", f"/transactions/{txn_id}", {"events": items},
+                             description=f"{len(items)} events")
+
+    async def _send(self, shard: int, method: str, path: str, data: Dict,
+                    description: str) -> bool:
+        url = self.address(shard) + path
+        headers = {"Authorization": f"Bearer {self.hs_token}"}
+        for attempt in range(MAX_ATTEMPTS):
+            try:
+                async with self.session.request(method, url, json=data,
+                                                headers=headers) as response:
+                    if response.status == 200:
+                        return True
+                    self.log.warning(f"Shard {shard} responded to {description} with HTTP "
+                                     f"{response.status}")
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                self.log.warning(f"Failed to send {description} to shard {shard}: {e}")
+            await asyncio.sleep(2 ** attempt)
+        self.log.error(f"Giving up on sending {description} to shard {shard}")
+        return False
+
+    def relay_to_front(self, evt: MatrixEvent) -> Awaitable[bool]:
+        """Send an event that needs the relaybot to the front process."""
+        return self._send(0, "POST", "/_mautrix_telegram/shard/relay", evt,
+                          description=f"relaybot event {evt.get('event_id')}")
+
+    async def _http_relay(self, request: web.Request) -> web.Response:
+        if not self._check_token(request):
+            return web.Response(status=401)
+        evt = await request.json()
+        if self.local_handler:
+            asyncio.ensure_future(self.local_handler(evt), loop=self.loop)
+        return web.json_response({})
+
+    # endregion
+    # region Cache invalidation
+
+    def invalidate(self, kind: str, *key: Any) -> None:
+        """Tell the other shards to reload a cached object that this shard changed in the database.
+
+        Args:
+            kind: The type of the object, one of the keys of :attr:`reloaders`.
+            *key: The arguments that the reloader uses to find the object in its cache.
+        """
+        if not self.enabled:
+            return
+        for shard in range(self.count):
+            if shard != self.index:
+                self._enqueue(shard, {"type": kind, "key": list(key)}, channel="invalidate")
+
+    async def _http_invalidate(self, request: web.Request) -> web.Response:
+        if not self._check_token(request):
+            return web.Response(status=401)
+        for obj in (await request.json()).get("objects", []):
+            try:
+                reloader = self.reloaders[obj["type"]]
+            except KeyError:
+                continue
+            asyncio.ensure_future(self._reload(reloader, obj["key"]), loop=self.loop)
+        return web.json_response({})
+
+    async def _reload(self, reloader: Reloader, key: List[Any]) -> None:
+        try:
+            await reloader(*key)
+        except Exception:
+            self.log.exception(f"Failed to reload {key} after invalidation")
+
+    # endregion
+    # region Client handoff
+
+    def start_client(self, mxid: MatrixUserID) -> Awaitable[bool]:
+        """Ask the shard that owns a user to start their Telegram client.
+
+        Logins through the web endpoints happen in the front process, so the client is handed off
+        to the owning shard once the login is complete.
+        """
+        return self._send(self.owner(mxid), "POST", "/_mautrix_telegram/shard/start",
+                          {"mxid": mxid}, description=f"client start of {mxid}")
+
+    async def _http_start(self, request: web.Request) -> web.Response:
+        if not self._check_token(request):
+            return web.Response(status=401)
+        mxid = (await request.json()).get("mxid", None)
+        if not mxid or not self.owns(mxid):
+            return web.Response(status=400)
+        from .user import User
+        user = User.get_by_mxid(mxid)
+        if not user.client:
+            # The login was saved by the front process after this shard loaded the user.
+            await user.reload()
+        await user.ensure_started()
+        return web.json_response({})
+
+    # endregion
+    # region Worker processes
+
+    def start_workers(self, args: List[str]) -> None:
+        """Start and supervise the worker processes. Only called in the front process."""
+        for shard in range(1, self.count):
+            asyncio.ensure_future(self._run_worker(shard, args), loop=self.loop)
+
+    async def _run_worker(self, shard: int, args: List[str]) -> None:
+        while not self._stopping:
+            process = await asyncio.create_subprocess_exec(
+                sys.executable, "-m", "mautrix_telegram", *args, "--shard", str(shard))
+            self._processes[shard] = process
+            self.log.info(f"Started shard {shard} with PID {process.pid}")
+            code = await process.wait()
+            del self._processes[shard]
+            if not self._stopping:
+                self.log.error(f"Shard {shard} exited with code {code}, restarting in 10 seconds")
+                await asyncio.sleep(10)
+
+    async def stop(self) -> None:
+        self._stopping = True
+        for process in self._processes.values():
+            process.terminate()
+        try:
+            await asyncio.wait_for(asyncio.gather(*[process.wait() for process
+                                                    in self._processes.values()]), timeout=30)
+        except asyncio.TimeoutError:
+            self.log.warning("Timed out waiting for shards to stop")
+        if self._session:
+            await self._session.close()
+
+    async def watch_front(self, interval: float = 5) -> None:
+        """Stop this worker if the front process that started it dies."""
+        parent = os.getppid()
+        while os.getppid() == parent:
+            await asyncio.sleep(interval)
+        self.log.warning("Front process died, stopping")
+        os.kill(os.getpid(), signal.SIGTERM)
+
+    # endregion
@@ -14,7 +14,10 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
-from typing import Dict, Tuple
+from typing import Dict, List, Optional, Set, Tuple
+import asyncio
+import logging
+import copy
 
 from mautrix_appservice import StateStore
 
@@ -23,11 +26,73 @@ from . import puppet as pu
 from .db import RoomState, UserProfile
 
 
+class MemberProfile:
+    """The cached membership of a user in a room. There's one of these for each room member, so it
+    uses slots instead of keeping :class:`UserProfile` model instances in memory."""
+    __slots__ = ("room_id", "user_id", "membership", "displayname", "avatar_url")
+
+    def __init__(self, room_id: MatrixRoomID, user_id: MatrixUserID, membership: str,
+                 displayname: Optional[str] = None, avatar_url: Optional[str] = None) -> None:
+        self.room_id = room_id  # type: MatrixRoomID
+        self.user_id = user_id  # type: MatrixUserID
+        self.membership = membership  # type: str
+        self.displayname = displayname  # type: Optional[str]
+        self.avatar_url = avatar_url  # type: Optional[str]
+
+    @classmethod
+    def from_db(cls, profile: UserProfile) -> 'MemberProfile':
+        return cls(profile.room_id, profile.user_id, profile.membership, profile.displayname,
+                   profile.avatar_url)
+
+    def to_db(self) -> UserProfile:
+        return UserProfile(room_id=self.room_id, user_id=self.user_id, membership=self.membership,
+                           displayname=self.displayname, avatar_url=self.avatar_url)
+
+    def dict(self) -> Dict[str, str]:
+        return {
+            "membership": self.membership,
+            "displayname": self.displayname,
+            "avatar_url": self.avatar_url,
+        }
+
+
 class SQLStateStore(StateStore):
-    def __init__(self) -> None:
+    """A state store that keeps member profiles and power levels in the database and caches them.
+
+    Lookups that don't find a row are cached as the default state (not joined, no power levels)
+    without inserting anything, and the row is only written when the state is actually set. The
+    ``preload`` mode decides how the cache is filled:
+
+    * ``lazy``: each missing room member or room is queried separately.
+    * ``room``: all members and the power levels of a room are loaded on the first lookup in it.
+    * ``startup``: everything is loaded with :meth:`preload_all`, after which nothing is queried.
+
+    Writes are queued by key, so repeated changes to the same member or room are written once. The
+    queue is written in a single transaction in the background after ``write_delay`` seconds, or
+    immediately when ``write_max_size`` keys are queued. Only one background write runs at a time,
+    so the rows are always written in order. Without ``persist``, changes are only kept in the
+    cache, which is used by sharded workers, as the front process writes the state for them.
+    """
+    log = logging.getLogger("mau.state_store")  # type: logging.Logger
+
+    def __init__(self, preload: str = "lazy", write_max_size: int = 1000,
+                 write_delay: float = 1, persist: bool = True) -> None:
         super().__init__()
-        self.profile_cache = {}  # type: Dict[Tuple[str, str], UserProfile]
+        if preload not in ("lazy", "room", "startup"):
+            raise ValueError(f"Invalid state store preload mode {preload}")
+        self.preload = preload  # type: str
+        self.write_max_size = write_max_size  # type: int
+        self.write_delay = write_delay  # type: float
+        self.persist = persist  # type: bool
+        self.profile_cache = {}  # type: Dict[Tuple[str, str], MemberProfile]
         self.room_state_cache = {}  # type: Dict[str, RoomState]
+        self._loaded_rooms = set()  # type: Set[MatrixRoomID]
+        self._loaded_all = False  # type: bool
+
+        self._queued_profiles = {}  # type: Dict[Tuple[str, str], MemberProfile]
+        self._queued_room_states = {}  # type: Dict[str, RoomState]
+        self._write_handle = None  # type: Optional[asyncio.TimerHandle]
+        self._writing = None  # type: Optional[asyncio.Future]
 
     @staticmethod
     def is_registered(user: MatrixUserID) -> bool:
@@ -41,6 +106,90 @@ class SQLStateStore(StateStore):
             puppet.is_registered = True
             puppet.save()
 
+    @property
+    def queued_writes(self) -> int:
+        return len(self._queued_profiles) + len(self._queued_room_states)
+
+    def _queue_write(self) -> None:
+        if not self.persist:
+            self._take_queued()
+            return
+        elif self.queued_writes >= self.write_max_size:
+            self._start_write()
+        elif not self._write_handle:
+            loop = UserProfile.loop or asyncio.get_event_loop()
+            self._write_handle = loop.call_later(self.write_delay, self._start_write)
+
+    def _take_queued(self) -> Tuple[Dict[Tuple[str, str], MemberProfile], Dict[str, RoomState]]:
+        profiles, room_states = self._queued_profiles, self._queued_room_states
+        self._queued_profiles = {}
+        self._queued_room_states = {}
+        return profiles, room_states
+
+    def _requeue(self, profiles: Dict[Tuple[str, str], MemberProfile],
+                 room_states: Dict[str, RoomState]) -> None:
+        # Keys that were queued again after the write started already have newer values.
+        for key, profile in profiles.items():
+            self._queued_profiles.setdefault(key, profile)
+        for room, room_state in room_states.items():
+            self._queued_room_states.setdefault(room, room_state)
+
+    @staticmethod
+    def _to_rows(profiles: Dict[Tuple[str, str], MemberProfile], room_states: Dict[str, RoomState]
+                 ) -> Tuple[List[UserProfile], List[RoomState]]:
+        # The cached objects keep changing, so copies are written instead.
+        return ([profile.to_db() for profile in profiles.values()],
+                [RoomState(room_id=room_state.room_id,
+                           power_levels=copy.deepcopy(room_state.power_levels))
+                 for room_state in room_states.values()])
+
+    @staticmethod
+    def _write(profiles: List[UserProfile], room_states: List[RoomState]) -> None:
+        if profiles:
+            UserProfile.bulk_upsert(profiles)
+        if room_states:
+            RoomState.bulk_upsert(room_states)
+
+    def _start_write(self) -> None:
+        if self._write_handle:
+            self._write_handle.cancel()
+            self._write_handle = None
+        if self._writing or not self.queued_writes:
+            # The queue is checked again when the current write is done.
+            return
+        profiles, room_states = self._take_queued()
+        # The cache already has the new values, so the write doesn't need to block the event loop.
+        self._writing = UserProfile.run_in_executor(self._write,
+                                                    *self._to_rows(profiles, room_states))
+        self._writing.add_done_callback(
+            lambda future: self._write_done(future, profiles, room_states))
+
+    def _write_done(self, future: asyncio.Future,
+                    profiles: Dict[Tuple[str, str], MemberProfile],
+                    room_states: Dict[str, RoomState]) -> None:
+        self._writing = None
+        if future.cancelled() or future.exception():
+            if not future.cancelled():
+                self.log.error("Failed to write state to database, retrying later",
+                               exc_info=future.exception())
+            self._requeue(profiles, room_states)
+        if self.queued_writes:
+            self._queue_write()
+
+    def flush(self) -> None:
+        """Write all queued changes to the database synchronously. Used at shutdown, after the
+        database executor has finished."""
+        if self._write_handle:
+            self._write_handle.cancel()
+            self._write_handle = None
+        if self.queued_writes:
+            profiles, room_states = self._take_queued()
+            try:
+                self._write(*self._to_rows(profiles, room_states))
+            except Exception:
+                self._requeue(profiles, room_states)
+                raise
+
     def update_state(self, event: Dict) -> None:
         event_type = event["type"]
         if event_type == "m.room.power_levels":
@@ -48,51 +197,104 @@ class SQLStateStore(StateStore):
         elif event_type == "m.room.member":
             self.set_member(event["room_id"], event["state_key"], event["content"])
 
-    def _get_user_profile(self, room_id: MatrixRoomID, user_id: MatrixUserID, create: bool = True
-                          ) -> UserProfile:
+    @staticmethod
+    def _read_all() -> Tuple[List[MemberProfile], List[RoomState]]:
+        # The rows are converted while reading, so that there's only one model instance at a time.
+        return ([MemberProfile.from_db(profile) for profile in UserProfile.all()],
+                list(RoomState.all()))
+
+    async def preload_all(self) -> None:
+        """Load all member profiles and room states into the cache."""
+        profiles, room_states = await UserProfile.run_in_executor(self._read_all)
+        # Anything that was set or looked up while loading is at least as new as the loaded rows.
+        for profile in profiles:
+            self.profile_cache.setdefault((profile.room_id, profile.user_id), profile)
+        for room_state in room_states:
+            self.room_state_cache.setdefault(room_state.room_id, room_state)
+        self._loaded_all = True
+        self.log.info(f"Preloaded {len(profiles)} member profiles "
+                      f"and {len(room_states)} room states")
+
+    def _is_loaded(self, room_id: MatrixRoomID) -> bool:
+        if self._loaded_all or room_id in self._loaded_rooms:
+            return True
+        elif self.preload != "room":
+            return False
+        self._load_room(room_id)
+        return True
+
+    def _load_room(self, room_id: MatrixRoomID) -> None:
+        for profile in UserProfile.all_in_room(room_id):
+            self.profile_cache.setdefault((room_id, profile.user_id),
+                                          MemberProfile.from_db(profile))
+        room_state = RoomState.get(room_id)
+        if room_state:
+            self.room_state_cache.setdefault(room_id, room_state)
+        self._loaded_rooms.add(room_id)
+
+    def _get_user_profile(self, room_id: MatrixRoomID, user_id: MatrixUserID) -> MemberProfile:
         key = (room_id, user_id)
         try:
             return self.profile_cache[key]
         except KeyError:
             pass
 
-        profile = UserProfile.get(*key)
-        if profile:
-            self.profile_cache[key] = profile
-        elif create:
-            profile = UserProfile(room_id=room_id, user_id=user_id, membership="leave")
-            profile.insert()
-            self.profile_cache[key] = profile
+        if self._is_loaded(room_id):
+            try:
+                return self.profile_cache[key]
+            except KeyError:
+                db_profile = None
+        else:
+            db_profile = UserProfile.get(*key)
+        profile = (MemberProfile.from_db(db_profile) if db_profile
+                   else MemberProfile(room_id, user_id, "leave"))
+        self.profile_cache[key] = profile
         return profile
 
     def get_member(self, room: MatrixRoomID, user: MatrixUserID) -> Dict:
         return self._get_user_profile(room, user).dict()
 
-    def set_member(self, room: MatrixRoomID, user: MatrixUserID, member: Dict) -> None:
+    def _set_member(self, room: MatrixRoomID, user: MatrixUserID, member: Dict) -> None:
         profile = self._get_user_profile(room, user)
         profile.membership = member.get("membership", profile.membership or "leave")
         profile.displayname = member.get("displayname", profile.displayname)
         profile.avatar_url = member.get("avatar_url", profile.avatar_url)
-        profile.update()
+        self._queued_profiles[(room, user)] = profile
+
+    def set_member(self, room: MatrixRoomID, user: MatrixUserID, member: Dict) -> None:
+        self._set_member(room, user, member)
+        self._queue_write()
+
+    def set_members(self, room: MatrixRoomID, members: Dict[MatrixUserID, Dict]) -> None:
+        """Set the state of many members of a room at once, e.g. after fetching the member list."""
+        if not self._is_loaded(room) and any((room, user) not in self.profile_cache
+                                             for user in members):
+            # Load the existing rows with one query instead of one per member.
+            self._load_room(room)
+        for user, member in members.items():
+            self._set_member(room, user, member)
+        self._queue_write()
 
     def set_membership(self, room: MatrixRoomID, user: MatrixUserID, membership: str) -> None:
         self.set_member(room, user, {
             "membership": membership,
         })
 
-    def _get_room_state(self, room_id: MatrixRoomID, create: bool = True) -> RoomState:
+    def _get_room_state(self, room_id: MatrixRoomID) -> RoomState:
         try:
             return self.room_state_cache[room_id]
         except KeyError:
             pass
 
-        room = RoomState.get(room_id)
-        if room:
-            self.room_state_cache[room_id] = room
-        elif create:
-            room = RoomState(room_id=room_id)
-            room.insert()
-            self.room_state_cache[room_id] = room
+        if self._is_loaded(room_id):
+            try:
+                return self.room_state_cache[room_id]
+            except KeyError:
+                room = None
+        else:
+            room = RoomState.get(room_id)
+        room = room or RoomState(room_id=room_id)
+        self.room_state_cache[room_id] = room
         return room
 
     def has_power_levels(self, room: MatrixRoomID) -> bool:
@@ -111,9 +313,11 @@ class SQLStateStore(StateStore):
             }
         power_levels[room]["users"][user] = level
         room_state.power_levels = power_levels
-        room_state.update()
+        self._queued_room_states[room] = room_state
+        self._queue_write()
 
     def set_power_levels(self, room: MatrixRoomID, content: Dict) -> None:
         state = self._get_room_state(room)
         state.power_levels = content
-        state.update()
+        self._queued_room_states[room] = state
+        self._queue_write()
@@ -15,23 +15,29 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 from typing import List, Union, Optional
+import os
 
 from telethon import TelegramClient, utils
+from telethon.errors import DcIdInvalidError, FileMigrateError
+from telethon.network import MTProtoSender
 from telethon.tl.functions.messages import SendMediaRequest
+from telethon.tl.functions.upload import GetFileRequest
 from telethon.tl.types import (
     InputMediaUploadedDocument, InputMediaUploadedPhoto, TypeDocumentAttribute, TypeInputMedia,
     TypeInputPeer, TypeMessageEntity, TypeMessageMedia, TypePeer)
+from telethon.tl.types.upload import FileCdnRedirect
 from telethon.tl.patched import Message
 
 
 class MautrixTelegramClient(TelegramClient):
-    async def upload_file_direct(self, file: bytes, mime_type: str = None,
+    async def upload_file_direct(self, file: Union[bytes, str], mime_type: str = None,
                                  attributes: List[TypeDocumentAttribute] = None,
                                  file_name: str = None, max_image_size: float = 10 * 1000 ** 2,
                                  ) -> Union[InputMediaUploadedDocument, InputMediaUploadedPhoto]:
         file_handle = await super().upload_file(file, file_name=file_name, use_cache=False)
+        file_size = os.path.getsize(file) if isinstance(file, str) else len(file)
 
-        if (mime_type == "image/png" or mime_type == "image/jpeg") and len(file) < max_image_size:
+        if (mime_type == "image/png" or mime_type == "image/jpeg") and file_size < max_image_size:
             return InputMediaUploadedPhoto(file_handle)
         else:
             attributes = attributes or []
@@ -51,3 +57,82 @@ class MautrixTelegramClient(TelegramClient):
         request = SendMediaRequest(entity, media, message=caption or "", entities=entities or [],
                                    reply_to_msg_id=reply_to)
         return self._get_response_message(request, await self(request), entity)
+
+    def iter_download(self, location, file_size: Optional[int] = None,
+                      part_size_kb: Optional[int] = None) -> 'DownloadIterator':
+        """Download a file in chunks instead of reading the whole file into memory.
+
+        The returned iterator must be closed with :meth:`DownloadIterator.close` if it isn't
+        consumed to the end.
+        """
+        if not part_size_kb:
+            part_size_kb = utils.get_appropriated_part_size(file_size) if file_size else 64
+        return DownloadIterator(self, location, int(part_size_kb * 1024))
+
+
+class DownloadIterator:
+    """An async iterator over the chunks of a file, equivalent to the loop in
+    :meth:`TelegramClient.download_file`."""
+
+    def __init__(self, client: MautrixTelegramClient, location, part_size: int) -> None:
+        self.client = client  # type: MautrixTelegramClient
+        self.dc_id, self.location = utils.get_input_location(location)
+        self.part_size = part_size  # type: int
+        self.offset = 0  # type: int
+        self._sender = None  # type: Optional[MTProtoSender]
+        self._exported = False  # type: bool
+        self._done = False  # type: bool
+
+    def __aiter__(self) -> 'DownloadIterator':
+        return self
+
+    async def _connect(self) -> None:
+        if self.dc_id and self.client.session.dc_id != self.dc_id:
+            try:
+                self._sender = await self.client._borrow_exported_sender(self.dc_id)
+                self._exported = True
+                return
+            except DcIdInvalidError:
+                pass
+        self._sender = self.client._sender
+
+    async def __anext__(self) -> bytes:
+        if self._done:
+            raise StopAsyncIteration
+        if not self._sender:
+            await self._connect()
+        while True:
+            try:
+                result = await self._sender.send(GetFileRequest(self.location, self.offset,
+                                                                self.part_size))
+            except FileMigrateError as e:
+                await self._release()
+                self._sender = await self.client._borrow_exported_sender(e.new_dc)
+                self._exported = True
+                continue
+            except Exception:
+                await self.close()
+                raise
+            if isinstance(result, FileCdnRedirect):
+                await self.close()
+                raise NotImplementedError("CDN downloads are not supported")
+            break
+        self.offset += self.part_size
+        # Only the last part can be smaller than the part size, so there's no need to request
+        # the empty part after it.
+        if len(result.bytes) < self.part_size:
+            await self.close()
+        if not result.bytes:
+            raise StopAsyncIteration
+        return result.bytes
+
+    async def _release(self) -> None:
+        if self._exported:
+            await self.client._return_exported_sender(self._sender)
+        self._sender = None
+        self._exported = False
+
+    async def close(self) -> None:
+        self._done = True
+        if self._sender:
+            await self._release()
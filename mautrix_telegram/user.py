@@ -14,11 +14,15 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
-from typing import Awaitable, Dict, List, Iterable, Match, NewType, Optional, Tuple, TYPE_CHECKING
+from typing import (Awaitable, Dict, List, Iterable, Match, NewType, Optional, Set, Tuple,
+                    TYPE_CHECKING)
 import logging
 import asyncio
+import time
 import re
 
+from sqlalchemy import func, select
+
 from telethon.tl.types import (
     TypeUpdate, UpdateNewMessage, UpdateNewChannelMessage, PeerUser,
     UpdateShortChatMessage, UpdateShortMessage, User as TLUser)
@@ -30,11 +34,12 @@ from mautrix_appservice import MatrixRequestError
 from .types import MatrixUserID, TelegramID
 from .db import User as DBUser
 from .abstract_user import AbstractUser
-from . import portal as po, puppet as pu
+from . import portal as po, puppet as pu, util
 
 if TYPE_CHECKING:
     from .config import Config
     from .context import Context
+    from .sharding import ShardRouter
 
 config = None  # type: Config
 
@@ -43,8 +48,9 @@ SearchResult = NewType('SearchResult', Tuple['pu.Puppet', int])
 
 class User(AbstractUser):
     log = logging.getLogger("mau.user")  # type: logging.Logger
-    by_mxid = {}  # type: Dict[str, User]
-    by_tgid = {}  # type: Dict[int, User]
+    by_mxid = util.InstanceCache("users_by_mxid")  # type: Dict[str, User]
+    by_tgid = util.InstanceCache("users_by_tgid")  # type: Dict[int, User]
+    shards = None  # type: ShardRouter
 
     def __init__(self, mxid: MatrixUserID, tgid: Optional[TelegramID] = None,
                  username: Optional[str] = None, phone: Optional[str] = None,
@@ -58,14 +64,17 @@ class User(AbstractUser):
         self.is_bot = is_bot  # type: bool
         self.username = username  # type: str
         self.phone = phone  # type: str
-        self.contacts = []  # type: List[pu.Puppet]
+        # The IDs are stored instead of the objects, so that the portals and puppets can be
+        # evicted from their caches.
+        self.contacts = []  # type: List[TelegramID]
         self.saved_contacts = saved_contacts  # type: int
         self.db_contacts = db_contacts
-        self.portals = {}  # type: Dict[Tuple[TelegramID, TelegramID], po.Portal]
-        self.db_portals = db_portals or []
+        self.portals = set()  # type: Set[Tuple[TelegramID, TelegramID]]
+        self.db_portals = db_portals
         self._db_instance = db_instance  # type: Optional[DBUser]
 
         self.command_status = None  # type: Optional[Dict]
+        self._loaded_at = time.monotonic()  # type: float
 
         (self.relaybot_whitelisted,
          self.whitelisted,
@@ -82,6 +91,17 @@ class User(AbstractUser):
     def name(self) -> str:
         return self.mxid
 
+    @property
+    def is_pinned(self) -> bool:
+        """Whether the user must stay cached, because it has a Telegram session or client, or a
+        command like login is in progress."""
+        return bool(self.tgid or self.client or self.command_status)
+
+    def _uncache(self) -> None:
+        self.by_mxid.discard(self.mxid, self)
+        if self.tgid:
+            self.by_tgid.discard(self.tgid, self)
+
     @property
     def mxid_localpart(self) -> str:
         match = re.compile("@(.+):(.+)").match(self.mxid)  # type: Match
@@ -102,26 +122,19 @@ class User(AbstractUser):
 
     @property
     def db_contacts(self) -> Iterable[TelegramID]:
-        return (puppet.id
-                for puppet in self.contacts
-                if puppet)
+        return self.contacts
 
     @db_contacts.setter
     def db_contacts(self, contacts: Iterable[TelegramID]) -> None:
-        self.contacts = [pu.Puppet.get(entry) for entry in contacts] if contacts else []
+        self.contacts = list(contacts) if contacts else []
 
     @property
     def db_portals(self) -> Iterable[Tuple[TelegramID, TelegramID]]:
-        return (portal.tgid_full
-                for portal in self.portals.values()
-                if portal and not portal.deleted)
+        return self.portals
 
     @db_portals.setter
     def db_portals(self, portals: Iterable[Tuple[TelegramID, TelegramID]]) -> None:
-        self.portals = {
-            tgid_full: po.Portal.get_by_tgid(*tgid_full)
-            for tgid_full in portals
-        } if portals else {}
+        self.portals = set(portals) if portals else set()
 
     # region Database conversion
 
@@ -142,6 +155,7 @@ class User(AbstractUser):
             self.db_instance.contacts = self.db_contacts
         if portals:
             self.db_instance.portals = self.db_portals
+        self.shards.invalidate("user", self.mxid)
 
     def delete(self, delete_db: bool = True) -> None:
         try:
@@ -151,6 +165,58 @@ class User(AbstractUser):
             pass
         if delete_db and self._db_instance:
             self._db_instance.delete()
+            self.shards.invalidate("user", self.mxid)
+
+    async def reload(self) -> bool:
+        """Reload the user from the database, as the shard that owns it may have changed it.
+
+        Returns:
+            ``False`` if the user has been deleted from the database, ``True`` otherwise.
+        """
+        self._loaded_at = time.monotonic()
+        db_user = await DBUser.aio.get_by_mxid(self.mxid)
+        if not db_user:
+            self._uncache()
+            return False
+        if db_user.tgid != self.tgid:
+            if self.tgid:
+                self.by_tgid.discard(self.tgid, self)
+            self.tgid = db_user.tgid
+            if self.tgid:
+                self.by_tgid[self.tgid] = self
+        self.username = db_user.tg_username
+        self.phone = db_user.tg_phone
+        self.saved_contacts = db_user.saved_contacts
+        self.db_contacts = db_user.contacts
+        self.db_portals = db_user.portals
+        self._db_instance = db_user
+        return True
+
+    def _can_reload(self) -> bool:
+        # Users are only changed by the shard that owns them, unless they're logging in here.
+        return self.is_remote and not self.client and not self.command_status
+
+    def _reload_if_stale(self) -> None:
+        # Lookups are synchronous, so the reload is done in the background.
+        if self._can_reload() and self.shards.is_stale(self._loaded_at):
+            self._loaded_at = time.monotonic()
+            asyncio.ensure_future(self._reload_in_background(), loop=self.loop)
+
+    async def _reload_in_background(self) -> None:
+        try:
+            await self.reload()
+        except Exception:
+            self.log.exception(f"Failed to reload {self.mxid}")
+
+    @classmethod
+    async def reload_cached(cls, mxid: MatrixUserID) -> None:
+        """Reload a cached user after another shard changed it."""
+        try:
+            user = cls.by_mxid[mxid]
+        except KeyError:
+            return
+        if user._can_reload():
+            await user.reload()
 
     @classmethod
     def from_db(cls, db_user: DBUser) -> 'User':
@@ -161,8 +227,29 @@ class User(AbstractUser):
     # endregion
     # region Telegram connection management
 
-    def ensure_started(self, even_if_no_session=False) -> Awaitable['User']:
-        return super().ensure_started(even_if_no_session)
+    @property
+    def is_remote(self) -> bool:
+        """Whether the Telegram client of this user runs in another shard."""
+        return bool(self.shards) and not self.shards.owns(self.mxid)
+
+    async def ensure_started(self, even_if_no_session=False) -> 'User':
+        if self.is_remote:
+            # The client runs in another shard. A new client is only created here for logging
+            # in through the web endpoints, after which it's handed off to the owning shard.
+            if not even_if_no_session or self.session_container.has_session(self.mxid):
+                return self
+        return await super().ensure_started(even_if_no_session)
+
+    async def is_logged_in(self) -> bool:
+        if not self.client and self.is_remote:
+            return self.session_container.has_session(self.mxid)
+        return await super().is_logged_in()
+
+    async def hand_off(self) -> None:
+        """Stop the client in this process and start it in the shard that owns this user."""
+        self.log.debug(f"Handing off {self.mxid} to shard {self.shards.owner(self.mxid)}")
+        await self.stop()
+        await self.shards.start_client(self.mxid)
 
     async def start(self, delete_unless_authenticated: bool = False) -> 'User':
         await super().start()
@@ -238,14 +325,15 @@ class User(AbstractUser):
         puppet = pu.Puppet.get(self.tgid)
         if puppet.is_real_user:
             await puppet.switch_mxid(None, None)
-        for _, portal in self.portals.items():
+        for tgid_full in self.portals:
+            portal = po.Portal.get_by_tgid(*tgid_full)
             if not portal or portal.deleted or not portal.mxid or portal.has_bot:
                 continue
             try:
                 await portal.main_intent.kick(portal.mxid, self.mxid, "Logged out of Telegram.")
             except MatrixRequestError:
                 pass
-        self.portals = {}
+        self.portals = set()
         self.contacts = []
         self.save(portals=True, contacts=True)
         if self.tgid:
@@ -264,7 +352,8 @@ class User(AbstractUser):
     def _search_local(self, query: str, max_results: int = 5, min_similarity: int = 45
                       ) -> List[SearchResult]:
         results = []  # type: List[SearchResult]
-        for contact in self.contacts:
+        for contact_id in self.contacts:
+            contact = pu.Puppet.get(contact_id)
             similarity = contact.similarity(query)
             if similarity >= min_similarity:
                 results.append(SearchResult((contact, similarity)))
@@ -298,7 +387,7 @@ class User(AbstractUser):
         creators = []
         for entity in await self.get_dialogs(limit=config["bridge.sync_dialog_limit"] or None):
             portal = po.Portal.get_by_entity(entity)
-            self.portals[portal.tgid_full] = portal
+            self.portals.add(portal.tgid_full)
             creators.append(
                 portal.create_matrix_room(self, entity, invites=[self.mxid],
                                           synchronous=synchronous_create))
@@ -306,30 +395,39 @@ class User(AbstractUser):
         await asyncio.gather(*creators, loop=self.loop)
 
     def register_portal(self, portal: po.Portal) -> None:
-        try:
-            if self.portals[portal.tgid_full] == portal:
-                return
-        except KeyError:
-            pass
-        self.portals[portal.tgid_full] = portal
+        if portal.tgid_full in self.portals:
+            return
+        self.portals.add(portal.tgid_full)
         self.save(portals=True)
 
     def unregister_portal(self, portal: po.Portal) -> None:
-        try:
-            del self.portals[portal.tgid_full]
-            self.save(portals=True)
-        except KeyError:
-            pass
+        if portal.tgid_full not in self.portals:
+            return
+        self.portals.remove(portal.tgid_full)
+        self.save(portals=True)
+
+    def has_portal(self, tgid_full: Tuple[TelegramID, TelegramID]) -> bool:
+        return tgid_full in self.portals
+
+    @classmethod
+    def portal_moved(cls, old: Tuple[TelegramID, TelegramID],
+                     new: Optional[Tuple[TelegramID, TelegramID]]) -> None:
+        """Update the portal lists of the cached users after a portal was migrated or deleted.
+
+        The rows in the database are updated by the foreign key cascades.
+        """
+        for user in cls.by_mxid.values():
+            if old in user.portals:
+                user.portals.remove(old)
+                if new:
+                    user.portals.add(new)
 
     async def needs_relaybot(self, portal: po.Portal) -> bool:
         return not await self.is_logged_in() or (
             (portal.has_bot or self.bot) and portal.tgid_full not in self.portals)
 
     def _hash_contacts(self) -> int:
-        acc = 0
-        for contact in sorted([self.saved_contacts] + [contact.id for contact in self.contacts]):
-            acc = (acc * 20261 + contact) & 0xffffffff
-        return acc & 0x7fffffff
+        return util.vector_hash(sorted([self.saved_contacts] + self.contacts))
 
     async def sync_contacts(self) -> None:
         response = await self.client(GetContactsRequest(hash=self._hash_contacts()))
@@ -341,7 +439,7 @@ class User(AbstractUser):
         for user in response.users:
             puppet = pu.Puppet.get(user.id)
             await puppet.update_info(self, user)
-            self.contacts.append(puppet)
+            self.contacts.append(puppet.id)
         self.save(contacts=True)
 
     # endregion
@@ -353,7 +451,9 @@ class User(AbstractUser):
             raise ValueError("Matrix ID can't be empty")
 
         try:
-            return cls.by_mxid[mxid]
+            user = cls.by_mxid[mxid]
+            user._reload_if_stale()
+            return user
         except KeyError:
             pass
 
@@ -372,7 +472,9 @@ class User(AbstractUser):
     @classmethod
     def get_by_tgid(cls, tgid: TelegramID) -> Optional['User']:
         try:
-            return cls.by_tgid[tgid]
+            user = cls.by_tgid[tgid]
+            user._reload_if_stale()
+            return user
         except KeyError:
             pass
 
@@ -400,9 +502,40 @@ class User(AbstractUser):
     # endregion
 
 
-def init(context: 'Context') -> List[Awaitable['User']]:
+def _get_last_activity() -> Dict[MatrixUserID, int]:
+    """Get the timestamp of the latest Telegram update state saved for each session."""
+    table = User.session_container.UpdateState.__table__
+    rows = DBUser.db.execute(select([table.c.session_id, func.max(table.c.date)])
+                             .group_by(table.c.session_id))
+    return {session_id: date or 0 for session_id, date in rows}
+
+
+def init(context: 'Context') -> List[Awaitable[None]]:
     global config
     config = context.config
+    User.shards = context.shards
+    context.shards.reloaders["user"] = User.reload_cached
+    for cache in (User.by_mxid, User.by_tgid):
+        cache.max_size = config["appservice.instance_cache.users"] or 0
+        cache.is_pinned = lambda user: user.is_pinned
+        cache.on_evict = User._uncache
 
     users = [User.from_db(user) for user in DBUser.all()]
-    return [user.ensure_started() for user in users if user.tgid]
+    users = [user for user in users if user.tgid and User.shards.owns(user.mxid)]
+
+    # Start the most recently active users first, so that they're bridged again quickly.
+    last_activity = _get_last_activity()
+    users.sort(key=lambda user: last_activity.get(user.mxid, -1), reverse=True)
+
+    lazy_after_days = config.get("bridge.startup.lazy_connect_after_days", 0)
+    if lazy_after_days > 0:
+        cutoff = time.time() - lazy_after_days * 24 * 60 * 60
+        idle_count = len(users)
+        users = [user for user in users if last_activity.get(user.mxid, cutoff) >= cutoff]
+        idle_count -= len(users)
+        User.log.info(f"Not connecting {idle_count} users who haven't been active in "
+                      f"{lazy_after_days} days until they send something on Matrix")
+
+    return [util.run_staggered("Telegram clients", [user.ensure_started for user in users],
+                               max_concurrent=config.get("bridge.startup.max_concurrent", 10),
+                               jitter=config.get("bridge.startup.jitter", 0.5))]
@@ -1,7 +1,20 @@
-from .file_transfer import transfer_file_to_matrix, convert_image
+from .file_transfer import (transfer_file_to_matrix, convert_image, init as init_file_transfer,
+                            stop as stop_file_transfer)
+from .dedup_store import DedupStore
+from .fingerprint import fingerprint_event
+from .ephemeral_coalescer import EphemeralCoalescer
 from .format_duration import format_duration
+from .instance_cache import InstanceCache
+from .media_cache import MediaCache
 from .signed_token import sign_token, verify_token
+from .startup import run_staggered
+from .redaction_queue import RedactionQueue
+from .request_scheduler import RequestScheduler
 from .recursive_dict import recursive_del, recursive_set, recursive_get
+from .update_dispatcher import UpdateDispatcher
+from .vector_hash import vector_hash
+from .upload_cache import (hash_file, get_input_media, has_upload_attributes,
+                           is_stale_upload_error, store_upload, refresh_upload)
 
 
 def ignore_coro(coro):
@@ -0,0 +1,158 @@
+# -*- coding: future_fstrings -*-
+# mautrix-telegram - A Matrix-Telegram puppeting bridge
+# Copyright (C) 2019 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import Dict, Optional, Tuple
+from collections import OrderedDict
+import logging
+import asyncio
+import time
+
+from ..types import MatrixEventID, TelegramID
+from ..db import DedupClaim
+from .. import metrics
+
+DedupMXID = Tuple[MatrixEventID, TelegramID]
+DedupKey = Tuple[TelegramID, TelegramID, str]
+Entry = Tuple[float, Optional[DedupMXID]]
+
+NOT_FOUND = (MatrixEventID("None"), TelegramID(0))  # type: DedupMXID
+
+
+class DedupStore:
+    """Remembers recently bridged Telegram events to skip the copies received by other users.
+
+    All portals share one store, so the ``max_entries`` budget goes to the portals that are
+    actually busy instead of being split evenly. Entries are evicted in insertion order when
+    there are too many of them or when they're older than ``max_age`` seconds.
+
+    With ``persist`` enabled, entries with a real Matrix event ID are also written to the
+    database in the background and loaded back on startup, so catching up after a restart
+    doesn't bridge the same messages again.
+    """
+    log = logging.getLogger("mau.dedup")  # type: logging.Logger
+
+    def __init__(self, max_entries: int = 100000, max_age: int = 24 * 60 * 60,
+                 persist: bool = False, loop: Optional[asyncio.AbstractEventLoop] = None
+                 ) -> None:
+        self.max_entries = max_entries  # type: int
+        self.max_age = max_age  # type: int
+        self.persist = persist  # type: bool
+        self.loop = loop  # type: Optional[asyncio.AbstractEventLoop]
+        self._entries = OrderedDict()  # type: Dict[DedupKey, Entry]
+
+        self.hits = 0  # type: int
+        self.misses = 0  # type: int
+        self.evictions = 0  # type: int
+
+    @property
+    def size(self) -> int:
+        return len(self._entries)
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "size": self.size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hit_rate,
+        }
+
+    def _evict(self, now: float) -> None:
+        cutoff = now - self.max_age
+        while self._entries:
+            timestamp, _ = next(iter(self._entries.values()))
+            if len(self._entries) <= self.max_entries and timestamp >= cutoff:
+                break
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def _store(self, key: DedupKey, mxid: Optional[DedupMXID]) -> None:
+        if not self.persist:
+            return
+        tgid, tg_receiver, evt_hash = key
+        event_id, tg_space = mxid or (None, None)
+        asyncio.ensure_future(self._run_store(tgid, tg_receiver, evt_hash, event_id, tg_space),
+                              loop=self.loop)
+
+    async def _run_store(self, *args) -> None:
+        try:
+            await DedupClaim.aio.store(*args)
+        except Exception:
+            self.log.exception("Failed to persist dedup entry")
+
+    def check(self, key: DedupKey, mxid: Optional[DedupMXID], kind: str = "message",
+              persist: bool = True) -> Tuple[bool, Optional[DedupMXID]]:
+        """Check if an event has been seen, and remember it if it hasn't.
+
+        Args:
+            key: The portal ID, receiver and hash of the event.
+            mxid: The Matrix event ID and Telegram ID space to store for the event.
+            kind: The kind of event for the dedup lookup metrics.
+            persist: Whether to write the entry to the database. Temporary IDs that will be
+                replaced with :meth:`update` shouldn't be persisted.
+
+        Returns:
+            Whether the event was seen before, and the value stored for it if it was.
+        """
+        now = time.monotonic()
+        self._evict(now)
+        try:
+            _, found = self._entries[key]
+        except KeyError:
+            self.misses += 1
+            metrics.count_dedup(kind, hit=False)
+            self._entries[key] = (now, mxid)
+            self._evict(now)
+            if persist:
+                self._store(key, mxid)
+            return False, None
+        self.hits += 1
+        metrics.count_dedup(kind, hit=True)
+        return True, found
+
+    def update(self, key: DedupKey, mxid: DedupMXID, expected_mxid: Optional[DedupMXID]
+               ) -> Optional[DedupMXID]:
+        """Replace the stored value of an event if it's still ``expected_mxid``.
+
+        Returns:
+            ``None`` if the value was replaced, otherwise the value that was found.
+        """
+        try:
+            timestamp, found = self._entries[key]
+        except KeyError:
+            return NOT_FOUND
+        if found != expected_mxid:
+            return found
+        # Assigning an existing key keeps its position, so the entry still expires based on when
+        # the event was first seen.
+        self._entries[key] = (timestamp, mxid)
+        self._store(key, mxid)
+        return None
+
+    def load(self) -> None:
+        """Load the newest persisted entries from the database."""
+        now, wall_now = time.monotonic(), time.time()
+        rows = list(DedupClaim.get_recent(self.max_age, self.max_entries))
+        for row in reversed(rows):
+            mxid = (row.mxid, row.tg_space) if row.mxid else None
+            self._entries[(row.tgid, row.tg_receiver, row.evt_hash)] = (
+                now - (wall_now - row.timestamp), mxid)
+        self.log.debug(f"Loaded {len(rows)} dedup entries from the database")
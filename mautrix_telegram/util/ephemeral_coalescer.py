@@ -0,0 +1,140 @@
+# -*- coding: future_fstrings -*-
+# mautrix-telegram - A Matrix-Telegram puppeting bridge
+# Copyright (C) 2019 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional, Tuple
+from collections import OrderedDict
+import asyncio
+import logging
+
+Sender = Callable[[], Awaitable[Any]]
+Pending = Tuple[Hashable, Sender, Optional[float]]
+
+
+class EphemeralCoalescer:
+    """Coalesces ephemeral state changes like typing notifications and presence.
+
+    Changes are collected for ``delay`` seconds and only the latest state of each key (e.g. a user
+    in a room) is sent. A state that's the same as the last sent one is skipped, unless it was
+    sent more than ``refresh`` seconds ago. When any of the ``overload_checks`` returns true, the
+    collected changes are dropped instead of sent, so that they don't compete with messages.
+    """
+    log = logging.getLogger("mau.ephemeral")  # type: logging.Logger
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, delay: float = 0.5,
+                 max_tracked: int = 10000) -> None:
+        self.loop = loop  # type: asyncio.AbstractEventLoop
+        self.delay = delay  # type: float
+        self.max_tracked = max_tracked  # type: int
+        self.overload_checks = []  # type: List[Callable[[], bool]]
+
+        self._pending = OrderedDict()  # type: Dict[Hashable, Pending]
+        self._sent = OrderedDict()  # type: Dict[Hashable, Tuple[Hashable, float]]
+        self._flush_handle = None  # type: Optional[asyncio.Handle]
+
+        self.sent = 0  # type: int
+        self.coalesced = 0  # type: int
+        self.suppressed = 0  # type: int
+        self.shed = 0  # type: int
+
+    @property
+    def overloaded(self) -> bool:
+        return any(check() for check in self.overload_checks)
+
+    @property
+    def pending(self) -> int:
+        return len(self._pending)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "pending": self.pending,
+            "tracked": len(self._sent),
+            "sent": self.sent,
+            "coalesced": self.coalesced,
+            "suppressed": self.suppressed,
+            "shed": self.shed,
+        }
+
+    def set(self, key: Hashable, state: Hashable, send: Sender,
+            refresh: Optional[float] = None) -> None:
+        """Queue a state change. It replaces any queued change of the same key.
+
+        Args:
+            key: The thing whose state changed, e.g. ``("typing", room_id, user_id)``.
+            state: The new state. Must be comparable to the previous states of the same key.
+            send: A function that sends the change.
+            refresh: The number of seconds after which the same state is sent again (e.g. because
+                it expires on the other side), or ``None`` if it never needs to be resent.
+        """
+        if key in self._pending:
+            self.coalesced += 1
+        self._pending[key] = (state, send, refresh)
+        if not self._flush_handle:
+            self._flush_handle = self.loop.call_later(self.delay, self._flush)
+
+    async def set_now(self, key: Hashable, state: Hashable, send: Sender,
+                      default: Hashable = None) -> None:
+        """Send a state change right away, unless it wouldn't change anything.
+
+        Any queued change of the key is discarded. Unknown keys are assumed to be in the
+        ``default`` state, which means that e.g. stopping typing can be skipped for users that
+        weren't typing in the first place.
+        """
+        if self._pending.pop(key, None):
+            self.coalesced += 1
+        if self._sent.get(key, (default,))[0] == state:
+            self.suppressed += 1
+            return
+        self._remember(key, state)
+        await self._send(key, send)
+
+    def _is_noop(self, key: Hashable, state: Hashable, refresh: Optional[float]) -> bool:
+        try:
+            sent_state, sent_at = self._sent[key]
+        except KeyError:
+            return False
+        return sent_state == state and (refresh is None or self.loop.time() - sent_at < refresh)
+
+    def _remember(self, key: Hashable, state: Hashable) -> None:
+        self._sent[key] = (state, self.loop.time())
+        self._sent.move_to_end(key)
+        while len(self._sent) > self.max_tracked:
+            # Forgetting a key only means that its next change can't be suppressed.
+            self._sent.popitem(last=False)
+
+    def _flush(self) -> None:
+        self._flush_handle = None
+        pending, self._pending = self._pending, OrderedDict()
+        if not pending:
+            return
+        elif self.overloaded:
+            self.shed += len(pending)
+            self.log.debug(f"Dropped {len(pending)} ephemeral changes, as the bridge is busy")
+            return
+        for key, (state, send, refresh) in pending.items():
+            if self._is_noop(key, state, refresh):
+                self.suppressed += 1
+                continue
+            self._remember(key, state)
+            asyncio.ensure_future(self._send(key, send), loop=self.loop)
+
+    async def _send(self, key: Hashable, send: Sender) -> None:
+        self.sent += 1
+        try:
+            await send()
+        except Exception:
+            # The other side is in an unknown state, so the next change must not be suppressed.
+            self._sent.pop(key, None)
+            self.log.debug(f"Failed to send ephemeral change of {key}", exc_info=True)
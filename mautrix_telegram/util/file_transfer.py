@@ -14,7 +14,9 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
-from typing import Optional, Tuple, Union, Dict
+from typing import Any, BinaryIO, Callable, Optional, Tuple, TypeVar, Union, Dict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from io import BytesIO
 import time
 import logging
@@ -28,9 +30,11 @@ from telethon.tl.types import (Document, FileLocation, InputFileLocation, InputD
 from telethon.errors import (AuthBytesInvalidError, AuthKeyInvalidError, LocationInvalidError,
                              SecurityError)
 from mautrix_appservice import IntentAPI
+from mautrix_appservice.errors import MatrixResponseError
 
-from ..tgclient import MautrixTelegramClient
+from ..tgclient import MautrixTelegramClient, DownloadIterator
 from ..db import TelegramFile as DBTelegramFile
+from .. import context as c, metrics
 
 try:
     from PIL import Image
@@ -48,11 +52,76 @@ except ImportError:
 log = logging.getLogger("mau.util")  # type: logging.Logger
 
 TypeLocation = Union[Document, InputDocumentFileLocation, FileLocation, InputFileLocation]
+T = TypeVar("T")
+
+media_pool = None  # type: Optional[ProcessPoolExecutor]
+media_pool_workers = 0  # type: int
+media_semaphore = None  # type: Optional[asyncio.Semaphore]
+media_timeout = 30  # type: float
+
+
+def _restart_media_pool(pool: ProcessPoolExecutor) -> None:
+    """Replace a broken or stuck media process pool with a new one.
+
+    The worker processes of the old pool are killed, as a stuck task would otherwise keep its
+    worker forever. Other tasks that were running in the old pool fail with BrokenProcessPool,
+    which doesn't restart the pool again, since it has already been replaced.
+    """
+    global media_pool
+    if media_pool is not pool:
+        return
+    media_pool = ProcessPoolExecutor(max_workers=media_pool_workers)
+    # ProcessPoolExecutor can't cancel running tasks, so the processes are killed directly.
+    for process in list((getattr(pool, "_processes", None) or {}).values()):
+        process.terminate()
+    pool.shutdown(wait=False)
+
+
+async def _run_media_task(func: Callable[..., T], *args: Any, fallback: T) -> T:
+    """Run a CPU-bound media transformation in the media process pool.
+
+    If the task fails or doesn't finish in time, ``fallback`` is returned instead. Tasks can't be
+    cancelled, so the pool is replaced when a task times out.
+    """
+    if not media_pool:
+        try:
+            return func(*args)
+        except Exception:
+            log.exception(f"Failed to run {func.__name__}")
+            return fallback
+
+    async with media_semaphore:
+        loop = asyncio.get_event_loop()
+        pool = media_pool
+        try:
+            return await asyncio.wait_for(loop.run_in_executor(pool, func, *args),
+                                          timeout=media_timeout)
+        except asyncio.TimeoutError:
+            log.warning(f"{func.__name__} didn't finish in {media_timeout} seconds, "
+                        "restarting the media process pool")
+            _restart_media_pool(pool)
+        except BrokenProcessPool:
+            if media_pool is pool:
+                log.exception(f"Media process pool broke while running {func.__name__}, "
+                              "restarting it")
+            _restart_media_pool(pool)
+        except Exception:
+            log.exception(f"Failed to run {func.__name__}")
+    return fallback
+
+
+async def convert_image(file: bytes, source_mime: str = "image/webp", target_type: str = "png",
+                        thumbnail_to: Optional[Tuple[int, int]] = None
+                        ) -> Tuple[str, bytes, Optional[int], Optional[int]]:
+    if not Image:
+        return source_mime, file, None, None
+    return await _run_media_task(_convert_image, file, source_mime, target_type, thumbnail_to,
+                                 fallback=(source_mime, file, None, None))
 
 
-def convert_image(file: bytes, source_mime: str = "image/webp", target_type: str = "png",
-                  thumbnail_to: Optional[Tuple[int, int]] = None
-                  ) -> Tuple[str, bytes, Optional[int], Optional[int]]:
+def _convert_image(file: bytes, source_mime: str = "image/webp", target_type: str = "png",
+                   thumbnail_to: Optional[Tuple[int, int]] = None
+                   ) -> Tuple[str, bytes, Optional[int], Optional[int]]:
     if not Image:
         return source_mime, file, None, None
     try:
@@ -74,15 +143,17 @@ def _temp_file_name(ext: str) -> str:
             + ext)
 
 
-def _read_video_thumbnail(data: bytes, video_ext: str = "mp4", frame_ext: str = "png",
-                          max_size: Tuple[int, int] = (1024, 720)) -> Tuple[bytes, int, int]:
-    # We don't have any way to read the video from memory, so save it to disk.
-    temp_file = _temp_file_name(video_ext)
-    with open(temp_file, "wb") as file:
-        file.write(data)
+async def read_video_thumbnail(video_path: str, frame_ext: str = "png",
+                               max_size: Tuple[int, int] = (1024, 720)
+                               ) -> Optional[Tuple[bytes, int, int]]:
+    return await _run_media_task(_read_video_thumbnail, video_path, frame_ext, max_size,
+                                 fallback=None)
+
 
-    # Read temp file and get frame
-    clip = VideoFileClip(temp_file)
+def _read_video_thumbnail(video_path: str, frame_ext: str = "png",
+                          max_size: Tuple[int, int] = (1024, 720)) -> Tuple[bytes, int, int]:
+    # Read the video file and get the first frame
+    clip = VideoFileClip(video_path)
     frame = clip.get_frame(0)
 
     # Convert to png and save to BytesIO
@@ -92,8 +163,6 @@ def _read_video_thumbnail(data: bytes, video_ext: str = "mp4", frame_ext: str =
         image.thumbnail(max_size, Image.ANTIALIAS)
     image.save(thumbnail_file, frame_ext)
 
-    os.remove(temp_file)
-
     w, h = image.size
     return thumbnail_file.getvalue(), w, h
 
@@ -106,8 +175,8 @@ def _location_to_id(location: TypeLocation) -> str:
 
 
 async def transfer_thumbnail_to_matrix(client: MautrixTelegramClient, intent: IntentAPI,
-                                       thumbnail_loc: TypeLocation, video: bytes,
-                                       mime: str) -> Optional[DBTelegramFile]:
+                                       thumbnail_loc: TypeLocation, video_path: Optional[str]
+                                       ) -> Optional[DBTelegramFile]:
     if not Image or not VideoFileClip:
         return None
 
@@ -115,16 +184,15 @@ async def transfer_thumbnail_to_matrix(client: MautrixTelegramClient, intent: In
     if not loc_id:
         return None
 
-    db_file = DBTelegramFile.get(loc_id)
+    db_file = await DBTelegramFile.aio.get(loc_id)
     if db_file:
         return db_file
 
-    video_ext = mimetypes.guess_extension(mime)
-    if VideoFileClip and video_ext:
-        try:
-            file, width, height = _read_video_thumbnail(video, video_ext, frame_ext="png")
-        except OSError:
+    if video_path:
+        thumbnail = await read_video_thumbnail(video_path, frame_ext="png")
+        if not thumbnail:
             return None
+        file, width, height = thumbnail
         mime_type = "image/png"
     else:
         file = await client.download_file(thumbnail_loc)
@@ -137,7 +205,7 @@ async def transfer_thumbnail_to_matrix(client: MautrixTelegramClient, intent: In
                              was_converted=False, timestamp=int(time.time()), size=len(file),
                              width=width, height=height)
     try:
-        db_file.insert()
+        await db_file.aio.insert()
     except (IntegrityError, InvalidRequestError) as e:
         log.exception(f"{e.__class__.__name__} while saving transferred file thumbnail data. "
                       "This was probably caused by two simultaneous transfers of the same file, "
@@ -152,12 +220,13 @@ TypeThumbnail = Optional[Union[TypeLocation, TypePhotoSize]]
 
 async def transfer_file_to_matrix(client: MautrixTelegramClient, intent: IntentAPI,
                                   location: TypeLocation, thumbnail: TypeThumbnail = None,
-                                  is_sticker: bool = False) -> Optional[DBTelegramFile]:
+                                  is_sticker: bool = False, file_size: Optional[int] = None
+                                  ) -> Optional[DBTelegramFile]:
     location_id = _location_to_id(location)
     if not location_id:
         return None
 
-    db_file = DBTelegramFile.get(location_id)
+    db_file = await DBTelegramFile.aio.get(location_id)
     if db_file:
         return db_file
 
@@ -168,53 +237,169 @@ async def transfer_file_to_matrix(client: MautrixTelegramClient, intent: IntentA
         transfer_locks[location_id] = lock
     async with lock:
         return await _unlocked_transfer_file_to_matrix(client, intent, location_id, location,
-                                                       thumbnail, is_sticker)
+                                                       thumbnail, is_sticker, file_size)
+
+
+class _UploadStream:
+    """Feeds the chunks of a Telegram download into an aiohttp request body.
+
+    The chunk that was already read for MIME sniffing is sent first. If ``tee_path`` is set, the
+    chunks are also written to that file (used for reading video thumbnails). The file is written
+    in the default executor, so that the disk doesn't block the event loop.
+    """
+
+    def __init__(self, first_chunk: bytes, download: DownloadIterator,
+                 tee_path: Optional[str] = None) -> None:
+        self.first_chunk = first_chunk  # type: Optional[bytes]
+        self.download = download  # type: DownloadIterator
+        self.tee_path = tee_path  # type: Optional[str]
+        self.tee = None  # type: Optional[BinaryIO]
+        self.size = 0  # type: int
+        self.loop = asyncio.get_event_loop()  # type: asyncio.AbstractEventLoop
+
+    def __aiter__(self) -> '_UploadStream':
+        return self
+
+    async def __anext__(self) -> bytes:
+        if self.first_chunk is not None:
+            chunk, self.first_chunk = self.first_chunk, None
+        else:
+            try:
+                chunk = await self.download.__anext__()
+            except StopAsyncIteration:
+                await self.close_tee()
+                raise
+        self.size += len(chunk)
+        if self.tee_path:
+            if not self.tee:
+                self.tee = await self.loop.run_in_executor(None, open, self.tee_path, "wb")
+            await self.loop.run_in_executor(None, self.tee.write, chunk)
+        return chunk
+
+    async def close_tee(self) -> None:
+        if self.tee:
+            tee, self.tee = self.tee, None
+            await self.loop.run_in_executor(None, tee.close)
+        self.tee_path = None
+
+
+async def _upload_stream(intent: IntentAPI, stream: _UploadStream, mime_type: str,
+                         size: int) -> str:
+    await intent.ensure_registered()
+    # The media repo needs to know the length in advance, as it won't accept chunked uploads.
+    resp = await intent.client.request("POST", "", content=stream,
+                                       headers={"Content-Type": mime_type,
+                                                "Content-Length": str(size)},
+                                       api_path="/_matrix/media/r0/upload")
+    try:
+        return resp["content_uri"]
+    except KeyError:
+        raise MatrixResponseError("Media repo upload response did not contain content_uri.")
+
+
+def _video_temp_path(mime_type: str, thumbnail: TypeThumbnail) -> Optional[str]:
+    if not thumbnail or not VideoFileClip or not Image:
+        return None
+    elif not mime_type.startswith("video/") and mime_type != "image/gif":
+        return None
+    video_ext = mimetypes.guess_extension(mime_type)
+    return _temp_file_name(video_ext) if video_ext else None
 
 
 async def _unlocked_transfer_file_to_matrix(client: MautrixTelegramClient, intent: IntentAPI,
                                             loc_id: str, location: TypeLocation,
-                                            thumbnail: TypeThumbnail, is_sticker: bool
-                                            ) -> Optional[DBTelegramFile]:
-    db_file = DBTelegramFile.get(loc_id)
+                                            thumbnail: TypeThumbnail, is_sticker: bool,
+                                            file_size: Optional[int]) -> Optional[DBTelegramFile]:
+    db_file = await DBTelegramFile.aio.get(loc_id)
     if db_file:
         return db_file
 
+    start = time.perf_counter()
+    file_size = file_size or getattr(location, "size", None)
+    download = client.iter_download(location, file_size=file_size)
+    video_path = None
     try:
-        file = await client.download_file(location)
+        try:
+            first_chunk = await download.__anext__()
+        except StopAsyncIteration:
+            first_chunk = b""
+
+        width, height = None, None
+        mime_type = magic.from_buffer(first_chunk, mime=True)
+        image_converted = False
+
+        if file_size and mime_type != "image/webp":
+            # Stream the file to the media repo, so only a few chunks are in memory at a time.
+            video_path = _video_temp_path(mime_type, thumbnail)
+            stream = _UploadStream(first_chunk, download, tee_path=video_path)
+            try:
+                content_uri = await _upload_stream(intent, stream, mime_type, file_size)
+            finally:
+                await stream.close_tee()
+            size = stream.size
+        else:
+            # The size is needed for the upload and stickers have to be converted, so read the
+            # whole file. These are small files, i.e. photos and stickers.
+            file = BytesIO()
+            file.write(first_chunk)
+            async for chunk in download:
+                file.write(chunk)
+            file = file.getvalue()
+            if mime_type == "image/webp":
+                new_mime_type, file, width, height = await convert_image(
+                    file, source_mime="image/webp", target_type="png",
+                    thumbnail_to=(256, 256) if is_sticker else None)
+                image_converted = new_mime_type != mime_type
+                mime_type = new_mime_type
+                thumbnail = None
+            else:
+                video_path = _video_temp_path(mime_type, thumbnail)
+                if video_path:
+                    with open(video_path, "wb") as video_file:
+                        video_file.write(file)
+            content_uri = await intent.upload_file(file, mime_type)
+            size = len(file)
+        metrics.observe_file_transfer("telegram_to_matrix", size, time.perf_counter() - start)
+
+        db_file = DBTelegramFile(id=loc_id, mxc=content_uri,
+                                 mime_type=mime_type, was_converted=image_converted,
+                                 timestamp=int(time.time()), size=size,
+                                 width=width, height=height)
+        if thumbnail and (mime_type.startswith("video/") or mime_type == "image/gif"):
+            if isinstance(thumbnail, (PhotoSize, PhotoCachedSize)):
+                thumbnail = thumbnail.location
+            db_file.thumbnail = await transfer_thumbnail_to_matrix(client, intent, thumbnail,
+                                                                   video_path)
     except LocationInvalidError:
         return None
     except (AuthBytesInvalidError, AuthKeyInvalidError, SecurityError) as e:
         log.exception(f"{e.__class__.__name__} while downloading a file.")
         return None
-
-    width, height = None, None
-    mime_type = magic.from_buffer(file, mime=True)
-
-    image_converted = False
-    if mime_type == "image/webp":
-        new_mime_type, file, width, height = convert_image(
-            file, source_mime="image/webp", target_type="png",
-            thumbnail_to=(256, 256) if is_sticker else None)
-        image_converted = new_mime_type != mime_type
-        mime_type = new_mime_type
-        thumbnail = None
-
-    content_uri = await intent.upload_file(file, mime_type)
-
-    db_file = DBTelegramFile(id=loc_id, mxc=content_uri,
-                             mime_type=mime_type, was_converted=image_converted,
-                             timestamp=int(time.time()), size=len(file),
-                             width=width, height=height)
-    if thumbnail and (mime_type.startswith("video/") or mime_type == "image/gif"):
-        if isinstance(thumbnail, (PhotoSize, PhotoCachedSize)):
-            thumbnail = thumbnail.location
-        db_file.thumbnail = await transfer_thumbnail_to_matrix(client, intent, thumbnail, file,
-                                                               mime_type)
+    finally:
+        await download.close()
+        if video_path and os.path.exists(video_path):
+            os.remove(video_path)
 
     try:
-        db_file.insert()
+        await db_file.aio.insert()
     except (IntegrityError, InvalidRequestError) as e:
         log.exception(f"{e.__class__.__name__} while saving transferred file data. "
                       "This was probably caused by two simultaneous transfers of the same file, "
                       "and should not cause any problems.")
     return db_file
+
+
+def init(context: 'c.Context') -> None:
+    global media_pool, media_pool_workers, media_semaphore, media_timeout
+    config = context.config
+    media_pool_workers = config.get("bridge.media_processing.workers", 2)
+    media_timeout = config.get("bridge.media_processing.timeout", 30)
+    if media_pool_workers > 0:
+        media_pool = ProcessPoolExecutor(max_workers=media_pool_workers)
+        media_semaphore = asyncio.Semaphore(
+            config.get("bridge.media_processing.max_concurrent", 4))
+
+
+def stop() -> None:
+    if media_pool:
+        media_pool.shutdown(wait=False)
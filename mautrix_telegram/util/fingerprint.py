@@ -0,0 +1,162 @@
+# -*- coding: future_fstrings -*-
+# mautrix-telegram - A Matrix-Telegram puppeting bridge
+# Copyright (C) 2019 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import Any, Callable, Dict, List, Optional, Type, Union
+import hashlib
+import struct
+
+from telethon.tl.types import (
+    GeoPoint, MessageService, MessageActionBotAllowed, MessageActionChannelCreate,
+    MessageActionChannelMigrateFrom, MessageActionChatAddUser, MessageActionChatCreate,
+    MessageActionChatDeletePhoto, MessageActionChatDeleteUser, MessageActionChatEditPhoto,
+    MessageActionChatEditTitle, MessageActionChatJoinedByLink, MessageActionChatMigrateTo,
+    MessageActionContactSignUp, MessageActionCustomAction, MessageActionEmpty,
+    MessageActionGameScore, MessageActionHistoryClear, MessageActionPaymentSent,
+    MessageActionPhoneCall, MessageActionPinMessage, MessageActionScreenshotTaken,
+    MessageMediaContact, MessageMediaDocument, MessageMediaEmpty, MessageMediaGame,
+    MessageMediaGeo, MessageMediaGeoLive, MessageMediaInvoice, MessageMediaPhoto,
+    MessageMediaPoll, MessageMediaUnsupported, MessageMediaVenue, MessageMediaWebPage)
+from telethon.tl.patched import Message
+from telethon.tl.tlobject import TLObject
+
+try:
+    from xxhash import xxh64_hexdigest as _hexdigest
+except ImportError:
+    def _hexdigest(data: bytes) -> str:
+        return hashlib.blake2b(data, digest_size=8).hexdigest()
+
+FieldEncoder = Callable[[Any], bytes]
+
+_INT = struct.Struct("<q")
+_INTS = (b"", _INT, struct.Struct("<qq"), struct.Struct("<qqq"))
+_GEO = struct.Struct("<dd")
+_LENGTH = struct.Struct("<I")
+_HEADER = struct.Struct("<qqI")
+_MESSAGE_SERVICE = MessageService.CONSTRUCTOR_ID
+
+
+def _ints(*values: Optional[int]) -> bytes:
+    # None is encoded as zero, which is never a valid ID.
+    return _INTS[len(values)].pack(*(value or 0 for value in values))
+
+
+def _int_list(values: List[int]) -> bytes:
+    return _LENGTH.pack(len(values)) + struct.pack(f"<{len(values)}q", *values)
+
+
+def _str(*values: Optional[str]) -> bytes:
+    # Strings are prefixed with their length so that different combinations of strings can't
+    # produce the same bytes.
+    parts = []
+    for value in values:
+        data = (value or "").encode("utf-8")
+        parts.append(_LENGTH.pack(len(data)))
+        parts.append(data)
+    return b"".join(parts)
+
+
+def _geo(geo: Any) -> bytes:
+    return _GEO.pack(geo.long, geo.lat) if isinstance(geo, GeoPoint) else b""
+
+
+def _id(obj: Any) -> bytes:
+    # Empty photos and documents still have an ID.
+    return _INT.pack(obj.id) if obj else b""
+
+
+def _by_constructor(encoders: Dict[Type[TLObject], FieldEncoder]) -> Dict[int, FieldEncoder]:
+    # Subclasses like the patched message types share the constructor ID of the raw type.
+    return {tl_type.CONSTRUCTOR_ID: encoder for tl_type, encoder in encoders.items()}
+
+
+# Only fields that are the same for every receiver of the message may be included here. For
+# example, web page previews are left out, because some clients may get the preview later.
+_MEDIA_FIELDS = _by_constructor({
+    MessageMediaEmpty: lambda media: b"",
+    MessageMediaUnsupported: lambda media: b"",
+    MessageMediaPhoto: lambda media: _id(media.photo),
+    MessageMediaDocument: lambda media: _id(media.document),
+    MessageMediaGeo: lambda media: _geo(media.geo),
+    MessageMediaGeoLive: lambda media: _geo(media.geo) + _ints(media.period),
+    MessageMediaVenue: lambda media: _geo(media.geo) + _str(media.title, media.address,
+                                                            media.venue_id),
+    MessageMediaContact: lambda media: _ints(media.user_id) + _str(media.phone_number,
+                                                                   media.first_name,
+                                                                   media.last_name),
+    MessageMediaGame: lambda media: _ints(media.game.id),
+    MessageMediaPoll: lambda media: _ints(media.poll.id),
+    MessageMediaInvoice: lambda media: (_ints(media.total_amount)
+                                        + _str(media.title, media.currency)),
+    MessageMediaWebPage: lambda media: b"",
+})
+
+_ACTION_FIELDS = _by_constructor({
+    MessageActionEmpty: lambda action: b"",
+    MessageActionChatCreate: lambda action: _int_list(action.users) + _str(action.title),
+    MessageActionChannelCreate: lambda action: _str(action.title),
+    MessageActionChatEditTitle: lambda action: _str(action.title),
+    MessageActionChatEditPhoto: lambda action: _id(action.photo),
+    MessageActionChatDeletePhoto: lambda action: b"",
+    MessageActionChatAddUser: lambda action: _int_list(action.users),
+    MessageActionChatDeleteUser: lambda action: _ints(action.user_id),
+    MessageActionChatJoinedByLink: lambda action: _ints(action.inviter_id),
+    MessageActionChatMigrateTo: lambda action: _ints(action.channel_id),
+    MessageActionChannelMigrateFrom: lambda action: _ints(action.chat_id) + _str(action.title),
+    MessageActionPinMessage: lambda action: b"",
+    MessageActionHistoryClear: lambda action: b"",
+    MessageActionGameScore: lambda action: _ints(action.game_id, action.score),
+    MessageActionPaymentSent: lambda action: _ints(action.total_amount) + _str(action.currency),
+    MessageActionPhoneCall: lambda action: _ints(action.call_id, action.duration),
+    MessageActionScreenshotTaken: lambda action: b"",
+    MessageActionCustomAction: lambda action: _str(action.message),
+    MessageActionBotAllowed: lambda action: _str(action.domain),
+    MessageActionContactSignUp: lambda action: b"",
+})
+
+
+def _encode_typed(obj: Optional[TLObject], encoders: Dict[int, FieldEncoder]) -> bytes:
+    if obj is None:
+        return b""
+    constructor = obj.CONSTRUCTOR_ID
+    try:
+        encoder = encoders[constructor]
+    except KeyError:
+        # Types added in newer layers are rare enough that the slow path is fine for them.
+        return _INT.pack(constructor) + _str(str(obj))
+    return _INT.pack(constructor) + encoder(obj)
+
+
+def fingerprint_event(event: Union[Message, MessageService]) -> str:
+    """Get a 64-bit fingerprint of the content of a Telegram message as a hex string.
+
+    Non-channel messages have a different ID for every user who receives them, so the
+    fingerprint only includes the fields that are the same for everyone: the timestamp (which is
+    only accurate to the second), the text and the forward header and media of normal messages,
+    and the sender and action of service messages. The same message always gets the same
+    fingerprint, even in another process.
+
+    The fingerprint uses xxHash if the ``xxhash`` module is installed and an 8-byte BLAKE2b digest
+    otherwise, so all bridge processes sharing a database should have the same set of modules.
+    """
+    timestamp = int(event.date.timestamp()) if event.date else 0
+    if event.CONSTRUCTOR_ID == _MESSAGE_SERVICE:
+        return _hexdigest(_HEADER.pack(_MESSAGE_SERVICE, timestamp, event.from_id or 0)
+                          + _encode_typed(event.action, _ACTION_FIELDS))
+    text = (event.message or "").encode("utf-8")
+    fwd = event.fwd_from
+    return _hexdigest(_HEADER.pack(event.CONSTRUCTOR_ID, timestamp, len(text)) + text
+                      + (_ints(fwd.from_id, fwd.channel_id, fwd.channel_post) if fwd else b"")
+                      + _encode_typed(event.media, _MEDIA_FIELDS))
@@ -0,0 +1,153 @@
+# -*- coding: future_fstrings -*-
+# mautrix-telegram - A Matrix-Telegram puppeting bridge
+# Copyright (C) 2019 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import (Any, Callable, Dict, Hashable, Iterator, List, MutableMapping, Optional, Set,
+                    Tuple, TypeVar)
+from collections import OrderedDict
+import random
+import sys
+
+from .. import metrics
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+
+def _estimate_size(obj: Any, seen: Set[int], depth: int = 3) -> int:
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if depth <= 0:
+        return size
+    if isinstance(obj, dict):
+        for key, value in obj.items():
+            size += _estimate_size(key, seen, depth - 1) + _estimate_size(value, seen, depth - 1)
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        for item in obj:
+            size += _estimate_size(item, seen, depth - 1)
+    else:
+        if hasattr(obj, "__dict__"):
+            size += _estimate_size(obj.__dict__, seen, depth - 1)
+        for cls in type(obj).__mro__:
+            for attr in getattr(cls, "__slots__", ()):
+                size += _estimate_size(getattr(obj, attr, None), seen, depth - 1)
+    return size
+
+
+class InstanceCache(MutableMapping[K, V]):
+    """A size-bounded registry of bridge objects like portals and puppets, which evicts the least
+    recently used objects that aren't pinned.
+
+    The classes using this must be able to load evicted objects from the database again, so
+    objects with state that isn't in the database (like locks or running clients) should be pinned
+    with ``is_pinned``. Pinned objects that would otherwise be evicted are moved to the end of the
+    queue, so they're only checked again after the rest of the cache has been gone through.
+    """
+    all = []  # type: List[InstanceCache]
+
+    def __init__(self, name: str, max_size: int = 0) -> None:
+        self.name = name  # type: str
+        self.max_size = max_size  # type: int
+        self.is_pinned = None  # type: Optional[Callable[[V], bool]]
+        self.on_evict = None  # type: Optional[Callable[[V], None]]
+        self._entries = OrderedDict()  # type: Dict[K, V]
+
+        self.hits = 0  # type: int
+        self.misses = 0  # type: int
+        self.evictions = 0  # type: int
+        InstanceCache.all.append(self)
+
+    def __getitem__(self, key: K) -> V:
+        try:
+            value = self._entries[key]
+        except KeyError:
+            self.misses += 1
+            raise
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return value
+
+    def __setitem__(self, key: K, value: V) -> None:
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        self._evict()
+
+    def __delitem__(self, key: K) -> None:
+        del self._entries[key]
+
+    def __contains__(self, key: Any) -> bool:
+        return key in self._entries
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __iter__(self) -> Iterator[K]:
+        # Copy the keys, so that objects can be removed or loaded while iterating.
+        return iter(list(self._entries))
+
+    def items(self) -> List[Tuple[K, V]]:
+        return list(self._entries.items())
+
+    def values(self) -> List[V]:
+        return list(self._entries.values())
+
+    def discard(self, key: K, value: V) -> None:
+        """Remove a key if it still points to the given object."""
+        if self._entries.get(key) is value:
+            del self._entries[key]
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    def _evict(self) -> None:
+        if self.max_size <= 0:
+            return
+        checked = 0
+        while len(self._entries) > self.max_size and checked < len(self._entries):
+            key, value = next(iter(self._entries.items()))
+            checked += 1
+            if self.is_pinned and self.is_pinned(value):
+                self._entries.move_to_end(key)
+                continue
+            del self._entries[key]
+            self.evictions += 1
+            metrics.count_instance_cache_eviction(self.name)
+            if self.on_evict:
+                self.on_evict(value)
+
+    def estimate_memory(self, sample_size: int = 100) -> int:
+        """Estimate the memory used by the cached objects in bytes from a random sample.
+
+        Objects shared between the sampled objects are only counted once, so this is a rough
+        lower bound rather than an exact number.
+        """
+        if not self._entries:
+            return 0
+        values = list(self._entries.values())
+        sample = random.sample(values, min(sample_size, len(values)))
+        seen = set()  # type: Set[int]
+        sample_size = sum(_estimate_size(value, seen) for value in sample)
+        return sys.getsizeof(self._entries) + sample_size * len(values) // len(sample)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "memory": self.estimate_memory(),
+        }
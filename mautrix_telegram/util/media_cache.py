@@ -0,0 +1,175 @@
+# -*- coding: future_fstrings -*-
+# mautrix-telegram - A Matrix-Telegram puppeting bridge
+# Copyright (C) 2019 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import Dict, Optional
+from collections import OrderedDict
+import hashlib
+import logging
+import asyncio
+import os
+
+from mautrix_appservice import IntentAPI
+
+CHUNK_SIZE = 64 * 1024
+
+
+class MediaCache:
+    """A size-bounded on-disk cache of files downloaded from the Matrix media repo.
+
+    Files are stored by the SHA-256 of their mxc URI and evicted in least recently used order once
+    the total size goes over ``max_size`` bytes. Downloads are streamed to disk, so callers get a
+    path instead of the file contents. Files are pinned from :meth:`acquire` until the matching
+    :meth:`release`, so a path is never evicted while it's still being read.
+    """
+    log = logging.getLogger("mau.media_cache")  # type: logging.Logger
+
+    def __init__(self, path: str, max_size: int,
+                 loop: Optional[asyncio.AbstractEventLoop] = None) -> None:
+        self.path = path  # type: str
+        self.max_size = max_size  # type: int
+        self.loop = loop or asyncio.get_event_loop()  # type: asyncio.AbstractEventLoop
+        self.size = 0  # type: int
+        self._files = OrderedDict()  # type: Dict[str, int]
+        # Number of callers that are using each file.
+        self._pins = {}  # type: Dict[str, int]
+        # Lock for downloading each file, and the number of callers holding or waiting for it.
+        self._locks = {}  # type: Dict[str, asyncio.Lock]
+        self._lock_users = {}  # type: Dict[str, int]
+
+        self.hits = 0  # type: int
+        self.misses = 0  # type: int
+
+        os.makedirs(path, exist_ok=True)
+        self._load()
+
+    def _load(self) -> None:
+        entries = []
+        for entry in os.scandir(self.path):
+            if not entry.is_file():
+                continue
+            elif entry.name.endswith(".part"):
+                # Left over from a download that was interrupted.
+                os.remove(entry.path)
+                continue
+            stat = entry.stat()
+            entries.append((stat.st_mtime, entry.name, stat.st_size))
+        for _, name, size in sorted(entries):
+            self._files[name] = size
+            self.size += size
+        self._evict()
+
+    def _evict(self) -> None:
+        # The most recently used file is never evicted, even if it alone is bigger than max_size.
+        # Pinned files are skipped, and evicted by a later call after they're released.
+        newest = next(reversed(self._files), None)
+        for name in list(self._files):
+            if self.size <= self.max_size:
+                break
+            elif name == newest or name in self._pins:
+                continue
+            size = self._files.pop(name)
+            self.size -= size
+            self.log.debug(f"Evicting {name} ({size} bytes) from media cache")
+            try:
+                os.remove(os.path.join(self.path, name))
+            except FileNotFoundError:
+                pass
+
+    @staticmethod
+    def _file_name(mxc: str) -> str:
+        return hashlib.sha256(mxc.encode("utf-8")).hexdigest()
+
+    def get(self, mxc: str) -> str:
+        """Get the path of a cached file, or an empty string if it isn't cached.
+
+        The file isn't pinned, so it may be evicted by the next download. Use :meth:`acquire` to
+        keep it around while it's being used.
+        """
+        name = self._file_name(mxc)
+        if name not in self._files:
+            return ""
+        path = os.path.join(self.path, name)
+        try:
+            # The modification time is used to restore the LRU order after a restart.
+            os.utime(path)
+        except FileNotFoundError:
+            self.size -= self._files.pop(name)
+            return ""
+        self._files.move_to_end(name)
+        return path
+
+    async def acquire(self, intent: IntentAPI, mxc: str) -> str:
+        """Download a file through the cache and return the path to it.
+
+        The file is pinned until :meth:`release` is called with the same mxc URI.
+        """
+        name = self._file_name(mxc)
+        try:
+            lock = self._locks[name]
+        except KeyError:
+            lock = self._locks[name] = asyncio.Lock()
+        self._lock_users[name] = self._lock_users.get(name, 0) + 1
+        try:
+            async with lock:
+                path = self.get(mxc)
+                if path:
+                    self.hits += 1
+                else:
+                    self.misses += 1
+                    path = await self._download(intent, mxc, name)
+                self._pins[name] = self._pins.get(name, 0) + 1
+                return path
+        finally:
+            # The lock is only removed once nobody is waiting for it, as a new lock would let
+            # another caller download the same file at the same time.
+            self._lock_users[name] -= 1
+            if self._lock_users[name] == 0:
+                del self._lock_users[name]
+                del self._locks[name]
+
+    def release(self, mxc: str) -> None:
+        """Unpin a file returned by :meth:`acquire`, allowing it to be evicted."""
+        name = self._file_name(mxc)
+        self._pins[name] -= 1
+        if self._pins[name] == 0:
+            del self._pins[name]
+            self._evict()
+
+    async def _download(self, intent: IntentAPI, mxc: str, name: str) -> str:
+        await intent.ensure_registered()
+        path = os.path.join(self.path, name)
+        temp_path = f"{path}.part"
+        size = 0
+        file = await self.loop.run_in_executor(None, open, temp_path, "wb")
+        try:
+            try:
+                async with intent.client.session.get(intent.client.get_download_url(mxc)
+                                                     ) as response:
+                    response.raise_for_status()
+                    async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                        await self.loop.run_in_executor(None, file.write, chunk)
+                        size += len(chunk)
+            finally:
+                await self.loop.run_in_executor(None, file.close)
+            await self.loop.run_in_executor(None, os.replace, temp_path, path)
+        except Exception:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        self._files[name] = size
+        self.size += size
+        self._evict()
+        return path
@@ -0,0 +1,85 @@
+# -*- coding: future_fstrings -*-
+# mautrix-telegram - A Matrix-Telegram puppeting bridge
+# Copyright (C) 2019 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import List, Tuple
+from collections import deque
+import asyncio
+import logging
+
+from mautrix_appservice import MatrixRequestError, IntentAPI
+
+from ..types import MatrixEventID, MatrixRoomID
+
+Redaction = Tuple[IntentAPI, MatrixRoomID, MatrixEventID]
+
+
+class RedactionQueue:
+    """Sends redactions in the background with a limited number of parallel requests.
+
+    Requests are started at most ``rate`` times per second, so that a bulk deletion on Telegram
+    (e.g. clearing the history of a chat) doesn't flood the homeserver with redactions.
+    """
+    log = logging.getLogger("mau.redaction_queue")  # type: logging.Logger
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, concurrency: int = 5,
+                 rate: float = 10) -> None:
+        self.loop = loop  # type: asyncio.AbstractEventLoop
+        self.concurrency = max(concurrency, 1)  # type: int
+        self.interval = 1 / rate if rate > 0 else 0  # type: float
+
+        self._queue = deque()  # type: deque
+        self._workers = []  # type: List[asyncio.Future]
+        self._next_start = 0.0  # type: float
+
+        self.redacted = 0  # type: int
+        self.failed = 0  # type: int
+
+    @property
+    def pending(self) -> int:
+        return len(self._queue)
+
+    def redact(self, intent: IntentAPI, room_id: MatrixRoomID, event_id: MatrixEventID) -> None:
+        self._queue.append((intent, room_id, event_id))
+        self._workers = [worker for worker in self._workers if not worker.done()]
+        if len(self._workers) < self.concurrency:
+            self._workers.append(asyncio.ensure_future(self._worker(), loop=self.loop))
+
+    async def join(self) -> None:
+        """Wait until all queued redactions have been sent."""
+        while self._workers:
+            workers, self._workers = self._workers, []
+            await asyncio.gather(*workers)
+
+    async def _wait_for_turn(self) -> None:
+        now = self.loop.time()
+        start = max(now, self._next_start)
+        self._next_start = start + self.interval
+        if start > now:
+            await asyncio.sleep(start - now)
+
+    async def _worker(self) -> None:
+        while self._queue:
+            intent, room_id, event_id = self._queue.popleft()
+            await self._wait_for_turn()
+            try:
+                await intent.redact(room_id, event_id)
+                self.redacted += 1
+            except MatrixRequestError as e:
+                self.failed += 1
+                self.log.debug(f"Failed to redact {event_id} in {room_id}: {e}")
+            except Exception:
+                self.failed += 1
+                self.log.exception(f"Failed to redact {event_id} in {room_id}")
@@ -0,0 +1,310 @@
+# -*- coding: future_fstrings -*-
+# mautrix-telegram - A Matrix-Telegram puppeting bridge
+# Copyright (C) 2019 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+from collections import OrderedDict, deque
+import asyncio
+import logging
+import json
+
+from mautrix_appservice import MatrixRequestError
+from mautrix_appservice.intent_api import HTTPAPI
+
+from .. import metrics
+
+LANE_MESSAGE = 0  # type: int
+LANE_DEFAULT = 1  # type: int
+LANE_EPHEMERAL = 2  # type: int
+LANES = ("message", "default", "ephemeral")
+
+EPHEMERAL_PATHS = ("/typing/", "/presence/", "/receipt/", "/read_markers")
+MESSAGE_PATHS = ("/send/", "/redact/", "/state/")
+# Requests that wait on the server for new data, so they'd hold a slot without doing anything.
+LONG_POLL_PATHS = ("/sync", "/events")
+
+DEFAULT_RETRY_AFTER = 5  # type: float
+
+
+def request_lane(method: str, endpoint: str) -> int:
+    """Get the priority lane of a client-server API request. Lower lanes are sent first."""
+    if any(path in endpoint for path in EPHEMERAL_PATHS):
+        return LANE_EPHEMERAL
+    elif method == "PUT" and any(path in endpoint for path in MESSAGE_PATHS):
+        return LANE_MESSAGE
+    return LANE_DEFAULT
+
+
+def is_long_poll(method: str, endpoint: str) -> bool:
+    """Check whether a request is a long-poll that shouldn't go through the scheduler."""
+    return method == "GET" and endpoint.endswith(LONG_POLL_PATHS)
+
+
+def retry_after(error: MatrixRequestError) -> float:
+    """Get the number of seconds a rate-limited request should wait before it's retried."""
+    try:
+        return json.loads(error.text)["retry_after_ms"] / 1000
+    except (ValueError, KeyError, TypeError):
+        return DEFAULT_RETRY_AFTER
+
+
+class TokenBucket:
+    """A token bucket that allows ``burst`` requests at once and ``rate`` requests per second
+    after that. A rate of zero means no limit."""
+    __slots__ = ("rate", "capacity", "tokens", "updated_at")
+
+    def __init__(self, rate: float, capacity: float, now: float) -> None:
+        self.rate = rate  # type: float
+        self.capacity = max(capacity, 1)  # type: float
+        self.tokens = self.capacity  # type: float
+        self.updated_at = now  # type: float
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def is_full(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+    def delay(self, now: float) -> float:
+        """Get the number of seconds until a token is available."""
+        if self.rate <= 0:
+            return 0
+        self._refill(now)
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self) -> None:
+        if self.rate > 0:
+            self.tokens -= 1
+
+
+class RequestScheduler:
+    """Paces the requests that the bridge makes to the homeserver.
+
+    Requests wait for a token from both the global bucket and the bucket of the user they're sent
+    as, and at most ``max_concurrent`` requests are in flight at once. Waiting requests are taken
+    from the message lane first and from the typing/presence lane last, round-robin between users
+    within a lane. When the homeserver responds with a 429, the user is paused for the time the
+    homeserver asked for and the request is retried, unless its body can only be sent once.
+    """
+    log = logging.getLogger("mau.request_scheduler")  # type: logging.Logger
+    max_buckets = 1000  # type: int
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, max_concurrent: int = 32,
+                 rate: float = 100, burst: float = 200, user_rate: float = 10,
+                 user_burst: float = 50, max_retries: int = 5) -> None:
+        self.loop = loop  # type: asyncio.AbstractEventLoop
+        self.max_concurrent = max(max_concurrent, 1)  # type: int
+        self.user_rate = user_rate  # type: float
+        self.user_burst = user_burst  # type: float
+        self.max_retries = max_retries  # type: int
+
+        self._global = TokenBucket(rate, burst, loop.time())  # type: TokenBucket
+        self._buckets = {}  # type: Dict[str, TokenBucket]
+        self._paused_until = {}  # type: Dict[str, float]
+        self._lanes = [OrderedDict() for _ in LANES]  # type: List[Dict[str, deque]]
+        self._wakeup = None  # type: Optional[asyncio.Event]
+        self._dispatcher = None  # type: Optional[asyncio.Future]
+        self._original_send = None  # type: Optional[Callable[..., Awaitable[dict]]]
+
+        self.queued = 0  # type: int
+        self.in_flight = 0  # type: int
+        self.requests = 0  # type: int
+        self.rate_limited = 0  # type: int
+
+    @property
+    def saturated(self) -> bool:
+        """Whether more requests are waiting than can be in flight at once."""
+        return self.queued >= self.max_concurrent
+
+    def queue_depth(self, lane: int) -> int:
+        return sum(len(queue) for queue in self._lanes[lane].values())
+
+    def stats(self) -> Dict[str, int]:
+        stats = {f"queued_{name}": self.queue_depth(lane) for lane, name in enumerate(LANES)}
+        stats.update(in_flight=self.in_flight, requests=self.requests,
+                     rate_limited=self.rate_limited, paused_users=len(self._paused_until))
+        return stats
+
+    def install(self) -> None:
+        """Send all requests of all :class:`HTTPAPI` instances through this scheduler.
+
+        Long-polls like ``/sync`` are sent directly, as they'd block a slot while they wait."""
+        if self._original_send:
+            return
+        original_send = self._original_send = HTTPAPI._send
+        scheduler = self
+
+        async def _send(api: HTTPAPI, method: str, endpoint: str, content: Any,
+                        query_params: Dict[str, Any], headers: Dict[str, str]) -> dict:
+            if is_long_poll(method, endpoint):
+                return await original_send(api, method, endpoint, content, query_params, headers)
+            user = query_params.get("user_id", None) or api.identity or api.bot_mxid
+            # Streamed bodies (e.g. media uploads) are consumed by the first attempt.
+            retryable = content is None or isinstance(content, (dict, bytes, str))
+            return await scheduler.run(user, request_lane(method, endpoint),
+                                       lambda: original_send(api, method, endpoint, content,
+                                                             query_params, headers),
+                                       retryable=retryable)
+
+        HTTPAPI._send = _send
+
+    def uninstall(self) -> None:
+        if self._original_send:
+            HTTPAPI._send, self._original_send = self._original_send, None
+
+    async def run(self, user: str, lane: int, request: Callable[[], Awaitable[Any]],
+                  retryable: bool = True) -> Any:
+        """Run a request as the given user once the rate limits allow it.
+
+        Args:
+            user: The Matrix user whose rate limits apply to the request.
+            lane: The priority lane of the request (one of the ``LANE_*`` constants).
+            request: A function that sends the request. It's called again for retries.
+            retryable: Whether the request can be sent again after a 429. If not, the user is
+                still paused, but the error is raised.
+
+        Returns:
+            The value returned by the request.
+        """
+        retries = 0
+        while True:
+            # Retries go to the front of the queue, as they've waited long enough already.
+            await self._acquire(user, lane, front=retries > 0)
+            try:
+                return await request()
+            except MatrixRequestError as e:
+                if e.code != 429 or retries >= self.max_retries:
+                    raise
+                self.rate_limited += 1
+                metrics.count_matrix_rate_limit()
+                delay = retry_after(e)
+                self._paused_until[user] = max(self._paused_until.get(user, 0),
+                                               self.loop.time() + delay)
+                if not retryable:
+                    # The next request of the user still waits for the pause to end.
+                    raise
+                retries += 1
+                self.log.debug(f"{user} was rate limited, retrying in {delay} seconds "
+                               f"(attempt {retries}/{self.max_retries})")
+            finally:
+                self._release()
+
+    async def _acquire(self, user: str, lane: int, front: bool = False) -> None:
+        ticket = self.loop.create_future()
+        try:
+            queue = self._lanes[lane][user]
+        except KeyError:
+            queue = self._lanes[lane][user] = deque()
+        if front:
+            queue.appendleft(ticket)
+        else:
+            queue.append(ticket)
+        self.queued += 1
+        self._wake()
+        try:
+            await ticket
+        except asyncio.CancelledError:
+            if ticket.done() and not ticket.cancelled():
+                # The slot was already granted, so it has to be given back.
+                self._release()
+            raise
+
+    def _release(self) -> None:
+        self.in_flight -= 1
+        self._wake()
+
+    def _wake(self) -> None:
+        if self._dispatcher:
+            self._wakeup.set()
+        elif self.queued:
+            self._wakeup = asyncio.Event()
+            self._dispatcher = asyncio.ensure_future(self._dispatch(), loop=self.loop)
+
+    async def _dispatch(self) -> None:
+        try:
+            while self.queued:
+                self._wakeup.clear()
+                delay = self._grant()
+                if not self.queued:
+                    break
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            self._dispatcher = None
+
+    def _bucket(self, user: str, now: float) -> TokenBucket:
+        try:
+            return self._buckets[user]
+        except KeyError:
+            if len(self._buckets) >= self.max_buckets:
+                # A full bucket behaves the same as a new one, so those can be dropped.
+                self._buckets = {key: bucket for key, bucket in self._buckets.items()
+                                 if not bucket.is_full(now)}
+            bucket = self._buckets[user] = TokenBucket(self.user_rate, self.user_burst, now)
+            return bucket
+
+    def _user_delay(self, user: str, now: float) -> float:
+        try:
+            paused = self._paused_until[user] - now
+            if paused > 0:
+                return paused
+            del self._paused_until[user]
+        except KeyError:
+            pass
+        return self._bucket(user, now).delay(now)
+
+    def _grant(self) -> Optional[float]:
+        """Let as many queued requests through as the limits allow.
+
+        Returns:
+            The number of seconds until the next request can be let through, or ``None`` if
+            that depends on a request finishing.
+        """
+        while self.queued and self.in_flight < self.max_concurrent:
+            now = self.loop.time()
+            delay = self._global.delay(now)
+            if delay > 0:
+                return delay
+            delay = self._grant_next(now)
+            if delay is not None:
+                return delay
+        return None
+
+    def _grant_next(self, now: float) -> Optional[float]:
+        next_delay = None  # type: Optional[float]
+        for lane in self._lanes:
+            for user, queue in lane.items():
+                delay = self._user_delay(user, now)
+                if delay > 0:
+                    next_delay = delay if next_delay is None else min(next_delay, delay)
+                    continue
+                ticket = queue.popleft()
+                self.queued -= 1
+                if queue:
+                    lane.move_to_end(user)
+                else:
+                    del lane[user]
+                if not ticket.cancelled():
+                    self._global.take()
+                    self._bucket(user, now).take()
+                    self.in_flight += 1
+                    self.requests += 1
+                    ticket.set_result(None)
+                return None
+        return next_delay
@@ -0,0 +1,81 @@
+# -*- coding: future_fstrings -*-
+# mautrix-telegram - A Matrix-Telegram puppeting bridge
+# Copyright (C) 2019 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import Any, Awaitable, Callable, List, Optional
+from collections import deque
+import logging
+import asyncio
+import random
+import time
+
+log = logging.getLogger("mau.startup")  # type: logging.Logger
+
+StartupTask = Callable[[], Awaitable[Any]]
+
+
+async def run_staggered(name: str, tasks: List[StartupTask], max_concurrent: int = 10,
+                        jitter: float = 0.5, progress_interval: float = 10, action: str = "start",
+                        logger: Optional[logging.Logger] = None) -> int:
+    """Run tasks in order with a limited number running at the same time.
+
+    Each worker waits a random time between 0 and ``jitter`` seconds before starting a task, so
+    that the connections are spread out instead of all being opened in the same instant. Failed
+    tasks are logged and don't stop the others.
+
+    Args:
+        name: The name of the tasks for the progress log messages, e.g. "Telegram clients".
+        tasks: The tasks to run, in the order they should be started.
+        max_concurrent: The maximum number of tasks to run at the same time.
+        jitter: The maximum delay in seconds before each task.
+        progress_interval: How often to log the progress in seconds.
+        action: What the tasks do for the log messages, as a verb with regular "-ing" and "-ed"
+            forms, e.g. "sync".
+        logger: The logger to use instead of the startup logger.
+
+    Returns:
+        The number of tasks that failed.
+    """
+    logger = logger or log
+    total = len(tasks)
+    if total == 0:
+        return 0
+    queue = deque(tasks)
+    done = failed = 0
+    start = last_progress = time.monotonic()
+    logger.info(f"{action.capitalize()}ing {total} {name} ({max_concurrent} at a time)")
+
+    async def worker() -> None:
+        nonlocal done, failed, last_progress
+        while queue:
+            task = queue.popleft()
+            if jitter > 0:
+                await asyncio.sleep(random.uniform(0, jitter))
+            try:
+                await task()
+            except Exception:
+                failed += 1
+                logger.exception(f"Failed to {action} one of the {name}")
+            done += 1
+            now = time.monotonic()
+            if now - last_progress >= progress_interval:
+                last_progress = now
+                logger.info(f"{action.capitalize()}ed {done}/{total} {name} ({failed} failed) "
+                            f"in {round(now - start, 1)} seconds")
+
+    await asyncio.gather(*[worker() for _ in range(max(min(max_concurrent, total), 1))])
+    logger.info(f"{action.capitalize()}ed {total} {name} ({failed} failed) "
+                f"in {round(time.monotonic() - start, 1)} seconds")
+    return failed
@@ -0,0 +1,190 @@
+# -*- coding: future_fstrings -*-
+# mautrix-telegram - A Matrix-Telegram puppeting bridge
+# Copyright (C) 2019 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional, Tuple
+from collections import deque
+import asyncio
+import logging
+
+Handler = Callable[[], Awaitable[Any]]
+# The flag tells whether the entry holds a slot of the ``max_queued`` capacity.
+Entry = Tuple[Handler, bool]
+
+
+class UpdateDispatcher:
+    """Runs handlers in per-key FIFO queues that are drained by a fixed pool of workers.
+
+    Handlers with the same key (e.g. the same portal) are run one at a time in the order they were
+    dispatched, while handlers with different keys run in parallel. When ``max_queued`` handlers
+    are waiting, :meth:`dispatch` blocks until there's room, which pushes back on the caller.
+    Handlers that depend on several queues can be run behind them with :meth:`dispatch_after`.
+    """
+    log = logging.getLogger("mau.dispatcher")  # type: logging.Logger
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, workers: int = 8,
+                 max_queued: int = 1000) -> None:
+        self.loop = loop  # type: asyncio.AbstractEventLoop
+        self.worker_count = workers  # type: int
+        self.max_queued = max_queued  # type: int
+
+        self._queues = {}  # type: Dict[Hashable, deque]
+        self._ready = None  # type: Optional[asyncio.Queue]
+        self._capacity = None  # type: Optional[asyncio.Semaphore]
+        self._workers = []  # type: List[asyncio.Future]
+        self._idle = None  # type: Optional[asyncio.Event]
+
+        self.queued = 0  # type: int
+        self.dispatched = 0  # type: int
+        self.handled = 0  # type: int
+        self.failed = 0  # type: int
+        self.blocked = 0  # type: int
+
+    @property
+    def enabled(self) -> bool:
+        return self.worker_count > 0
+
+    @property
+    def saturated(self) -> bool:
+        """Whether the queue is at least half full, so optional work should be skipped."""
+        return self.enabled and self.queued >= self.max_queued / 2
+
+    @property
+    def active_keys(self) -> int:
+        return len(self._queues)
+
+    @property
+    def max_key_depth(self) -> int:
+        return max((len(queue) for queue in self._queues.values()), default=0)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "queued": self.queued,
+            "active_keys": self.active_keys,
+            "max_key_depth": self.max_key_depth,
+            "dispatched": self.dispatched,
+            "handled": self.handled,
+            "failed": self.failed,
+            "blocked": self.blocked,
+        }
+
+    def _start(self) -> None:
+        self._ready = asyncio.Queue()
+        self._capacity = asyncio.Semaphore(self.max_queued)
+        self._workers = [asyncio.ensure_future(self._worker(), loop=self.loop)
+                         for _ in range(self.worker_count)]
+
+    async def _reserve(self) -> None:
+        if not self._workers:
+            self._start()
+        if self._capacity.locked():
+            self.blocked += 1
+            self.log.debug(f"Update queue full ({self.queued} queued), waiting for room")
+        await self._capacity.acquire()
+        self.queued += 1
+        self.dispatched += 1
+
+    def _enqueue(self, key: Hashable, entry: Entry) -> None:
+        try:
+            self._queues[key].append(entry)
+        except KeyError:
+            # The key isn't queued or being handled, so a worker needs to be told about it.
+            self._queues[key] = deque((entry,))
+            self._ready.put_nowait(key)
+
+    async def dispatch(self, key: Hashable, handler: Handler) -> None:
+        if not self.enabled:
+            await self._run(handler)
+            return
+        await self._reserve()
+        self._enqueue(key, (handler, True))
+
+    async def dispatch_after(self, after: Callable[[Hashable], bool], key: Hashable,
+                             handler: Handler) -> None:
+        """Dispatch a handler once the handlers already queued under some other keys have run.
+
+        Args:
+            after: A function that tells whether the handler must wait for the given key.
+            key: The key to queue the handler under once it's done waiting.
+            handler: The handler to run.
+        """
+        if not self.enabled:
+            await self._run(handler)
+            return
+        waiting_for = [other for other in self._queues if other != key and after(other)]
+        await self._reserve()
+        if not waiting_for:
+            self._enqueue(key, (handler, True))
+            return
+
+        remaining = [len(waiting_for)]
+
+        async def barrier() -> None:
+            remaining[0] -= 1
+            if remaining[0] == 0:
+                # The handler isn't queued until now, so it doesn't hold a worker while waiting.
+                self._enqueue(key, (handler, True))
+
+        for other in waiting_for:
+            # If the key was drained while waiting for capacity, the barrier just runs right away.
+            self._enqueue(other, (barrier, False))
+
+    async def _run(self, handler: Handler) -> None:
+        try:
+            await handler()
+        except Exception:
+            self.failed += 1
+            self.log.exception("Failed to run dispatched handler")
+        else:
+            self.handled += 1
+
+    async def _worker(self) -> None:
+        while True:
+            key = await self._ready.get()
+            queue = self._queues[key]
+            handler, reserved = queue.popleft()
+            try:
+                if reserved:
+                    await self._run(handler)
+                else:
+                    await handler()
+            finally:
+                if reserved:
+                    self.queued -= 1
+                    self._capacity.release()
+                    if not self.queued and self._idle:
+                        self._idle.set()
+                # Only one worker owns a key at a time, which keeps the handlers in order.
+                if queue:
+                    self._ready.put_nowait(key)
+                else:
+                    del self._queues[key]
+
+    async def drain(self, timeout: Optional[float] = None) -> None:
+        """Wait until all dispatched handlers have been run."""
+        if not self.queued:
+            return
+        self._idle = asyncio.Event()
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+        except asyncio.TimeoutError:
+            self.log.warning(f"{self.queued} updates were still queued after {timeout} seconds")
+        finally:
+            self._idle = None
+
+    def stop(self) -> None:
+        for worker in self._workers:
+            worker.cancel()
+        self._workers = []
@@ -0,0 +1,122 @@
+# -*- coding: future_fstrings -*-
+# mautrix-telegram - A Matrix-Telegram puppeting bridge
+# Copyright (C) 2019 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import Optional, Tuple, Union
+import hashlib
+import logging
+import time
+
+from sqlalchemy.exc import IntegrityError
+
+from telethon.errors import RPCError, FileIdInvalidError, MediaEmptyError
+from telethon.tl.types import (Document, InputDocument, InputMediaDocument, InputMediaPhoto,
+                               InputPhoto, MessageMediaDocument, MessageMediaPhoto, Photo,
+                               TypeMessageMedia)
+
+from ..db import UploadedFile as DBUploadedFile, UploadedFileMXC as DBUploadedFileMXC
+from ..types import TelegramID
+
+log = logging.getLogger("mau.util")  # type: logging.Logger
+
+
+def hash_file(file: Union[bytes, str]) -> str:
+    """Hash the contents of a file, given as bytes or as a path."""
+    if isinstance(file, bytes):
+        return hashlib.sha256(file).hexdigest()
+    content_hash = hashlib.sha256()
+    with open(file, "rb") as stream:
+        for chunk in iter(lambda: stream.read(64 * 1024), b""):
+            content_hash.update(chunk)
+    return content_hash.hexdigest()
+
+
+def get_input_media(upload: DBUploadedFile) -> Union[InputMediaPhoto, InputMediaDocument]:
+    if upload.is_photo:
+        return InputMediaPhoto(InputPhoto(upload.id, upload.access_hash, upload.file_reference))
+    return InputMediaDocument(InputDocument(upload.id, upload.access_hash,
+                                            upload.file_reference))
+
+
+def has_upload_attributes(upload: DBUploadedFile, file_name: str,
+                          size: Optional[Tuple[int, int]]) -> bool:
+    """Check if an upload can be reused for a file with the given name and image size.
+
+    Documents keep the attributes they were first uploaded with, so a document with a different
+    name or size has to be uploaded again.
+    """
+    if upload.is_photo:
+        return True
+    return (upload.file_name == file_name
+            and (upload.width, upload.height) == (size or (None, None)))
+
+
+def is_stale_upload_error(error: RPCError) -> bool:
+    """Check if sending a cached upload failed because the reference to it isn't valid anymore.
+
+    The Telethon versions we support don't have separate error classes for file reference
+    errors, so they're detected from the error message.
+    """
+    return (isinstance(error, (FileIdInvalidError, MediaEmptyError))
+            or "FILE_REFERENCE" in (getattr(error, "message", None) or ""))
+
+
+def _get_file(media: Optional[TypeMessageMedia]) -> Optional[Union[Photo, Document]]:
+    if isinstance(media, MessageMediaPhoto) and isinstance(media.photo, Photo):
+        return media.photo
+    elif isinstance(media, MessageMediaDocument) and isinstance(media.document, Document):
+        return media.document
+    return None
+
+
+async def store_upload(owner: TelegramID, content_hash: str, mxc: str, msgtype: str,
+                       mime_type: Optional[str], media: Optional[TypeMessageMedia],
+                       file_name: str, size: Optional[Tuple[int, int]]) -> None:
+    file = _get_file(media)
+    if not file:
+        return
+    upload = DBUploadedFile(owner=owner, content_hash=content_hash, mime_type=mime_type,
+                            is_photo=isinstance(file, Photo), id=file.id,
+                            access_hash=file.access_hash, file_reference=file.file_reference,
+                            timestamp=int(time.time()))
+    if not upload.is_photo:
+        upload.file_name = file_name
+        upload.width, upload.height = size or (None, None)
+    try:
+        await upload.aio.insert()
+        await DBUploadedFileMXC.aio.set(owner, mxc, msgtype, content_hash)
+    except IntegrityError:
+        log.exception("Failed to store uploaded file reference")
+
+
+async def refresh_upload(upload: DBUploadedFile, mxc: Optional[str], msgtype: str,
+                         media: Optional[TypeMessageMedia]) -> None:
+    """Update the stored reference of a reused upload with the one Telegram returned.
+
+    Telegram returns a fresh file reference every time the file is sent, so storing it keeps the
+    reference from expiring as long as the file is used.
+
+    Args:
+        upload: The upload that was reused.
+        mxc: The Matrix URI the upload was found by content for, which will map to the upload
+            from now on. ``None`` if the upload was found by the URI in the first place.
+        msgtype: The message type the file was sent as.
+        media: The media that Telegram returned.
+    """
+    file = _get_file(media)
+    if file and file.id == upload.id and file.file_reference != upload.file_reference:
+        await upload.aio.update(file_reference=file.file_reference, timestamp=int(time.time()))
+    if mxc:
+        await DBUploadedFileMXC.aio.set(upload.owner, mxc, msgtype, upload.content_hash)
@@ -0,0 +1,26 @@
+# -*- coding: future_fstrings -*-
+# mautrix-telegram - A Matrix-Telegram puppeting bridge
+# Copyright (C) 2019 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import Iterable
+
+
+def vector_hash(ids: Iterable[int]) -> int:
+    """Calculate the hash of a list of IDs that Telegram uses to check if a cached list is
+    up-to-date, e.g. for the contact list or a page of channel participants."""
+    acc = 0
+    for item_id in ids:
+        acc = (acc * 20261 + item_id) & 0xffffffff
+    return acc & 0x7fffffff
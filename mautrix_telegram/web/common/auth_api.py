@@ -113,7 +113,10 @@ class AuthAPI(abc.ABC):
         existing_user = User.get_by_tgid(user_info.id)
         if existing_user and existing_user != user:
             await existing_user.log_out()
-        ignore_coro(asyncio.ensure_future(user.post_login(user_info), loop=self.loop))
+        if user.is_remote:
+            await user.hand_off()
+        else:
+            ignore_coro(asyncio.ensure_future(user.post_login(user_info), loop=self.loop))
         if user.command_status and user.command_status["action"] == "Login":
             user.command_status = None
 
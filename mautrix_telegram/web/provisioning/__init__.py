@@ -326,10 +326,11 @@ class ProvisioningAPI(AuthAPI):
                 "title": chat.title,
             } for chat in chats])
         else:
+            chats = (Portal.get_by_tgid(*tgid_full) for tgid_full in user.portals)
             return web.json_response([{
                 "id": get_peer_id(chat.peer),
                 "title": chat.title,
-            } for chat in user.portals.values() if chat.tgid])
+            } for chat in chats if chat and chat.tgid])
 
     async def send_bot_token(self, request: web.Request) -> web.Response:
         data, user, err = await self.get_user_request_info(request)
@@ -7,6 +7,8 @@ extras = {
     "fast_crypto": ["cryptg>=0.1,<0.2"],
     "webp_convert": ["Pillow>=4.3.0,<6"],
     "hq_thumbnails": ["moviepy>=1.0,<2.0"],
+    "metrics": ["prometheus_client>=0.6,<0.7"],
+    "fast_dedup": ["xxhash>=1.3,<2"],
 }
 extras["all"] = list({dep for deps in extras.values() for dep in deps})
 
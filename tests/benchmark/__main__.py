@@ -0,0 +1,46 @@
+import argparse
+import asyncio
+import logging
+import tempfile
+import os
+
+from .harness import BenchmarkOptions, run_benchmark
+
+parser = argparse.ArgumentParser(description="Benchmark the Telegram to Matrix bridging path "
+                                             "with a fake homeserver and fake Telegram clients.",
+                                 prog="python -m tests.benchmark")
+parser.add_argument("--portals", type=int, default=10, help="number of portals")
+parser.add_argument("--users", type=int, default=20, help="number of bridged Matrix users")
+parser.add_argument("--senders", type=int, default=50, help="number of Telegram senders")
+parser.add_argument("--receivers", type=int, default=2,
+                    help="number of bridged users that receive each update")
+parser.add_argument("--updates", type=int, default=1000, help="number of updates to send")
+parser.add_argument("--rate", type=float, default=0,
+                    help="updates per second, or 0 to send as fast as possible")
+parser.add_argument("--concurrency", type=int, default=20,
+                    help="maximum number of updates being handled at the same time")
+parser.add_argument("--photos", type=float, default=0.1, help="ratio of photo messages")
+parser.add_argument("--documents", type=float, default=0.05, help="ratio of document messages")
+parser.add_argument("--edits", type=float, default=0.05, help="ratio of edits")
+parser.add_argument("--deletions", type=float, default=0.05, help="ratio of deletions")
+parser.add_argument("--file-size", type=int, default=512, help="size of files in KiB")
+parser.add_argument("--hs-latency", type=float, default=0,
+                    help="delay of each homeserver response in milliseconds")
+parser.add_argument("--trace-memory", action="store_true",
+                    help="measure the peak Python memory use with tracemalloc (slow)")
+parser.add_argument("--seed", type=int, default=0, help="random seed for the update mix")
+parser.add_argument("-v", "--verbose", action="store_true", help="show bridge log messages")
+args = parser.parse_args()
+
+logging.basicConfig(level=logging.DEBUG if args.verbose else logging.CRITICAL)
+options = BenchmarkOptions(portals=args.portals, users=args.users, senders=args.senders,
+                           receivers=args.receivers, updates=args.updates, rate=args.rate,
+                           concurrency=args.concurrency, photo_ratio=args.photos,
+                           document_ratio=args.documents, edit_ratio=args.edits,
+                           delete_ratio=args.deletions, file_size=args.file_size * 1024,
+                           hs_latency=args.hs_latency / 1000, trace_memory=args.trace_memory,
+                           seed=args.seed)
+with tempfile.TemporaryDirectory() as temp_dir:
+    result = asyncio.get_event_loop().run_until_complete(
+        run_benchmark(options, os.path.join(temp_dir, "benchmark.db")))
+print(result.format())
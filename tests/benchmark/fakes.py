@@ -0,0 +1,141 @@
+"""Stand-ins for the homeserver and the Telegram servers used by the benchmark harness."""
+from typing import Optional
+from collections import Counter
+import asyncio
+
+from aiohttp import web
+
+from telethon.tl.types import Document, User as TLUser
+
+from mautrix_telegram.tgclient import MautrixTelegramClient
+
+PNG_HEADER = (b"\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR\x00\x00\x03\x20\x00\x00\x02\x58"
+              b"\x08\x02\x00\x00\x00")
+PDF_HEADER = b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n"
+CHUNK_SIZE = 128 * 1024
+
+
+class FakeHomeserver:
+    """An aiohttp server that answers every client-server API request with a plausible response.
+
+    Requests are counted by kind, and each one can be delayed to simulate a remote homeserver.
+    """
+
+    def __init__(self, latency: float = 0) -> None:
+        self.latency = latency  # type: float
+        self.requests = Counter()  # type: Counter
+        self.uploaded_bytes = 0  # type: int
+        self._counter = 0  # type: int
+        self._runner = None  # type: Optional[web.AppRunner]
+        self.url = ""  # type: str
+
+        self.app = web.Application(client_max_size=1024 ** 3)
+        self.app.router.add_route("*", "/{path:.*}", self.handle)
+
+    async def start(self) -> None:
+        self._runner = web.AppRunner(self.app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://127.0.0.1:{port}"
+
+    async def stop(self) -> None:
+        await self._runner.cleanup()
+
+    def _next_id(self) -> int:
+        self._counter += 1
+        return self._counter
+
+    async def handle(self, request: web.Request) -> web.Response:
+        path = request.match_info["path"]
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if path.startswith("_matrix/media/") and "/upload" in path:
+            self.requests["upload"] += 1
+            async for chunk in request.content.iter_chunked(CHUNK_SIZE):
+                self.uploaded_bytes += len(chunk)
+            return web.json_response({"content_uri": f"mxc://bench.example/{self._next_id()}"})
+        await request.read()
+        if "/send/" in path:
+            self.requests["send"] += 1
+            return web.json_response({"event_id": f"${self._next_id()}"})
+        elif "/redact/" in path:
+            self.requests["redact"] += 1
+            return web.json_response({"event_id": f"${self._next_id()}"})
+        elif "/state/" in path and request.method == "PUT":
+            self.requests["state"] += 1
+            return web.json_response({"event_id": f"${self._next_id()}"})
+        elif "/join/" in path or path.endswith("/join"):
+            self.requests["join"] += 1
+            room_id = next((part for part in path.split("/") if part.startswith("!")), "")
+            return web.json_response({"room_id": room_id})
+        elif path.endswith("/register"):
+            self.requests["register"] += 1
+            return web.json_response({})
+        elif path.endswith("/joined_members"):
+            self.requests["joined_members"] += 1
+            return web.json_response({"joined": {}})
+        self.requests["other"] += 1
+        return web.json_response({})
+
+
+class FakeDownload:
+    """An in-memory replacement for :class:`mautrix_telegram.tgclient.DownloadIterator`."""
+
+    def __init__(self, header: bytes, size: int) -> None:
+        self.header = header  # type: bytes
+        self.remaining = size  # type: int
+
+    def __aiter__(self) -> 'FakeDownload':
+        return self
+
+    async def __anext__(self) -> bytes:
+        if self.remaining <= 0:
+            raise StopAsyncIteration
+        size = min(self.remaining, CHUNK_SIZE)
+        if self.header:
+            chunk = self.header + bytes(max(size - len(self.header), 0))
+            self.header = b""
+        else:
+            chunk = bytes(size)
+        self.remaining -= len(chunk)
+        # Give other tasks a chance to run, like a real network read would.
+        await asyncio.sleep(0)
+        return chunk
+
+    async def close(self) -> None:
+        pass
+
+
+class FakeTelegramClient(MautrixTelegramClient):
+    """A Telegram client that never connects. It serves synthetic file downloads and entities
+    instead of talking to the Telegram servers."""
+
+    def __init__(self, tgid: int) -> None:
+        # The TelegramClient constructor sets up a session and a network sender, which aren't
+        # needed here.
+        self.tgid = tgid  # type: int
+        self.downloads = 0  # type: int
+
+    def __del__(self) -> None:
+        pass
+
+    def is_connected(self) -> bool:
+        return True
+
+    async def is_user_authorized(self) -> bool:
+        return True
+
+    async def get_me(self, input_peer: bool = False) -> TLUser:
+        return TLUser(id=self.tgid, first_name=f"User {self.tgid}")
+
+    async def get_entity(self, entity) -> TLUser:
+        user_id = getattr(entity, "user_id", self.tgid)
+        return TLUser(id=user_id, first_name=f"User {user_id}")
+
+    def iter_download(self, location, file_size: Optional[int] = None,
+                      part_size_kb: Optional[int] = None) -> FakeDownload:
+        self.downloads += 1
+        header = PDF_HEADER if isinstance(location, Document) else PNG_HEADER
+        return FakeDownload(header, file_size or getattr(location, "size", 0) or CHUNK_SIZE)
@@ -0,0 +1,313 @@
+"""Runs synthetic Telegram updates through the bridge and measures how fast they're bridged."""
+from typing import Dict, List, Optional
+from datetime import datetime, timezone
+import tracemalloc
+import resource
+import logging
+import asyncio
+import random
+import time
+import os
+
+import sqlalchemy as sql
+from alchemysession import AlchemySessionContainer
+from mautrix_appservice import AppService
+from telethon.tl.types import (Message, MessageMediaPhoto, MessageMediaDocument, Photo, PhotoSize,
+                               FileLocation, Document, DocumentAttributeFilename, PeerChannel,
+                               UpdateNewChannelMessage, UpdateEditChannelMessage,
+                               UpdateDeleteChannelMessages)
+
+from mautrix_telegram import user as u, puppet as pu, portal as po
+from mautrix_telegram.abstract_user import init as init_abstract_user
+from mautrix_telegram.config import Config
+from mautrix_telegram.context import Context
+from mautrix_telegram.db import Base, Portal as DBPortal, Puppet as DBPuppet, init as init_db
+from mautrix_telegram.formatter import init as init_formatter
+from mautrix_telegram.matrix import MatrixHandler
+from mautrix_telegram.sharding import ShardRouter
+from mautrix_telegram.sqlstatestore import SQLStateStore
+from mautrix_telegram.util import init_file_transfer, stop_file_transfer
+
+from .fakes import FakeHomeserver, FakeTelegramClient
+
+EXAMPLE_CONFIG = os.path.join(os.path.dirname(__file__), "..", "..", "example-config.yaml")
+DOMAIN = "bench.example"
+USER_ID_BASE = 100000
+CHANNEL_ID_BASE = 1000
+
+log = logging.getLogger("mau.benchmark")  # type: logging.Logger
+
+
+class BenchmarkOptions:
+    def __init__(self, portals: int = 10, users: int = 20, senders: int = 50,
+                 receivers: int = 2, updates: int = 1000, rate: float = 0,
+                 concurrency: int = 20, photo_ratio: float = 0.1, document_ratio: float = 0.05,
+                 edit_ratio: float = 0.05, delete_ratio: float = 0.05,
+                 file_size: int = 512 * 1024, hs_latency: float = 0, trace_memory: bool = False,
+                 seed: int = 0) -> None:
+        self.portals = portals  # type: int
+        self.users = users  # type: int
+        self.senders = senders  # type: int
+        self.receivers = min(receivers, users)  # type: int
+        self.updates = updates  # type: int
+        self.rate = rate  # type: float
+        self.concurrency = concurrency  # type: int
+        self.photo_ratio = photo_ratio  # type: float
+        self.document_ratio = document_ratio  # type: float
+        self.edit_ratio = edit_ratio  # type: float
+        self.delete_ratio = delete_ratio  # type: float
+        self.file_size = file_size  # type: int
+        self.hs_latency = hs_latency  # type: float
+        self.trace_memory = trace_memory  # type: bool
+        self.seed = seed  # type: int
+
+
+class BenchmarkResult:
+    def __init__(self, options: BenchmarkOptions, latencies: Dict[str, List[float]],
+                 errors: int, duration: float, requests: Dict[str, int], uploaded_bytes: int,
+                 max_rss: int, traced_peak: Optional[int]) -> None:
+        self.options = options  # type: BenchmarkOptions
+        self.latencies = latencies  # type: Dict[str, List[float]]
+        self.errors = errors  # type: int
+        self.duration = duration  # type: float
+        self.requests = requests  # type: Dict[str, int]
+        self.uploaded_bytes = uploaded_bytes  # type: int
+        self.max_rss = max_rss  # type: int
+        self.traced_peak = traced_peak  # type: Optional[int]
+
+    @property
+    def count(self) -> int:
+        return sum(len(values) for values in self.latencies.values())
+
+    @property
+    def throughput(self) -> float:
+        return self.count / self.duration if self.duration else 0
+
+    @staticmethod
+    def percentile(values: List[float], percent: float) -> float:
+        if not values:
+            return 0
+        values = sorted(values)
+        return values[min(int(len(values) * percent / 100), len(values) - 1)]
+
+    def format(self) -> str:
+        all_latencies = [value for values in self.latencies.values() for value in values]
+        lines = [f"{self.count} updates in {self.duration:.2f} s "
+                 f"({self.throughput:.1f} updates/s, {self.errors} errors)",
+                 f"{'kind':<10} {'count':>7} {'p50 ms':>9} {'p99 ms':>9}"]
+        for kind, values in sorted(self.latencies.items()) + [("all", all_latencies)]:
+            lines.append(f"{kind:<10} {len(values):>7} "
+                         f"{self.percentile(values, 50) * 1000:>9.2f} "
+                         f"{self.percentile(values, 99) * 1000:>9.2f}")
+        lines.append("homeserver requests: " + ", ".join(f"{kind}={count}" for kind, count
+                                                         in sorted(self.requests.items())))
+        lines.append(f"uploaded {self.uploaded_bytes / 1024 ** 2:.1f} MiB, "
+                     f"max RSS {self.max_rss / 1024:.1f} MiB")
+        if self.traced_peak is not None:
+            lines.append(f"peak traced Python memory {self.traced_peak / 1024 ** 2:.1f} MiB")
+        return "\n".join(lines)
+
+
+class BenchmarkBridge:
+    """The bridge modules wired to a fake homeserver and fake Telegram clients."""
+
+    def __init__(self, options: BenchmarkOptions, db_path: str) -> None:
+        self.options = options  # type: BenchmarkOptions
+        self.db_path = db_path  # type: str
+        self.loop = asyncio.get_event_loop()  # type: asyncio.AbstractEventLoop
+        self.homeserver = FakeHomeserver(options.hs_latency)  # type: FakeHomeserver
+        self.az = None  # type: AppService
+        self.users = []  # type: List[u.User]
+        self._run = None
+
+    def _make_config(self) -> Config:
+        config = Config(EXAMPLE_CONFIG, None, None)
+        config.load()
+        config["homeserver.address"] = self.homeserver.url
+        config["homeserver.domain"] = DOMAIN
+        config["appservice.as_token"] = "as_token"
+        config["appservice.hs_token"] = "hs_token"
+        config["bridge.permissions"] = {"*": "full"}
+        return config
+
+    async def start(self) -> None:
+        await self.homeserver.start()
+        config = self._make_config()
+
+        db_engine = sql.create_engine(f"sqlite:///{self.db_path}")
+        session_container = AlchemySessionContainer(engine=db_engine, table_base=Base,
+                                                    session=False, table_prefix="telethon_",
+                                                    manage_tables=False)
+        session_container.core_mode = True
+        Base.metadata.bind = db_engine
+        Base.metadata.create_all(db_engine)
+        init_db(db_engine, self.loop)
+
+        self.az = AppService(config["homeserver.address"], DOMAIN, "as_token", "hs_token",
+                             config["appservice.bot_username"], log="mau.as", loop=self.loop,
+                             state_store=SQLStateStore(),
+                             real_user_content_key="net.maunium.telegram.puppet",
+                             aiohttp_params={})
+        # Only the client side of the appservice is used, so the server is never started.
+        self._run = self.az.run()
+        self._run.__enter__().close()
+
+        context = Context(self.az, config, self.loop, session_container, None)
+        context.shards = ShardRouter(self.loop, 1, 0, 0, "hs_token")
+        context.mx = MatrixHandler(context)
+        init_abstract_user(context)
+        init_formatter(context)
+        init_file_transfer(context)
+        po.init(context)
+        await asyncio.gather(*pu.init(context), *u.init(context))
+        self._populate()
+
+    def _populate(self) -> None:
+        for portal in range(self.options.portals):
+            DBPortal(tgid=CHANNEL_ID_BASE + portal, tg_receiver=CHANNEL_ID_BASE + portal,
+                     peer_type="channel", megagroup=True, mxid=f"!portal{portal}:{DOMAIN}",
+                     title=f"Portal {portal}", config="{}").insert()
+        for sender in range(1, self.options.senders + 1):
+            DBPuppet(id=sender, displayname=f"Sender {sender}", displayname_source=sender,
+                     is_bot=False, matrix_registered=True).insert()
+        for index in range(self.options.users):
+            user = u.User(f"@user{index}:{DOMAIN}", USER_ID_BASE + index)
+            user.client = FakeTelegramClient(user.tgid)
+            self.users.append(user)
+
+    def receivers(self, portal: int) -> List[u.User]:
+        return [self.users[(portal + i) % len(self.users)] for i in range(self.options.receivers)]
+
+    async def stop(self) -> None:
+        await self.az.http_session.close()
+        self._run.__exit__(None, None, None)
+        await self.homeserver.stop()
+        stop_file_transfer()
+        Base.executor.shutdown(wait=True)
+        po.Portal.by_mxid.clear()
+        po.Portal.by_tgid.clear()
+        pu.Puppet.cache.clear()
+        pu.Puppet.by_custom_mxid.clear()
+        u.User.by_mxid.clear()
+        u.User.by_tgid.clear()
+
+
+class UpdateGenerator:
+    """Generates a random mix of new messages, edits and deletions across the portals."""
+
+    def __init__(self, options: BenchmarkOptions) -> None:
+        self.options = options  # type: BenchmarkOptions
+        self.random = random.Random(options.seed)  # type: random.Random
+        self.next_id = 0  # type: int
+        self.pts = 0  # type: int
+        # Messages that have been bridged and can be edited or deleted, per portal.
+        self.bridged = [[] for _ in range(options.portals)]  # type: List[List[int]]
+
+    def _id(self) -> int:
+        self.next_id += 1
+        return self.next_id
+
+    def _pts(self) -> int:
+        self.pts += 1
+        return self.pts
+
+    def _message(self, channel_id: int, message_id: int, **kwargs) -> Message:
+        return Message(id=message_id, to_id=PeerChannel(channel_id),
+                       date=datetime.now(tz=timezone.utc),
+                       from_id=self.random.randint(1, self.options.senders), **kwargs)
+
+    def next(self):
+        options = self.options
+        portal = self.random.randrange(options.portals)
+        channel_id = CHANNEL_ID_BASE + portal
+        bridged = self.bridged[portal]
+        roll = self.random.random()
+        if bridged and roll < options.delete_ratio:
+            message_id = bridged.pop(self.random.randrange(len(bridged)))
+            return portal, "delete", None, UpdateDeleteChannelMessages(
+                channel_id=channel_id, messages=[message_id], pts=self._pts(), pts_count=1)
+        roll -= options.delete_ratio
+        if bridged and roll < options.edit_ratio:
+            message_id = self.random.choice(bridged)
+            message = self._message(channel_id, message_id, message=f"Edited {self._id()}",
+                                    edit_date=datetime.now(tz=timezone.utc))
+            return portal, "edit", None, UpdateEditChannelMessage(message=message,
+                                                                  pts=self._pts(), pts_count=1)
+        roll -= options.edit_ratio
+
+        message_id = self._id()
+        if roll < options.photo_ratio:
+            kind = "photo"
+            location = FileLocation(dc_id=1, volume_id=message_id, local_id=message_id, secret=0,
+                                    file_reference=b"")
+            photo = Photo(id=message_id, access_hash=0, file_reference=b"",
+                          date=datetime.now(tz=timezone.utc),
+                          sizes=[PhotoSize("x", location, 800, 600, options.file_size)])
+            message = self._message(channel_id, message_id, message="",
+                                    media=MessageMediaPhoto(photo=photo))
+        elif roll < options.photo_ratio + options.document_ratio:
+            kind = "document"
+            document = Document(id=message_id, access_hash=0, file_reference=b"",
+                                date=datetime.now(tz=timezone.utc), mime_type="application/pdf",
+                                size=options.file_size, dc_id=1,
+                                attributes=[DocumentAttributeFilename(f"file{message_id}.pdf")])
+            message = self._message(channel_id, message_id, message="",
+                                    media=MessageMediaDocument(document=document))
+        else:
+            kind = "text"
+            message = self._message(channel_id, message_id,
+                                    message=f"Message {message_id} " + "lorem ipsum " * 5)
+        return portal, kind, message_id, UpdateNewChannelMessage(message=message, pts=self._pts(),
+                                                                 pts_count=1)
+
+
+async def run_benchmark(options: BenchmarkOptions, db_path: str) -> BenchmarkResult:
+    """Start the bridge against the fakes, send the updates and collect the results.
+
+    Every update is passed to :meth:`AbstractUser._update` of each user that receives the portal,
+    like Telegram does for groups with multiple bridged users. The latency of an update is the
+    time until all of those calls have returned.
+    """
+    bridge = BenchmarkBridge(options, db_path)
+    await bridge.start()
+    generator = UpdateGenerator(options)
+    latencies = {}  # type: Dict[str, List[float]]
+    errors = 0
+    semaphore = asyncio.Semaphore(options.concurrency)
+    loop = bridge.loop
+
+    async def dispatch(portal: int, kind: str, message_id: Optional[int], update) -> None:
+        nonlocal errors
+        start = time.perf_counter()
+        try:
+            await asyncio.gather(*[user._update(update) for user in bridge.receivers(portal)])
+        except Exception:
+            log.exception(f"Failed to handle {kind} update")
+            errors += 1
+            return
+        finally:
+            semaphore.release()
+        latencies.setdefault(kind, []).append(time.perf_counter() - start)
+        if message_id:
+            generator.bridged[portal].append(message_id)
+
+    if options.trace_memory:
+        tracemalloc.start()
+    start = loop.time()
+    tasks = []
+    try:
+        for index in range(options.updates):
+            if options.rate:
+                await asyncio.sleep(max(start + index / options.rate - loop.time(), 0))
+            await semaphore.acquire()
+            tasks.append(asyncio.ensure_future(dispatch(*generator.next())))
+        await asyncio.gather(*tasks)
+        duration = loop.time() - start
+        traced_peak = tracemalloc.get_traced_memory()[1] if options.trace_memory else None
+    finally:
+        if options.trace_memory:
+            tracemalloc.stop()
+        await bridge.stop()
+    return BenchmarkResult(options, latencies, errors, duration, dict(bridge.homeserver.requests),
+                           bridge.homeserver.uploaded_bytes,
+                           resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, traced_peak)
@@ -0,0 +1,87 @@
+"""Micro-benchmark of the Telegram message fingerprint used for deduplication.
+
+Run with ``python -m tests.benchmark.hashing``.
+"""
+from typing import Callable, List
+from datetime import datetime, timezone
+import argparse
+import hashlib
+import timeit
+
+from telethon.tl.types import (
+    Document, GeoPoint, Message, MessageActionChatAddUser, MessageActionChatEditTitle,
+    MessageFwdHeader, MessageMediaContact, MessageMediaDocument, MessageMediaGeo,
+    MessageMediaPhoto, MessageService, Photo)
+
+from mautrix_telegram.util import fingerprint_event
+
+
+def legacy_hash_event(event) -> str:
+    """The MD5-based hash that was used before :func:`fingerprint_event`."""
+    if isinstance(event, MessageService):
+        hash_content = [event.date.timestamp(), event.from_id, event.action]
+    else:
+        hash_content = [event.date.timestamp(), event.message]
+        if event.fwd_from:
+            hash_content += [event.fwd_from.from_id, event.fwd_from.channel_id]
+        elif isinstance(event, Message) and event.media:
+            try:
+                hash_content += {
+                    MessageMediaContact: lambda media: [media.user_id],
+                    MessageMediaDocument: lambda media: [media.document.id],
+                    MessageMediaPhoto: lambda media: [media.photo.id],
+                    MessageMediaGeo: lambda media: [media.geo.long, media.geo.lat],
+                }[type(event.media)](event.media)
+            except KeyError:
+                pass
+    return hashlib.md5("-"
+                       .join(str(a) for a in hash_content)
+                       .encode("utf-8")
+                       ).hexdigest()
+
+
+def sample_events() -> List[object]:
+    date = datetime(2019, 3, 1, 12, 0, tzinfo=timezone.utc)
+    text = "Hello, world! " * 10
+    return [
+        Message(id=1, date=date, message=text),
+        Message(id=2, date=date, message="", media=MessageMediaPhoto(
+            photo=Photo(id=123456789, access_hash=1, file_reference=b"", date=date, sizes=[]))),
+        Message(id=3, date=date, message="", media=MessageMediaDocument(
+            document=Document(id=987654321, access_hash=1, file_reference=b"", date=date,
+                              mime_type="application/pdf", size=1024, dc_id=2, attributes=[]))),
+        Message(id=4, date=date, message="", media=MessageMediaGeo(
+            geo=GeoPoint(long=24.94, lat=60.17, access_hash=0))),
+        Message(id=5, date=date, message=text,
+                fwd_from=MessageFwdHeader(date=date, from_id=1234)),
+        MessageService(id=6, date=date, from_id=1234,
+                       action=MessageActionChatAddUser(users=[1, 2, 3])),
+        MessageService(id=7, date=date, from_id=1234,
+                       action=MessageActionChatEditTitle(title="New title")),
+    ]
+
+
+def measure(func: Callable[[object], str], events: List[object], number: int) -> float:
+    """Get the best average time in microseconds to hash one event."""
+    timer = timeit.Timer(lambda: [func(event) for event in events])
+    return min(timer.repeat(repeat=5, number=number)) / number / len(events) * 1e6
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Compare the dedup fingerprint with the old "
+                                                 "MD5-based hash.",
+                                     prog="python -m tests.benchmark.hashing")
+    parser.add_argument("-n", "--number", type=int, default=2000,
+                        help="number of times to hash the sample events in each round")
+    args = parser.parse_args()
+
+    events = sample_events()
+    legacy = measure(legacy_hash_event, events, args.number)
+    current = measure(fingerprint_event, events, args.number)
+    print(f"legacy md5:  {legacy:7.2f} µs/event")
+    print(f"fingerprint: {current:7.2f} µs/event")
+    print(f"speedup:     {legacy / current:7.2f}x")
+
+
+if __name__ == "__main__":
+    main()
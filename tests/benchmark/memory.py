@@ -0,0 +1,140 @@
+"""Memory benchmark of the objects that the bridge keeps in memory for every Telegram user, room
+member and recently bridged message.
+
+Each object is compared to the layout it had before it used ``__slots__``. Run with
+``python -m tests.benchmark.memory``.
+"""
+from typing import Any, Callable, Iterator, Optional, Tuple
+import argparse
+import asyncio
+import tracemalloc
+import gc
+
+from mautrix_appservice import AppService
+
+from mautrix_telegram import user as _  # noqa: F401 (imported first to avoid an import cycle)
+from mautrix_telegram.db import Message, Puppet as DBPuppet, UserProfile
+from mautrix_telegram.db.message_cache import CachedMessage
+from mautrix_telegram.puppet import Puppet
+from mautrix_telegram.sqlstatestore import MemberProfile
+
+Factory = Callable[[int], Any]
+
+
+def unslotted(cls: type) -> type:
+    """Make a copy of a class that stores its attributes in a ``__dict__`` like before."""
+    attrs = {key: value for key, value in vars(cls).items()
+             if key not in ("__slots__", "__dict__", "__weakref__")
+             and key not in getattr(cls, "__slots__", ())}
+    return type(f"Unslotted{cls.__name__}", cls.__bases__, attrs)
+
+
+def db_puppet(tgid: int) -> DBPuppet:
+    return DBPuppet(id=tgid, access_token=None, custom_mxid=None, username=f"user{tgid}",
+                    displayname=f"User {tgid} (Telegram)", displayname_source=1,
+                    photo_id=f"photo{tgid}", name_hash="0123456789abcdef", is_bot=False,
+                    matrix_registered=True)
+
+
+def puppet_factories() -> Tuple[Factory, Factory]:
+    legacy_cls = unslotted(Puppet)
+
+    def legacy(tgid: int) -> Any:
+        row = db_puppet(tgid)
+        puppet = legacy_cls(row.id, row.access_token, row.custom_mxid, row.username,
+                            row.displayname, row.displayname_source, row.photo_id, row.is_bot,
+                            row.matrix_registered, row.name_hash)
+        # Puppets used to keep the row they were loaded from.
+        puppet._db_instance = row
+        return puppet
+
+    def current(tgid: int) -> Any:
+        return Puppet.from_db(db_puppet(tgid))
+
+    return legacy, current
+
+
+def reset_puppets(az: AppService) -> None:
+    Puppet.cache.clear()
+    # Otherwise the second run would reuse the HTTP API objects of the first one.
+    az.intent.client.children.clear()
+
+
+def profile_factories() -> Tuple[Factory, Factory]:
+    def legacy(i: int) -> Any:
+        return UserProfile(room_id="!room:example.com", user_id=f"@telegram_{i}:example.com",
+                           membership="join", displayname=f"User {i}", avatar_url=None)
+
+    def current(i: int) -> Any:
+        return MemberProfile("!room:example.com", f"@telegram_{i}:example.com", "join",
+                             f"User {i}", None)
+
+    return legacy, current
+
+
+def message_factories() -> Tuple[Factory, Factory]:
+    def legacy(i: int) -> Any:
+        return Message(mxid=f"$event{i}", mx_room="!room:example.com", tgid=i, tg_space=1)
+
+    def current(i: int) -> Any:
+        return CachedMessage(f"$event{i}", "!room:example.com", i, 1)
+
+    return legacy, current
+
+
+def measure(factory: Factory, count: int, reset: Optional[Callable[[], None]] = None) -> int:
+    """Get the number of bytes allocated for ``count`` objects that are all kept alive."""
+    if reset:
+        reset()
+    gc.collect()
+    tracemalloc.start()
+    try:
+        start, _ = tracemalloc.get_traced_memory()
+        objects = [factory(i) for i in range(1, count + 1)]
+        gc.collect()
+        size, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    del objects
+    if reset:
+        reset()
+    return size - start
+
+
+def run(count: int) -> Iterator[Tuple[str, int, int]]:
+    loop = asyncio.get_event_loop()
+    az = AppService("http://localhost:8008", "example.com", "as_token", "hs_token", "telegrambot",
+                    loop=loop, real_user_content_key="net.maunium.telegram.puppet",
+                    aiohttp_params={})
+    # Only the client side of the appservice is used, so the server is never started.
+    az_run = az.run()
+    az_run.__enter__().close()
+    Puppet.az = az
+    Puppet.username_template = "telegram_{userid}"
+    Puppet.hs_domain = "example.com"
+    try:
+        cases = (("puppets", puppet_factories(), lambda: reset_puppets(az)),
+                 ("member profiles", profile_factories(), None),
+                 ("cached messages", message_factories(), None))
+        for name, (legacy, current), reset in cases:
+            yield name, measure(legacy, count, reset), measure(current, count, reset)
+    finally:
+        loop.run_until_complete(az.http_session.close())
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Compare the memory used by the in-memory "
+                                                 "models with their dict-based versions.",
+                                     prog="python -m tests.benchmark.memory")
+    parser.add_argument("-n", "--count", type=int, default=100000,
+                        help="number of objects of each type to create")
+    args = parser.parse_args()
+
+    print(f"{'':16} {'before':>10} {'after':>10} {'saved':>7}   (at {args.count} objects)")
+    for name, legacy, current in run(args.count):
+        print(f"{name:16} {legacy / 2**20:7.1f} MiB {current / 2**20:7.1f} MiB "
+              f"{1 - current / legacy:7.0%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,20 @@
+import pytest
+
+from .harness import BenchmarkOptions, run_benchmark
+
+
+@pytest.mark.asyncio
+async def test_smoke(tmpdir) -> None:
+    options = BenchmarkOptions(portals=3, users=4, senders=5, updates=40, concurrency=4,
+                               photo_ratio=0.2, document_ratio=0.1, edit_ratio=0.1,
+                               delete_ratio=0.1, file_size=200 * 1024)
+    result = await run_benchmark(options, str(tmpdir.join("benchmark.db")))
+
+    assert result.errors == 0
+    assert result.count == options.updates
+    assert set(result.latencies.keys()) == {"text", "photo", "document", "edit", "delete"}
+    # Each message is received by two users, but only bridged once.
+    new_messages = sum(len(result.latencies[kind]) for kind in ("text", "photo", "document"))
+    assert result.requests["send"] == new_messages + len(result.latencies["edit"])
+    assert result.requests["upload"] == (len(result.latencies["photo"])
+                                         + len(result.latencies["document"]))
@@ -0,0 +1,47 @@
+import pytest
+import sqlalchemy as sql
+
+from mautrix_telegram.db import Base, Message, init as init_db
+from mautrix_telegram.db.base import SELECT_CHUNK_SIZE
+
+
+@pytest.fixture(params=["plain", "cache", "write_buffer"])
+def message(request):
+    db_engine = sql.create_engine("sqlite://")
+    Base.metadata.create_all(db_engine)
+    init_db(db_engine)
+    if request.param == "cache":
+        Message.enable_cache(100)
+    elif request.param == "write_buffer":
+        Message.enable_write_buffer(10000)
+    yield Message
+    Message.enable_cache(0)
+    Message.enable_write_buffer(0)
+    Base.executor.shutdown()
+
+
+class TestMessageBatch:
+    def test_get_and_delete_many(self, message) -> None:
+        count = SELECT_CHUNK_SIZE + 10
+        for i in range(1, count + 1):
+            message(mxid=f"${i}", mx_room="!room", tgid=i, tg_space=10).insert()
+        message(mxid="$1", mx_room="!room", tgid=1, tg_space=20).insert()
+        # Warm up the cache for some of the messages.
+        assert message.get_by_tgid(2, 10).mxid == "$2"
+
+        found = message.get_many_by_tgid(list(range(1, count + 5)), 10)
+        assert sorted(msg.tgid for msg in found) == list(range(1, count + 1))
+
+        message.delete_many(found[:3] + [message.get_by_tgid(1, 20)])
+        assert message.get_by_tgid(1, 20) is None
+        assert len(message.get_many_by_tgid(list(range(1, count + 1)), 10)) == count - 3
+
+    def test_count_spaces_by_mxids(self, message) -> None:
+        message(mxid="$a", mx_room="!room", tgid=1, tg_space=10).insert()
+        message(mxid="$a", mx_room="!room", tgid=1, tg_space=20).insert()
+        message(mxid="$b", mx_room="!room", tgid=2, tg_space=10).insert()
+
+        counts = message.count_spaces_by_mxids([("$a", "!room"), ("$b", "!room"),
+                                                ("$a", "!other"), ("$c", "!room")])
+        assert counts == {("$a", "!room"): 2, ("$b", "!room"): 1, ("$a", "!other"): 0,
+                          ("$c", "!room"): 0}
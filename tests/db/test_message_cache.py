@@ -0,0 +1,56 @@
+import pytest
+import sqlalchemy as sql
+
+from mautrix_telegram.db import Base, Message, init as init_db
+
+
+@pytest.fixture
+def cached_message():
+    db_engine = sql.create_engine("sqlite://")
+    Base.metadata.create_all(db_engine)
+    init_db(db_engine)
+    Message.enable_cache(2)
+    yield Message
+    Message.enable_cache(0)
+    Base.executor.shutdown()
+
+
+class TestMessageCache:
+    def test_lookup_both_ways(self, cached_message) -> None:
+        cached_message(mxid="$a", mx_room="!room", tgid=1, tg_space=10).insert()
+
+        assert cached_message.get_by_tgid(1, 10).mxid == "$a"
+        assert cached_message.get_by_mxid("$a", "!room", 10).tgid == 1
+        assert cached_message.get_by_mxid("$a", "!room", 20) is None
+        assert cached_message.cache.hits == 2
+        assert cached_message.cache.misses == 1
+
+    def test_write_through(self, cached_message) -> None:
+        cached_message(mxid="$temp", mx_room="!room", tgid=1, tg_space=10).insert()
+        cached_message.update_by_mxid("$temp", "!room", mxid="$real")
+        assert cached_message.get_by_mxid("$temp", "!room", 10) is None
+        assert cached_message.get_by_mxid("$real", "!room", 10).tgid == 1
+
+        cached_message.update_by_tgid(1, 10, mxid="$edit")
+        assert cached_message.get_by_tgid(1, 10).mxid == "$edit"
+
+        cached_message.get_by_tgid(1, 10).delete()
+        assert cached_message.get_by_tgid(1, 10) is None
+        assert cached_message.cache.size == 0
+
+    def test_eviction(self, cached_message) -> None:
+        for i in range(3):
+            cached_message(mxid=f"${i}", mx_room="!room", tgid=i, tg_space=10).insert()
+        assert cached_message.cache.size == 2
+        assert cached_message.cache.evictions == 1
+
+        # The evicted row is loaded from the database and cached again.
+        assert cached_message.get_by_mxid("$0", "!room", 10).tgid == 0
+        assert cached_message.cache.misses == 1
+        assert cached_message.get_by_tgid(0, 10).mxid == "$0"
+        assert cached_message.cache.hits == 1
+
+    def test_returns_copies(self, cached_message) -> None:
+        cached_message(mxid="$a", mx_room="!room", tgid=1, tg_space=10).insert()
+        cached_message.get_by_tgid(1, 10).mxid = "$changed"
+        assert cached_message.get_by_tgid(1, 10).mxid == "$a"
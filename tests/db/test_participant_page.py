@@ -0,0 +1,39 @@
+from datetime import datetime, timezone
+
+import pytest
+import sqlalchemy as sql
+from telethon.tl.types import ChannelParticipant, ChannelParticipantAdmin, ChatAdminRights
+
+from mautrix_telegram.db import Base, ParticipantPage, init as init_db
+
+DATE = datetime(2019, 3, 1, tzinfo=timezone.utc)
+
+
+@pytest.fixture
+def db():
+    db_engine = sql.create_engine("sqlite://")
+    Base.metadata.create_all(db_engine)
+    init_db(db_engine)
+    yield
+    Base.executor.shutdown()
+
+
+def test_store_and_replace(db) -> None:
+    participants = [ChannelParticipant(user_id=1, date=DATE),
+                    ChannelParticipantAdmin(user_id=2, promoted_by=1, date=DATE,
+                                            admin_rights=ChatAdminRights(ban_users=True))]
+    ParticipantPage.replace_all(10, [
+        ParticipantPage(offset=0, hash=123, participants=ParticipantPage.serialize(participants)),
+        ParticipantPage(offset=2, hash=456, participants=b""),
+    ])
+    first, second = ParticipantPage.get_all(10)
+    assert (first.offset, first.hash, second.offset) == (0, 123, 2)
+    loaded = first.deserialize()
+    assert [type(participant) for participant in loaded] == [ChannelParticipant,
+                                                             ChannelParticipantAdmin]
+    assert loaded[1].admin_rights.ban_users
+    assert second.deserialize() == []
+
+    ParticipantPage.replace_all(10, [first])
+    assert [page.offset for page in ParticipantPage.get_all(10)] == [0]
+    assert ParticipantPage.get_all(20) == []
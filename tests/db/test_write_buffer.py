@@ -0,0 +1,123 @@
+import pytest
+import sqlalchemy as sql
+
+from mautrix_telegram.db import Base, Message, init as init_db
+
+
+@pytest.fixture
+def buffered_message():
+    db_engine = sql.create_engine("sqlite://")
+    Base.metadata.create_all(db_engine)
+    init_db(db_engine)
+    Message.enable_write_buffer(100)
+    yield Message
+    Message.enable_write_buffer(0)
+    Base.executor.shutdown()
+
+
+def _count_rows() -> int:
+    return Message.db.execute(sql.select([sql.func.count()]).select_from(Message.t)).scalar()
+
+
+class TestMessageWriteBuffer:
+    def test_pending_insert_is_readable(self, buffered_message) -> None:
+        buffered_message(mxid="$temp", mx_room="!room", tgid=1, tg_space=10).insert()
+        buffered_message.update_by_mxid("$temp", "!room", mxid="$real")
+
+        assert _count_rows() == 0
+        msg = buffered_message.get_by_tgid(1, 10)
+        assert msg.mxid == "$real"
+        assert buffered_message.get_by_mxid("$real", "!room", 10).tgid == 1
+        assert buffered_message.count_spaces_by_mxid("$real", "!room") == 1
+
+        buffered_message.flush()
+        assert _count_rows() == 1
+        assert buffered_message.get_by_tgid(1, 10).mxid == "$real"
+
+    def test_pending_update_of_flushed_row(self, buffered_message) -> None:
+        buffered_message(mxid="$a", mx_room="!room", tgid=1, tg_space=10).insert()
+        buffered_message(mxid="$a", mx_room="!room", tgid=1, tg_space=20).insert()
+        buffered_message.flush()
+
+        buffered_message.update_by_tgid(1, 20, mxid="$b")
+        assert buffered_message.count_spaces_by_mxid("$a", "!room") == 1
+        assert buffered_message.get_by_mxid("$b", "!room", 20).tgid == 1
+
+        buffered_message.get_by_tgid(1, 10).delete()
+        assert buffered_message.get_by_tgid(1, 10) is None
+        buffered_message.flush()
+        assert _count_rows() == 1
+        assert buffered_message.get_by_tgid(1, 20).mxid == "$b"
+
+    def test_flush_on_size(self, buffered_message) -> None:
+        buffered_message.write_buffer.max_size = 3
+        for i in range(3):
+            buffered_message(mxid=f"${i}", mx_room="!room", tgid=i, tg_space=10).insert()
+        assert _count_rows() == 3
+        assert buffered_message.write_buffer.pending == 0
+
+    def test_duplicate_insert(self, buffered_message) -> None:
+        buffered_message(mxid="$a", mx_room="!room", tgid=1, tg_space=10).insert()
+        with pytest.raises(sql.exc.IntegrityError):
+            buffered_message(mxid="$b", mx_room="!room", tgid=1, tg_space=10).insert()
+        buffered_message.flush()
+
+        # Duplicates of rows that were already written are only found when they're written.
+        buffered_message(mxid="$b", mx_room="!room", tgid=1, tg_space=10).insert()
+        buffered_message.flush()
+        assert buffered_message.write_buffer.failed_ops == 1
+        assert buffered_message.get_by_tgid(1, 10).mxid == "$a"
+
+        buffered_message(mxid="$b", mx_room="!room", tgid=1, tg_space=10).insert()
+        buffered_message.get_by_tgid(1, 10).delete()
+        buffered_message(mxid="$c", mx_room="!room", tgid=1, tg_space=10).insert()
+        buffered_message.flush()
+        assert buffered_message.get_by_tgid(1, 10).mxid == "$c"
+
+    def test_conflicting_batch_is_retried(self, buffered_message) -> None:
+        buffered_message(mxid="$a", mx_room="!room", tgid=1, tg_space=10).insert()
+        buffered_message(mxid="$b", mx_room="!room", tgid=2, tg_space=10).insert()
+        # Another process wrote the same row in the meantime.
+        Message.db.execute(Message.t.insert(), mxid="$c", mx_room="!room", tgid=1, tg_space=10)
+        buffered_message.flush()
+        assert _count_rows() == 2
+        assert buffered_message.write_buffer.failed_ops == 1
+
+    def test_failed_write_is_requeued(self, buffered_message, mocker) -> None:
+        buffer = buffered_message.write_buffer
+        buffer.max_size = 2
+        write = buffer._write
+        mocker.patch.object(buffer, "_write",
+                            side_effect=sql.exc.OperationalError("", {}, None))
+        buffered_message(mxid="$a", mx_room="!room", tgid=1, tg_space=10).insert()
+        # The insert that fills the buffer doesn't see the error of the write.
+        buffered_message(mxid="$b", mx_room="!room", tgid=2, tg_space=10).insert()
+        buffered_message.update_by_tgid(1, 10, mxid="$c")
+        assert buffer._write.call_count == 1
+        # The update of the requeued insert is applied to it directly.
+        assert buffer.pending == 2
+        assert buffered_message.get_by_tgid(1, 10).mxid == "$c"
+        with pytest.raises(sql.exc.OperationalError):
+            buffered_message.flush()
+
+        buffer._write = write
+        buffered_message.flush()
+        assert _count_rows() == 2
+        assert buffered_message.get_by_tgid(1, 10).mxid == "$c"
+        assert buffered_message.get_by_tgid(2, 10).mxid == "$b"
+
+    def test_rows_being_flushed_stay_visible(self, buffered_message) -> None:
+        buffer = buffered_message.write_buffer
+        buffered_message(mxid="$a", mx_room="!room", tgid=1, tg_space=10).insert()
+        seen = []
+        write = buffer._write
+
+        def slow_write(ops) -> None:
+            # Reads during the write must neither block nor miss the row.
+            seen.append(buffered_message.get_by_tgid(1, 10).mxid)
+            write(ops)
+
+        buffer._write = slow_write
+        buffered_message.flush()
+        assert seen == ["$a"]
+        assert buffered_message.get_by_tgid(1, 10).mxid == "$a"
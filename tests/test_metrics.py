@@ -0,0 +1,46 @@
+import pytest
+import sqlalchemy as sql
+
+pytest.importorskip("prometheus_client")
+
+from mautrix_telegram import metrics
+from mautrix_telegram.db import Base, Message, init as init_db
+
+
+@pytest.fixture
+def enabled_metrics():
+    metrics.enabled = True
+    yield metrics
+    metrics.enabled = False
+
+
+def sample(name: str, **labels) -> float:
+    return metrics.REGISTRY.get_sample_value(name, labels) or 0
+
+
+class TestMetrics:
+    @pytest.mark.asyncio
+    async def test_timed(self, enabled_metrics) -> None:
+        @metrics.timed(metrics.TELEGRAM_MESSAGE_TIME)
+        async def handle() -> str:
+            return "done"
+
+        before = sample("bridge_telegram_message_seconds_count")
+        assert await handle() == "done"
+        assert sample("bridge_telegram_message_seconds_count") == before + 1
+
+    @pytest.mark.asyncio
+    async def test_db_query_time(self, enabled_metrics, tmpdir) -> None:
+        db_engine = sql.create_engine(f"sqlite:///{tmpdir}/metrics.db")
+        Base.metadata.create_all(db_engine)
+        init_db(db_engine)
+        try:
+            assert await Message.aio.get_by_tgid(1, 2) is None
+        finally:
+            Base.executor.shutdown()
+        assert sample("bridge_db_query_seconds_count", method="Message.get_by_tgid") == 1
+
+    def test_disabled(self) -> None:
+        before = sample("bridge_dedup_lookups_total", kind="message", result="hit")
+        metrics.count_dedup("message", hit=True)
+        assert sample("bridge_dedup_lookups_total", kind="message", result="hit") == before
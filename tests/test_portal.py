@@ -0,0 +1,126 @@
+from datetime import datetime, timezone
+import asyncio
+
+import pytest
+import sqlalchemy as sql
+from telethon.tl.types import ChannelParticipant, InputChannel, User
+from telethon.tl.types.channels import ChannelParticipants, ChannelParticipantsNotModified
+
+from mautrix_telegram import user as _  # noqa: F401 (imported first to avoid an import cycle)
+from mautrix_telegram import portal as po, util
+from mautrix_telegram.db import Base, ParticipantPage, init as init_db
+
+DATE = datetime(2019, 3, 1, tzinfo=timezone.utc)
+
+
+@pytest.fixture
+def channel():
+    old_config, po.config = po.config, {"bridge.skip_deleted_members": True}
+    portal = po.Portal(1, peer_type="channel", mxid="!room:example.org")
+    yield portal
+    po.config = old_config
+    po.Portal.by_tgid.clear()
+    po.Portal.by_mxid.clear()
+
+
+@pytest.fixture
+def db(tmpdir):
+    # The pages are stored from the executor threads, which can't see an in-memory database.
+    db_engine = sql.create_engine(f"sqlite:///{tmpdir.join('portal.db')}")
+    Base.metadata.create_all(db_engine)
+    init_db(db_engine)
+    yield
+    Base.executor.shutdown()
+
+
+def participant_page(offset: int, user_ids: list) -> ParticipantPage:
+    participants = [ChannelParticipant(user_id=user_id, date=DATE) for user_id in user_ids]
+    return ParticipantPage(channel_id=1, offset=offset, hash=util.vector_hash(user_ids),
+                           participants=ParticipantPage.serialize(participants))
+
+
+class FakeSource:
+    """A user whose client returns the participant list one page at a time."""
+
+    def __init__(self, pages: list) -> None:
+        self.pages = pages
+        self.client = self
+        self.hashes = []
+
+    async def __call__(self, request) -> ChannelParticipants:
+        self.hashes.append(request.hash)
+        user_ids = self.pages[request.offset // 2] if request.offset // 2 < len(self.pages) else []
+        if user_ids is None:
+            return ChannelParticipantsNotModified()
+        return ChannelParticipants(
+            count=0, participants=[ChannelParticipant(user_id=user_id, date=DATE)
+                                   for user_id in user_ids],
+            users=[User(id=user_id) for user_id in user_ids])
+
+
+class TestMemberSync:
+    @pytest.mark.asyncio
+    async def test_bounded_concurrency_and_failures(self, channel, mocker) -> None:
+        mocker.patch.object(po.Portal, "member_sync_concurrency", 3)
+        running = peak = 0
+        synced = []
+
+        async def sync_user(_, source, entity: User) -> None:
+            nonlocal running, peak
+            running += 1
+            peak = max(peak, running)
+            await asyncio.sleep(0.01)
+            running -= 1
+            if entity.id % 4 == 0:
+                raise ValueError("can't join")
+            synced.append(entity.id)
+
+        mocker.patch.object(po.Portal, "_sync_telegram_user", sync_user)
+        log = channel.log = mocker.Mock()
+        users = [User(id=i, first_name=f"User {i}") for i in range(1, 11)]
+        users.append(User(id=11, deleted=True))
+        await channel.sync_telegram_users(None, users)
+
+        assert peak == 3
+        assert sorted(synced) == [1, 2, 3, 5, 6, 7, 9, 10]
+        assert log.exception.call_count == 2
+        assert "Synced 10 members (2 failed)" in log.info.call_args[0][0]
+
+
+class TestParticipantCache:
+    @pytest.mark.asyncio
+    async def test_incremental_fetch(self, db, channel, mocker) -> None:
+        ParticipantPage.replace_all(1, [participant_page(0, [1, 2]), participant_page(2, [3, 4])])
+        # The first page hasn't changed and the second one has a new member.
+        source = FakeSource([None, [3, 5]])
+
+        users, participants = await channel._get_all_channel_users(
+            source, InputChannel(1, 0), only_changed=True)
+        assert source.hashes == [util.vector_hash([1, 2]), util.vector_hash([3, 4]), 0]
+        assert [user.id for user in users] == [5]
+        assert [participant.user_id for participant in participants] == [1, 2, 3, 5]
+
+        # The new pages are only cached once the new members have been synced.
+        stored = [page.hash for page in ParticipantPage.get_all(1)]
+        assert stored == [util.vector_hash([1, 2]), util.vector_hash([3, 4])]
+        sync = mocker.patch.object(po.Portal, "_sync_telegram_user")
+        sync.side_effect = ValueError("can't join")
+        await channel.sync_telegram_users(source, users, participants)
+        assert [page.hash for page in ParticipantPage.get_all(1)] == stored
+
+        # The changed page is fetched again, as it wasn't cached.
+        source.hashes = []
+        users, participants = await channel._get_all_channel_users(
+            source, InputChannel(1, 0), only_changed=True)
+        assert [user.id for user in users] == [5]
+        sync.side_effect = None
+        await channel.sync_telegram_users(source, users, participants)
+        assert [page.hash for page in ParticipantPage.get_all(1)] == [util.vector_hash([1, 2]),
+                                                                      util.vector_hash([3, 5])]
+
+        # Nothing has changed anymore, so nothing is returned to be synced.
+        source.pages = [None, None]
+        users, participants = await channel._get_all_channel_users(
+            source, InputChannel(1, 0), only_changed=True)
+        assert users == []
+        assert [participant.user_id for participant in participants] == [1, 2, 3, 5]
@@ -0,0 +1,94 @@
+import asyncio
+
+import pytest
+from telethon.tl.types import UpdateUserName, User
+
+from mautrix_telegram import puppet as pu
+
+
+@pytest.fixture
+def name_config():
+    config = {
+        "bridge.displayname_template": "{displayname} (Telegram)",
+        "bridge.displayname_preference": ["full name", "username"],
+    }
+    old_config, pu.config = pu.config, config
+    yield config
+    pu.config = old_config
+
+
+@pytest.fixture
+def puppet(name_config, mocker):
+    mocker.patch.object(pu.Puppet, "az")
+    mocker.patch.object(pu.Puppet, "username_template", "telegram_{userid}")
+    mocker.patch.object(pu.Puppet, "hs_domain", "example.com")
+    puppet = pu.Puppet(1)
+    yield puppet
+    pu.Puppet.cache.clear()
+
+
+def resolved(value=None) -> asyncio.Future:
+    future = asyncio.Future()
+    future.set_result(value)
+    return future
+
+
+class TestNameHash:
+    def test_same_for_user_and_name_update(self, name_config) -> None:
+        user = User(id=1, first_name="Alice", last_name="Smith", username="alice", phone="123")
+        update = UpdateUserName(user_id=1, first_name="Alice", last_name="Smith",
+                                username="alice")
+        assert pu.Puppet.get_name_hash(user) == pu.Puppet.get_name_hash(update)
+
+        renamed = User(id=1, first_name="Alice", last_name="Jones", username="alice")
+        assert pu.Puppet.get_name_hash(renamed) != pu.Puppet.get_name_hash(user)
+
+    def test_depends_on_config(self, name_config) -> None:
+        user = User(id=1, first_name="Alice", phone="123")
+        name_hash = pu.Puppet.get_name_hash(user)
+        name_config["bridge.displayname_template"] = "{displayname}"
+        assert pu.Puppet.get_name_hash(user) != name_hash
+
+        # Name updates don't include the phone number, so they can't be hashed if it's used.
+        name_config["bridge.displayname_preference"].append("phone number")
+        assert pu.Puppet.get_name_hash(UpdateUserName(user_id=1, first_name="Alice",
+                                                      last_name=None, username=None)) is None
+
+
+class TestUpdateDisplayname:
+    @pytest.mark.asyncio
+    async def test_unchanged_name_is_skipped(self, puppet, mocker) -> None:
+        source = mocker.Mock(is_relaybot=False, tgid=10)
+        set_display_name = puppet.default_mxid_intent.set_display_name
+        set_display_name.return_value = resolved()
+        user = User(id=1, first_name="Alice", last_name="Smith")
+        assert await puppet.update_displayname(source, user)
+        assert set_display_name.call_count == 1
+        assert puppet.displayname == "Alice Smith (Telegram)"
+
+        # The name update has the same hash, so the user isn't fetched and nothing is sent.
+        update = UpdateUserName(user_id=1, first_name="Alice", last_name="Smith", username=None)
+        assert not await puppet.update_displayname(source, update)
+        assert not await puppet.update_displayname(source, user)
+        assert set_display_name.call_count == 1
+        assert not source.client.get_entity.called
+
+        # Updates from other sources aren't skipped by the hash.
+        relaybot = mocker.Mock(is_relaybot=True, tgid=20)
+        assert await puppet.update_displayname(relaybot, user)
+        assert puppet.displayname_source == 20
+
+    @pytest.mark.asyncio
+    async def test_failed_update_is_retried(self, puppet, mocker) -> None:
+        source = mocker.Mock(is_relaybot=False, tgid=10)
+        set_display_name = puppet.default_mxid_intent.set_display_name
+        set_display_name.side_effect = ConnectionResetError()
+        user = User(id=1, first_name="Alice", last_name="Smith")
+        with pytest.raises(ConnectionResetError):
+            await puppet.update_displayname(source, user)
+        assert puppet.name_hash is None
+
+        set_display_name.side_effect = None
+        set_display_name.return_value = resolved()
+        assert await puppet.update_displayname(source, user)
+        assert puppet.name_hash == pu.Puppet.get_name_hash(user)
@@ -0,0 +1,200 @@
+from datetime import datetime, timezone
+import asyncio
+
+import pytest
+import sqlalchemy as sql
+from telethon.tl.types import Message, MessageActionChatEditTitle, MessageService, PeerChat
+
+from mautrix_telegram import user as _  # noqa: F401 (imported first to avoid an import cycle)
+from mautrix_telegram import portal as po, util
+from mautrix_telegram.db import (Base, DedupClaim, Message as DBMessage, Portal as DBPortal,
+                                 init as init_db)
+from mautrix_telegram.sharding import ShardRouter, shard_for
+
+
+@pytest.fixture
+def sharded_portals(tmpdir):
+    # Reloads run in a worker thread, which can't see an in-memory database.
+    db_engine = sql.create_engine(f"sqlite:///{tmpdir.join('portals.db')}")
+    Base.metadata.create_all(db_engine)
+    init_db(db_engine)
+    old_shards, po.Portal.shards = po.Portal.shards, ShardRouter(None, 4, 1, 29317, "hs_token",
+                                                                 reload_interval=60)
+    yield po.Portal.shards
+    po.Portal.shards = old_shards
+    po.Portal.by_tgid.clear()
+    po.Portal.by_mxid.clear()
+    Base.executor.shutdown()
+
+
+class TestShardRouter:
+    def test_shard_for_is_stable(self) -> None:
+        assert shard_for("@user:example.org", 1) == 0
+        shards = {shard_for(f"@user{i}:example.org", 4) for i in range(100)}
+        assert shards == {0, 1, 2, 3}
+        assert shard_for("@user:example.org", 4) == shard_for("@user:example.org", 4)
+
+    @pytest.mark.asyncio
+    async def test_route(self, mocker) -> None:
+        loop = asyncio.get_event_loop()
+        front = ShardRouter(loop, 4, 0, 29317, "hs_token")
+        send = mocker.patch.object(front, "_send")
+        send.return_value = asyncio.Future()
+        send.return_value.set_result(True)
+
+        users = [f"@user{i}:example.org" for i in range(20)]
+        local = [user for user in users if front.owns(user)]
+        remote = [user for user in users if not front.owns(user)]
+        assert not any(front.route({"sender": user}) for user in local)
+        assert all(front.route({"sender": user}) for user in remote)
+        await asyncio.sleep(0)
+
+        forwarded = [evt["sender"] for args, _ in send.call_args_list
+                     for evt in args[3]["events"]]
+        assert sorted(forwarded) == sorted(remote)
+        for args, _ in send.call_args_list:
+            assert all(front.owner(evt["sender"]) == args[0] for evt in args[3]["events"])
+
+    def test_workers_never_route(self) -> None:
+        worker = ShardRouter(None, 4, 2, 29317, "hs_token")
+        assert not any(worker.route({"sender": f"@user{i}:example.org"}) for i in range(20))
+
+    @pytest.mark.asyncio
+    async def test_state_events_go_to_every_shard(self, mocker) -> None:
+        loop = asyncio.get_event_loop()
+        front = ShardRouter(loop, 4, 0, 29317, "hs_token")
+        send = mocker.patch.object(front, "_send")
+        send.return_value = asyncio.Future()
+        send.return_value.set_result(True)
+
+        local = next(f"@user{i}:example.org" for i in range(20)
+                     if front.owns(f"@user{i}:example.org"))
+        assert not front.route({"sender": local, "type": "m.room.member", "state_key": local})
+        assert front.broadcast_state({"sender": "@telegram_1:example.org",
+                                      "type": "m.room.member", "state_key": ""})
+        assert not front.broadcast_state({"sender": local, "type": "m.room.message"})
+        await asyncio.sleep(0)
+
+        forwarded = sorted((args[0], evt["sender"]) for args, _ in send.call_args_list
+                           for evt in args[3]["events"])
+        assert forwarded == sorted((shard, sender) for shard in (1, 2, 3)
+                                   for sender in (local, "@telegram_1:example.org"))
+
+
+    @pytest.mark.asyncio
+    async def test_invalidate(self, mocker) -> None:
+        loop = asyncio.get_event_loop()
+        worker = ShardRouter(loop, 3, 1, 29317, "hs_token")
+        send = mocker.patch.object(worker, "_send")
+        send.return_value = asyncio.Future()
+        send.return_value.set_result(True)
+        worker.invalidate("portal", 1, 2)
+        await asyncio.sleep(0)
+        assert sorted(args[0] for args, _ in send.call_args_list) == [0, 2]
+        assert all(args[3] == {"objects": [{"type": "portal", "key": [1, 2]}]}
+                   for args, _ in send.call_args_list)
+
+        reloaded = []
+
+        async def reload_portal(*key) -> None:
+            reloaded.append(key)
+
+        worker.reloaders["portal"] = reload_portal
+        request = mocker.Mock(headers={"Authorization": "Bearer hs_token"})
+        request.json.return_value = asyncio.Future()
+        request.json.return_value.set_result(send.call_args[0][3])
+        response = await worker._http_invalidate(request)
+        await asyncio.sleep(0)
+        assert response.status == 200
+        assert reloaded == [(1, 2)]
+
+
+class TestShardedPortal:
+    @pytest.mark.asyncio
+    async def test_room_created_by_other_shard(self, sharded_portals) -> None:
+        DBPortal(tgid=1, tg_receiver=1, peer_type="chat").insert()
+        portal = po.Portal.get_by_tgid(1)
+        assert not portal.mxid
+
+        # Another shard creates the room and tells this shard to reload the portal.
+        DBPortal.get_by_tgid(1, 1).update(mxid="!room:example.org")
+        await po.Portal.reload_cached(1, 1)
+        assert po.Portal.get_by_tgid(1) is portal
+        assert portal.mxid == "!room:example.org"
+        assert po.Portal.get_by_mxid("!room:example.org") is portal
+
+        # A portal that was loaded before doesn't unset the room when it's saved.
+        stale = DBPortal.get_by_tgid(1, 1)
+        stale.mxid = None
+        assert not stale.claim_mxid("!other:example.org")
+        portal.mxid = None
+        portal.save()
+        assert DBPortal.get_by_tgid(1, 1).mxid == "!room:example.org"
+
+    @pytest.mark.asyncio
+    async def test_save_invalidates(self, sharded_portals, mocker) -> None:
+        invalidate = mocker.patch.object(sharded_portals, "invalidate")
+        DBPortal(tgid=1, tg_receiver=1, peer_type="chat").insert()
+        portal = po.Portal.get_by_tgid(1)
+        portal.title = "Title"
+        portal.save()
+        portal.delete()
+        assert invalidate.call_args_list == [mocker.call("portal", 1, 1)] * 2
+
+    @pytest.mark.asyncio
+    async def test_reload_interval(self, sharded_portals, mocker) -> None:
+        mocker.patch.object(po.Portal, "loop", asyncio.get_event_loop())
+        DBPortal(tgid=1, tg_receiver=1, peer_type="chat", mxid="!room:example.org").insert()
+        portal = po.Portal.get_by_tgid(1)
+        DBPortal.get_by_tgid(1, 1).update(title="New title")
+        assert po.Portal.get_by_tgid(1).title is None
+
+        # Stale portals are returned right away and reloaded in the background.
+        portal._loaded_at -= 60
+        assert po.Portal.get_by_tgid(1) is portal
+        for _ in range(100):
+            if portal.title:
+                break
+            await asyncio.sleep(0.01)
+        assert portal.title == "New title"
+
+        DBPortal.get_by_tgid(1, 1).delete()
+        await po.Portal.reload_cached(1, 1)
+        assert po.Portal.get_by_tgid(1) is None
+        assert portal.deleted
+
+    @pytest.mark.asyncio
+    async def test_lost_claim_maps_message(self, sharded_portals, mocker) -> None:
+        mocker.patch.object(po.Portal, "loop", asyncio.get_event_loop())
+        mocker.patch.object(po.Portal, "dedup", util.DedupStore())
+        mocker.patch.object(po.Portal, "dedup_shared", True)
+        portal = po.Portal(1, peer_type="chat", mxid="!room:example.org")
+        # Group messages have a different ID for each user, so the shards see different IDs.
+        date = datetime(2019, 3, 1, tzinfo=timezone.utc)
+        winner_copy = Message(id=10, to_id=PeerChat(1), date=date, message="hi")
+        loser_copy = Message(id=20, to_id=PeerChat(1), date=date, message="hi")
+        key = portal._dedup_key(loser_copy)
+        assert key == portal._dedup_key(winner_copy)
+
+        assert await portal.claim_shared(key)
+        assert not await portal.claim_shared(key)
+        DedupClaim.store(*key, "$event", 100)
+        portal.is_duplicate(loser_copy, ("$temp", 200), persist=False)
+        await portal._map_claimed_message(key, loser_copy, 200, "$temp")
+        assert DBMessage.get_by_tgid(20, 200).mxid == "$event"
+        assert portal.is_duplicate(loser_copy) == ("$event", 100)
+
+    @pytest.mark.asyncio
+    async def test_edits_and_actions_are_claimed_separately(self, sharded_portals,
+                                                            mocker) -> None:
+        mocker.patch.object(po.Portal, "dedup_shared", True)
+        portal = po.Portal(1, peer_type="channel", mxid="!room:example.org")
+        date = datetime(2019, 3, 1, tzinfo=timezone.utc)
+        message = Message(id=10, to_id=PeerChat(1), date=date, message="hi")
+        action = MessageService(id=10, to_id=PeerChat(1), date=date,
+                                action=MessageActionChatEditTitle(title="Title"))
+        keys = [portal._dedup_key(message), portal._edit_dedup_key(message),
+                portal._action_dedup_key(action)]
+        assert len(set(keys)) == 3
+        assert all([await portal.claim_shared(key) for key in keys])
+        assert not any([await portal.claim_shared(key) for key in keys])
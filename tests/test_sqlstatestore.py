@@ -0,0 +1,128 @@
+import pytest
+import sqlalchemy as sql
+
+from mautrix_telegram import user as _  # noqa: F401
+from mautrix_telegram.db import Base, RoomState, UserProfile, init as init_db
+from mautrix_telegram.sqlstatestore import SQLStateStore
+
+ROOM = "!room:example.com"
+
+
+@pytest.fixture
+def db(tmpdir):
+    # The preload runs in a worker thread, which can't see an in-memory database.
+    db_engine = sql.create_engine(f"sqlite:///{tmpdir.join('state.db')}")
+    Base.metadata.create_all(db_engine)
+    init_db(db_engine)
+    UserProfile(room_id=ROOM, user_id="@alice:example.com", membership="join").insert()
+    RoomState(room_id=ROOM, power_levels={"users": {"@alice:example.com": 100}}).insert()
+    yield db_engine
+    Base.executor.shutdown()
+
+
+def make_store(preload: str) -> SQLStateStore:
+    # Writes are only done when the tests flush the store.
+    return SQLStateStore(preload, write_max_size=1000, write_delay=60)
+
+
+def count_profiles(db_engine) -> int:
+    return db_engine.execute(sql.select([sql.func.count()]).select_from(UserProfile.t)).scalar()
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("preload", ["lazy", "room"])
+async def test_misses_are_not_inserted(db, preload) -> None:
+    store = make_store(preload)
+    assert store.is_joined(ROOM, "@alice:example.com")
+    assert not store.is_joined(ROOM, "@bob:example.com")
+    assert store.has_power_levels(ROOM)
+    assert not store.has_power_levels("!other:example.com")
+    assert count_profiles(db) == 1
+
+    store.joined(ROOM, "@bob:example.com")
+    store.set_member(ROOM, "@alice:example.com", {"membership": "leave"})
+    store.set_power_levels("!other:example.com", {"users": {}})
+    store.flush()
+    assert UserProfile.get(ROOM, "@bob:example.com").membership == "join"
+    assert UserProfile.get(ROOM, "@alice:example.com").membership == "leave"
+    assert RoomState.get("!other:example.com").power_levels == {"users": {}}
+
+
+@pytest.mark.asyncio
+async def test_set_members_coalesces(db) -> None:
+    store = make_store("lazy")
+    store.set_members(ROOM, {f"@user{i}:example.com": {"membership": "join"} for i in range(600)})
+    store.set_members(ROOM, {"@alice:example.com": {"membership": "leave"},
+                             "@user1:example.com": {"membership": "join", "displayname": "One"}})
+    assert store.queued_writes == 601
+    assert count_profiles(db) == 1
+
+    store.flush()
+    assert store.queued_writes == 0
+    assert count_profiles(db) == 601
+    assert UserProfile.get(ROOM, "@alice:example.com").membership == "leave"
+    assert UserProfile.get(ROOM, "@user1:example.com").displayname == "One"
+
+
+@pytest.mark.asyncio
+async def test_background_write(db) -> None:
+    store = SQLStateStore(write_max_size=2, write_delay=60)
+    store.joined(ROOM, "@bob:example.com")
+    store.set_power_levels(ROOM, {"users": {}})
+    assert store.queued_writes == 0
+    # The queue is written again once the first write is done.
+    store.joined(ROOM, "@carol:example.com")
+    store.joined(ROOM, "@dave:example.com")
+    await store._writing
+    await store._writing
+    assert RoomState.get(ROOM).power_levels == {"users": {}}
+    assert count_profiles(db) == 4
+
+
+
+@pytest.mark.asyncio
+async def test_failed_write_is_requeued(db, mocker) -> None:
+    store = make_store("lazy")
+    store.joined(ROOM, "@bob:example.com")
+    store.set_power_levels(ROOM, {"users": {}})
+    error = sql.exc.OperationalError("", {}, None)
+    mocker.patch.object(RoomState, "bulk_upsert", side_effect=error)
+    store._start_write()
+    # A change queued while the write is running is newer than the one being written.
+    store.set_power_levels(ROOM, {"users": {"@bob:example.com": 50}})
+    with pytest.raises(sql.exc.OperationalError):
+        await store._writing
+    assert store.queued_writes == 2
+    assert store._queued_room_states[ROOM].power_levels == {"users": {"@bob:example.com": 50}}
+
+    mocker.stopall()
+    store.flush()
+    assert store.queued_writes == 0
+    assert UserProfile.get(ROOM, "@bob:example.com").membership == "join"
+    assert RoomState.get(ROOM).power_levels == {"users": {"@bob:example.com": 50}}
+
+
+def test_worker_store_does_not_write(db) -> None:
+    store = SQLStateStore(write_max_size=1, write_delay=60, persist=False)
+    store.joined(ROOM, "@bob:example.com")
+    assert store.is_joined(ROOM, "@bob:example.com")
+    assert store.queued_writes == 0
+    store.flush()
+    assert count_profiles(db) == 1
+
+def test_room_preload(db) -> None:
+    store = make_store("room")
+    assert not store.is_joined(ROOM, "@bob:example.com")
+    assert store.profile_cache[(ROOM, "@alice:example.com")].membership == "join"
+    assert ROOM in store.room_state_cache
+
+
+@pytest.mark.asyncio
+async def test_startup_preload(db) -> None:
+    store = make_store("startup")
+    await store.preload_all()
+    UserProfile.delete_all(ROOM)
+
+    assert store.is_joined(ROOM, "@alice:example.com")
+    assert store.get_power_levels(ROOM)["users"]["@alice:example.com"] == 100
+    assert not store.is_joined("!other:example.com", "@alice:example.com")
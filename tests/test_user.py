@@ -0,0 +1,74 @@
+import pytest
+import sqlalchemy as sql
+
+from mautrix_telegram import user as u, portal as po
+from mautrix_telegram.db import Base, Portal as DBPortal, User as DBUser, init as init_db
+from mautrix_telegram.sharding import ShardRouter
+
+
+@pytest.fixture
+def user(mocker):
+    db_engine = sql.create_engine("sqlite://")
+    Base.metadata.create_all(db_engine)
+    init_db(db_engine)
+    config = mocker.Mock()
+    config.get_permissions.return_value = (True, True, True, True, False, 10)
+    mocker.patch.object(u, "config", config)
+    shards = ShardRouter(None, 1, 0, 0, "hs_token")
+    mocker.patch.object(po.Portal, "shards", shards)
+    mocker.patch.object(u.User, "shards", shards)
+    for tgid in (1, 2):
+        DBPortal(tgid=tgid, tg_receiver=tgid, peer_type="chat").insert()
+    DBUser(mxid="@user:example.com", tgid=10, saved_contacts=0).insert()
+    user = u.User.get_by_mxid("@user:example.com")
+    yield user
+    for cache in (u.User.by_mxid, u.User.by_tgid, po.Portal.by_tgid, po.Portal.by_mxid):
+        cache.clear()
+    Base.executor.shutdown()
+
+
+class TestUserPortals:
+    def test_portals_are_stored_by_id(self, user) -> None:
+        portal = po.Portal.get_by_tgid(1)
+        user.register_portal(portal)
+        # Only the ID is kept, so the user doesn't keep an evicted portal alive.
+        assert user.portals == {(1, 1)}
+        assert list(DBUser.get_by_mxid(user.mxid).portals) == [(1, 1)]
+        po.Portal.by_tgid.clear()
+        assert po.Portal.get_by_tgid(1) is not portal
+        user.register_portal(po.Portal.get_by_tgid(1))
+        assert user.portals == {(1, 1)}
+
+    def test_register_reloaded_portal(self, user, mocker) -> None:
+        user.register_portal(po.Portal.get_by_tgid(1))
+        po.Portal.by_tgid.clear()
+        save = mocker.patch.object(user, "save")
+        user.register_portal(po.Portal.get_by_tgid(1))
+        assert not save.called
+
+        user.unregister_portal(po.Portal.get_by_tgid(1))
+        assert user.portals == set()
+        save.assert_called_once_with(portals=True)
+
+    def test_deleted_and_migrated_portals(self, user) -> None:
+        user.register_portal(po.Portal.get_by_tgid(1))
+        user.register_portal(po.Portal.get_by_tgid(2))
+
+        po.Portal.get_by_tgid(1).delete()
+        po.Portal.get_by_tgid(2).migrate_and_save_telegram(3)
+        assert user.portals == {(3, 3)}
+        user.save(portals=True)
+        assert list(DBUser.get_by_mxid(user.mxid).portals) == [(3, 3)]
+
+
+class TestUpdateQueues:
+    def test_deletions_only_wait_for_own_chats(self, user) -> None:
+        user.register_portal(po.Portal.get_by_tgid(1))
+        other = u.User("@other:example.com", tgid=20)
+        assert user._is_non_channel_queue_key(10)
+        assert user._is_non_channel_queue_key((5, 10))
+        assert user._is_non_channel_queue_key((1, 1))
+        assert not user._is_non_channel_queue_key((2, 2))
+        assert not user._is_non_channel_queue_key(("puppet", 10))
+        assert not other._is_non_channel_queue_key((1, 1))
+        assert not other._is_non_channel_queue_key((5, 10))
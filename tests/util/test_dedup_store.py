@@ -0,0 +1,63 @@
+import asyncio
+import time
+
+import pytest
+import sqlalchemy as sql
+
+from mautrix_telegram.db import Base, DedupClaim, init as init_db
+from mautrix_telegram.util.dedup_store import DedupStore, NOT_FOUND
+
+KEY = (1, 1, "hash")
+
+
+@pytest.fixture
+def db(tmp_path):
+    # The entries are written from the executor threads, which can't see an in-memory database.
+    db_engine = sql.create_engine(f"sqlite:///{tmp_path}/dedup.db")
+    Base.metadata.create_all(db_engine)
+    init_db(db_engine)
+    yield
+    Base.executor.shutdown()
+
+
+class TestDedupStore:
+    def test_check_and_update(self) -> None:
+        store = DedupStore()
+        assert store.check(KEY, ("$temp", 10)) == (False, None)
+        assert store.check(KEY, ("$other", 10)) == (True, ("$temp", 10))
+
+        assert store.update(KEY, ("$real", 10), ("$wrong", 10)) == ("$temp", 10)
+        assert store.update(KEY, ("$real", 10), ("$temp", 10)) is None
+        assert store.check(KEY, None) == (True, ("$real", 10))
+        assert store.update((1, 1, "missing"), ("$real", 10), None) == NOT_FOUND
+        assert store.stats()["hits"] == 2
+        assert store.stats()["misses"] == 1
+
+    def test_eviction(self) -> None:
+        store = DedupStore(max_entries=2)
+        for i in range(3):
+            store.check((1, 1, str(i)), (f"${i}", 10))
+        assert store.size == 2
+        assert store.evictions == 1
+        assert store.check((1, 1, "0"), None) == (False, None)
+
+        store = DedupStore(max_age=10)
+        store.check(KEY, ("$a", 10))
+        store._entries[KEY] = (time.monotonic() - 20, ("$a", 10))
+        assert store.check(KEY, ("$b", 10)) == (False, None)
+
+    @pytest.mark.asyncio
+    async def test_persist(self, db) -> None:
+        store = DedupStore(persist=True, loop=asyncio.get_event_loop())
+        store.check(KEY, ("$temp", 10), persist=False)
+        store.update(KEY, ("$real", 10), ("$temp", 10))
+        store.check((1, 1, "a:action"), None)
+        for _ in range(100):
+            if len(DedupClaim.db.execute(DedupClaim.t.select()).fetchall()) == 2:
+                break
+            await asyncio.sleep(0.01)
+
+        loaded = DedupStore(persist=True)
+        loaded.load()
+        assert loaded.check(KEY, None) == (True, ("$real", 10))
+        assert loaded.check((1, 1, "a:action"), None) == (True, None)
@@ -0,0 +1,83 @@
+import asyncio
+
+import pytest
+
+from mautrix_telegram.util import EphemeralCoalescer
+
+
+class Recorder:
+    def __init__(self) -> None:
+        self.sent = []
+
+    def sender(self, key, state):
+        async def send() -> None:
+            self.sent.append((key, state))
+        return send
+
+
+def make_coalescer() -> EphemeralCoalescer:
+    return EphemeralCoalescer(asyncio.get_event_loop(), delay=0.01)
+
+
+async def flush() -> None:
+    await asyncio.sleep(0.03)
+
+
+class TestEphemeralCoalescer:
+    @pytest.mark.asyncio
+    async def test_keeps_latest_state(self) -> None:
+        coalescer = make_coalescer()
+        recorder = Recorder()
+        for state in (True, False, True):
+            coalescer.set("a", state, recorder.sender("a", state))
+        coalescer.set("b", False, recorder.sender("b", False))
+        await flush()
+
+        assert recorder.sent == [("a", True), ("b", False)]
+        assert coalescer.coalesced == 2
+
+    @pytest.mark.asyncio
+    async def test_suppresses_noop(self) -> None:
+        coalescer = make_coalescer()
+        recorder = Recorder()
+        coalescer.set("a", "online", recorder.sender("a", "online"))
+        await flush()
+        coalescer.set("a", "online", recorder.sender("a", "online"))
+        coalescer.set("b", True, recorder.sender("b", True), refresh=0)
+        await flush()
+        # States that expire on the other side are sent again after the refresh interval.
+        coalescer.set("b", True, recorder.sender("b", True), refresh=0)
+        await flush()
+
+        assert recorder.sent == [("a", "online"), ("b", True), ("b", True)]
+        assert coalescer.suppressed == 1
+
+    @pytest.mark.asyncio
+    async def test_set_now(self) -> None:
+        coalescer = make_coalescer()
+        recorder = Recorder()
+        await coalescer.set_now("a", False, recorder.sender("a", False), default=False)
+        coalescer.set("a", True, recorder.sender("a", True))
+        await coalescer.set_now("a", False, recorder.sender("a", False), default=False)
+        await flush()
+        assert recorder.sent == []
+
+        coalescer.set("a", True, recorder.sender("a", True))
+        await flush()
+        await coalescer.set_now("a", False, recorder.sender("a", False), default=False)
+        assert recorder.sent == [("a", True), ("a", False)]
+
+    @pytest.mark.asyncio
+    async def test_sheds_when_overloaded(self) -> None:
+        coalescer = make_coalescer()
+        recorder = Recorder()
+        overloaded = True
+        coalescer.overload_checks.append(lambda: overloaded)
+        coalescer.set("a", True, recorder.sender("a", True))
+        await flush()
+        overloaded = False
+        coalescer.set("b", True, recorder.sender("b", True))
+        await flush()
+
+        assert recorder.sent == [("b", True)]
+        assert coalescer.shed == 1
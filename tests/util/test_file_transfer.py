@@ -0,0 +1,54 @@
+from concurrent.futures import ProcessPoolExecutor
+import asyncio
+import time
+
+import pytest
+
+from mautrix_telegram import user as _  # noqa: F401 (imported first to avoid an import cycle)
+from mautrix_telegram.util import file_transfer
+
+
+def hang(seconds: float) -> str:
+    time.sleep(seconds)
+    return "done"
+
+
+@pytest.fixture
+def media_pool():
+    file_transfer.media_pool_workers = 1
+    file_transfer.media_pool = ProcessPoolExecutor(max_workers=1)
+    file_transfer.media_semaphore = asyncio.Semaphore(1)
+    file_transfer.media_timeout = 0.5
+    yield
+    file_transfer.media_pool.shutdown(wait=False)
+    file_transfer.media_pool = None
+
+
+@pytest.mark.asyncio
+async def test_timed_out_task_restarts_pool(media_pool) -> None:
+    pool = file_transfer.media_pool
+    assert await file_transfer._run_media_task(hang, 60, fallback="fallback") == "fallback"
+    assert file_transfer.media_pool is not pool
+    # The stuck worker was killed, so the next task gets a worker right away.
+    assert await file_transfer._run_media_task(hang, 0, fallback="fallback") == "done"
+
+
+class FakeDownload:
+    def __init__(self, *chunks: bytes) -> None:
+        self.chunks = list(chunks)
+
+    async def __anext__(self) -> bytes:
+        if not self.chunks:
+            raise StopAsyncIteration
+        return self.chunks.pop(0)
+
+
+@pytest.mark.asyncio
+async def test_upload_stream_tee(tmpdir) -> None:
+    path = str(tmpdir.join("video.mp4"))
+    stream = file_transfer._UploadStream(b"first ", FakeDownload(b"second ", b"third"),
+                                         tee_path=path)
+    assert b"".join([chunk async for chunk in stream]) == b"first second third"
+    assert stream.size == 18
+    with open(path, "rb") as file:
+        assert file.read() == b"first second third"
@@ -0,0 +1,52 @@
+from datetime import datetime, timezone
+
+from telethon.tl.types import (Message, MessageActionChatAddUser, MessageActionChatEditTitle,
+                               MessageFwdHeader, MessageMediaGeo, MessageMediaPhoto,
+                               MessageMediaWebPage, MessageService, GeoPoint, Photo, WebPage,
+                               WebPagePending)
+
+from mautrix_telegram.util import fingerprint_event
+
+DATE = datetime(2019, 3, 1, 12, 0, tzinfo=timezone.utc)
+
+
+def photo(photo_id: int) -> MessageMediaPhoto:
+    return MessageMediaPhoto(photo=Photo(id=photo_id, access_hash=1, file_reference=b"",
+                                         date=DATE, sizes=[]))
+
+
+class TestFingerprint:
+    def test_ignores_receiver_specific_fields(self) -> None:
+        # Each receiver gets a different message ID and may get the link preview later.
+        first = Message(id=1, date=DATE, message="https://example.com",
+                        media=MessageMediaWebPage(webpage=WebPagePending(id=5, date=0)))
+        second = Message(id=2, date=DATE, message="https://example.com",
+                         media=MessageMediaWebPage(webpage=WebPage(
+                             id=5, url="https://example.com", display_url="example.com",
+                             hash=0)))
+        assert fingerprint_event(first) == fingerprint_event(second)
+        assert len(fingerprint_event(first)) == 16
+
+    def test_content_changes_fingerprint(self) -> None:
+        fingerprints = {fingerprint_event(event) for event in [
+            Message(id=1, date=DATE, message="a"),
+            Message(id=1, date=DATE, message="b"),
+            Message(id=1, date=datetime(2019, 3, 1, 12, 1, tzinfo=timezone.utc), message="a"),
+            Message(id=1, date=DATE, message="a", fwd_from=MessageFwdHeader(date=DATE,
+                                                                             from_id=1)),
+            Message(id=1, date=DATE, message="", media=photo(1)),
+            Message(id=1, date=DATE, message="", media=photo(2)),
+            Message(id=1, date=DATE, message="", media=MessageMediaGeo(
+                geo=GeoPoint(long=1.0, lat=2.0, access_hash=0))),
+            Message(id=1, date=DATE, message="", media=MessageMediaGeo(
+                geo=GeoPoint(long=2.0, lat=1.0, access_hash=0))),
+            MessageService(id=1, date=DATE, from_id=1,
+                           action=MessageActionChatAddUser(users=[1, 2])),
+            MessageService(id=1, date=DATE, from_id=1,
+                           action=MessageActionChatAddUser(users=[1, 3])),
+            MessageService(id=1, date=DATE, from_id=2,
+                           action=MessageActionChatAddUser(users=[1, 2])),
+            MessageService(id=1, date=DATE, from_id=1,
+                           action=MessageActionChatEditTitle(title="a")),
+        ]}
+        assert len(fingerprints) == 12
@@ -0,0 +1,63 @@
+from mautrix_telegram.util import InstanceCache
+
+
+class Item:
+    def __init__(self, key: int, pinned: bool = False) -> None:
+        self.key = key
+        self.pinned = pinned
+        self.payload = "x" * 100
+
+
+def make_cache(max_size: int, evicted: list) -> InstanceCache:
+    cache = InstanceCache("test", max_size)
+    cache.is_pinned = lambda item: item.pinned
+    cache.on_evict = evicted.append
+    return cache
+
+
+class TestInstanceCache:
+    def test_evicts_least_recently_used(self) -> None:
+        evicted = []
+        cache = make_cache(2, evicted)
+        cache[1], cache[2] = Item(1), Item(2)
+        assert cache[1].key == 1
+        cache[3] = Item(3)
+
+        assert sorted(cache) == [1, 3]
+        assert [item.key for item in evicted] == [2]
+        assert cache.evictions == 1
+
+    def test_pinned_entries_stay(self) -> None:
+        evicted = []
+        cache = make_cache(2, evicted)
+        cache[1] = Item(1, pinned=True)
+        cache[2] = Item(2)
+        cache[3] = Item(3)
+        assert sorted(cache) == [1, 3]
+
+        # If everything is pinned, the cache is allowed to grow over the limit.
+        cache[3].pinned = True
+        cache[4] = Item(4, pinned=True)
+        assert sorted(cache) == [1, 3, 4]
+        assert [item.key for item in evicted] == [2]
+
+    def test_unbounded(self) -> None:
+        cache = make_cache(0, [])
+        for i in range(100):
+            cache[i] = Item(i)
+        assert len(cache) == 100
+
+    def test_discard_and_stats(self) -> None:
+        cache = make_cache(10, [])
+        item = cache[1] = Item(1)
+        cache.discard(1, Item(1))
+        assert 1 in cache
+        cache.discard(1, item)
+        assert 1 not in cache
+
+        cache[2] = Item(2)
+        assert cache.get(1) is None
+        stats = cache.stats()
+        assert stats["size"] == 1
+        assert stats["misses"] == 1
+        assert stats["memory"] > 100
@@ -0,0 +1,143 @@
+import asyncio
+import os
+
+import pytest
+
+from mautrix_telegram.util.media_cache import MediaCache
+
+
+class FakeContent:
+    def __init__(self, data: bytes, fail: bool) -> None:
+        self.data = data
+        self.fail = fail
+
+    def iter_chunked(self, size: int) -> 'FakeContent':
+        self.chunks = [self.data[i:i + size] for i in range(0, len(self.data), size)]
+        return self
+
+    def __aiter__(self) -> 'FakeContent':
+        return self
+
+    async def __anext__(self) -> bytes:
+        await asyncio.sleep(0)
+        if not self.chunks:
+            if self.fail:
+                raise ConnectionResetError()
+            raise StopAsyncIteration()
+        return self.chunks.pop(0)
+
+
+class FakeResponse:
+    def __init__(self, data: bytes, fail: bool) -> None:
+        self.content = FakeContent(data, fail)
+
+    async def __aenter__(self) -> 'FakeResponse':
+        return self
+
+    async def __aexit__(self, *_) -> None:
+        pass
+
+    def raise_for_status(self) -> None:
+        pass
+
+
+class FakeIntent:
+    def __init__(self, files: dict) -> None:
+        self.files = files
+        self.downloads = []
+        self.failures = 0
+        self.client = self
+        self.session = self
+
+    async def ensure_registered(self) -> None:
+        pass
+
+    def get_download_url(self, mxc: str) -> str:
+        return mxc
+
+    def get(self, url: str) -> FakeResponse:
+        self.downloads.append(url)
+        fail = self.failures > 0
+        self.failures -= 1
+        return FakeResponse(self.files[url], fail)
+
+
+@pytest.fixture
+def intent() -> FakeIntent:
+    return FakeIntent({"mxc://a": b"a" * 100, "mxc://b": b"b" * 100, "mxc://c": b"c" * 100})
+
+
+@pytest.mark.asyncio
+async def test_concurrent_downloads(tmpdir, intent) -> None:
+    cache = MediaCache(str(tmpdir), 1000)
+    paths = await asyncio.gather(*[cache.acquire(intent, "mxc://a") for _ in range(3)])
+    assert intent.downloads == ["mxc://a"]
+    assert len(set(paths)) == 1
+    with open(paths[0], "rb") as file:
+        assert file.read() == b"a" * 100
+    assert (cache.hits, cache.misses) == (2, 1)
+    assert not cache._locks and not cache._lock_users
+
+    for _ in range(3):
+        cache.release("mxc://a")
+    assert not cache._pins
+
+
+@pytest.mark.asyncio
+async def test_pinned_files_are_not_evicted(tmpdir, intent) -> None:
+    cache = MediaCache(str(tmpdir), 150)
+    path_a = await cache.acquire(intent, "mxc://a")
+    path_b = await cache.acquire(intent, "mxc://b")
+    # a is the least recently used file, but it's still in use.
+    assert os.path.exists(path_a) and os.path.exists(path_b)
+    assert cache.size == 200
+
+    cache.release("mxc://a")
+    assert not os.path.exists(path_a)
+    assert cache.size == 100
+    cache.release("mxc://b")
+
+    path_c = await cache.acquire(intent, "mxc://c")
+    cache.release("mxc://c")
+    assert not os.path.exists(path_b) and os.path.exists(path_c)
+
+
+@pytest.mark.asyncio
+async def test_failed_download(tmpdir, intent) -> None:
+    cache = MediaCache(str(tmpdir), 1000)
+    intent.failures = 1
+    with pytest.raises(ConnectionResetError):
+        await cache.acquire(intent, "mxc://a")
+    assert os.listdir(str(tmpdir)) == []
+    assert cache.size == 0 and not cache._locks and not cache._pins
+
+    assert await cache.acquire(intent, "mxc://a")
+
+
+@pytest.mark.asyncio
+async def test_lock_outlives_failed_download(tmpdir, intent) -> None:
+    cache = MediaCache(str(tmpdir), 1000)
+    intent.failures = 1
+    first = asyncio.ensure_future(cache.acquire(intent, "mxc://a"))
+    second = asyncio.ensure_future(cache.acquire(intent, "mxc://a"))
+    with pytest.raises(ConnectionResetError):
+        await first
+    # The second caller is downloading the file again, so a third one has to wait for it instead
+    # of writing the same temporary file at the same time.
+    third = asyncio.ensure_future(cache.acquire(intent, "mxc://a"))
+    assert await second == await third
+    assert intent.downloads == ["mxc://a", "mxc://a"]
+    assert not cache._locks
+
+
+@pytest.mark.asyncio
+async def test_load(tmpdir, intent) -> None:
+    cache = MediaCache(str(tmpdir), 1000)
+    path = await cache.acquire(intent, "mxc://a")
+    cache.release("mxc://a")
+    tmpdir.join("interrupted.part").write_binary(b"x")
+
+    cache = MediaCache(str(tmpdir), 1000)
+    assert cache.size == 100
+    assert cache.get("mxc://a") == path
+    assert not tmpdir.join("interrupted.part").exists()
@@ -0,0 +1,49 @@
+import asyncio
+
+import pytest
+from mautrix_appservice import MatrixRequestError
+
+from mautrix_telegram.util import RedactionQueue
+
+
+class FakeIntent:
+    def __init__(self) -> None:
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.redacted = []
+
+    async def redact(self, room_id: str, event_id: str) -> None:
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        await asyncio.sleep(0.01)
+        self.in_flight -= 1
+        if event_id == "$fail":
+            raise MatrixRequestError(code=403, text="Forbidden")
+        self.redacted.append(event_id)
+
+
+@pytest.mark.asyncio
+async def test_concurrency_limit() -> None:
+    loop = asyncio.get_event_loop()
+    queue = RedactionQueue(loop, concurrency=3, rate=0)
+    intent = FakeIntent()
+    for i in range(20):
+        queue.redact(intent, "!room", f"${i}")
+    queue.redact(intent, "!room", "$fail")
+    assert queue.pending > 0
+    await queue.join()
+
+    assert sorted(intent.redacted) == sorted(f"${i}" for i in range(20))
+    assert intent.max_in_flight == 3
+    assert (queue.redacted, queue.failed, queue.pending) == (20, 1, 0)
+
+
+@pytest.mark.asyncio
+async def test_rate_limit() -> None:
+    loop = asyncio.get_event_loop()
+    queue = RedactionQueue(loop, concurrency=10, rate=100)
+    start = loop.time()
+    for i in range(6):
+        queue.redact(FakeIntent(), "!room", f"${i}")
+    await queue.join()
+    assert loop.time() - start >= 0.05
@@ -0,0 +1,153 @@
+import asyncio
+
+import pytest
+from mautrix_appservice import MatrixRequestError
+from mautrix_appservice.intent_api import HTTPAPI
+
+from mautrix_telegram.util import RequestScheduler
+from mautrix_telegram.util.request_scheduler import (LANE_DEFAULT, LANE_EPHEMERAL, LANE_MESSAGE,
+                                                     is_long_poll, request_lane,
+                                                     retry_after)
+
+
+def test_request_lane() -> None:
+    base = "https://example.com/_matrix/client/r0"
+    assert request_lane("PUT", f"{base}/rooms/!a/send/m.room.message/1") == LANE_MESSAGE
+    assert request_lane("PUT", f"{base}/rooms/!a/redact/$b/2") == LANE_MESSAGE
+    assert request_lane("PUT", f"{base}/rooms/!a/typing/@b") == LANE_EPHEMERAL
+    assert request_lane("PUT", f"{base}/presence/@b/status") == LANE_EPHEMERAL
+    assert request_lane("PUT", f"{base}/profile/@b/displayname") == LANE_DEFAULT
+    assert request_lane("GET", f"{base}/rooms/!a/state/m.room.power_levels/") == LANE_DEFAULT
+
+    assert request_lane("GET", f"{base}/rooms/!a/state/m.room.power_levels/") == LANE_DEFAULT
+
+
+def test_is_long_poll() -> None:
+    base = "https://example.com/_matrix/client/r0"
+    assert is_long_poll("GET", f"{base}/sync")
+    assert not is_long_poll("GET", f"{base}/rooms/!a/messages")
+    assert not is_long_poll("POST", f"{base}/user/@a/filter")
+
+
+def test_retry_after() -> None:
+    error = MatrixRequestError(code=429, text='{"errcode": "M_LIMIT_EXCEEDED", '
+                                              '"retry_after_ms": 1500}')
+    assert retry_after(error) == 1.5
+    assert retry_after(MatrixRequestError(code=429, text="Too many requests")) == 5
+
+
+class TestRequestScheduler:
+    @pytest.mark.asyncio
+    async def test_messages_before_typing(self) -> None:
+        scheduler = RequestScheduler(asyncio.get_event_loop(), max_concurrent=1, rate=0,
+                                     user_rate=0)
+        sent = []
+        release = asyncio.Event()
+
+        async def blocker() -> None:
+            await release.wait()
+
+        def request(name: str):
+            async def send() -> str:
+                sent.append(name)
+                return name
+            return send
+
+        first = asyncio.ensure_future(scheduler.run("@a", LANE_DEFAULT, blocker))
+        await asyncio.sleep(0)
+        typing = asyncio.ensure_future(scheduler.run("@a", LANE_EPHEMERAL, request("typing")))
+        message = asyncio.ensure_future(scheduler.run("@b", LANE_MESSAGE, request("message")))
+        await asyncio.sleep(0)
+        assert scheduler.queue_depth(LANE_EPHEMERAL) == 1
+        release.set()
+        await asyncio.gather(first, typing, message)
+
+        assert sent == ["message", "typing"]
+        assert scheduler.queued == scheduler.in_flight == 0
+
+    @pytest.mark.asyncio
+    async def test_user_bucket(self) -> None:
+        loop = asyncio.get_event_loop()
+        scheduler = RequestScheduler(loop, rate=0, user_rate=100, user_burst=2)
+
+        async def send() -> None:
+            pass
+
+        start = loop.time()
+        await asyncio.gather(*[scheduler.run("@a", LANE_MESSAGE, send) for _ in range(5)])
+        # Two requests fit in the burst, the other three have to wait 10ms each.
+        assert loop.time() - start >= 0.03
+        start = loop.time()
+        await scheduler.run("@b", LANE_MESSAGE, send)
+        assert loop.time() - start < 0.01
+        assert scheduler.requests == 6
+
+    @pytest.mark.asyncio
+    async def test_rate_limited_retry(self) -> None:
+        loop = asyncio.get_event_loop()
+        scheduler = RequestScheduler(loop, rate=0, user_rate=0, max_retries=1)
+        attempts = []
+
+        async def send() -> str:
+            attempts.append(loop.time())
+            raise MatrixRequestError(code=429, text='{"retry_after_ms": 20}')
+
+        with pytest.raises(MatrixRequestError):
+            await scheduler.run("@a", LANE_MESSAGE, send)
+        assert len(attempts) == 2
+        assert attempts[1] - attempts[0] >= 0.02
+        assert scheduler.rate_limited == 1
+        assert scheduler.in_flight == 0
+
+    @pytest.mark.asyncio
+    async def test_streamed_body_not_retried(self, mocker) -> None:
+        scheduler = RequestScheduler(asyncio.get_event_loop(), rate=0, user_rate=0)
+        error = MatrixRequestError(code=429, text='{"retry_after_ms": 20}')
+        original_send = mocker.patch.object(HTTPAPI, "_send", side_effect=error)
+        scheduler.install()
+        api = mocker.Mock(identity=None, bot_mxid="@bot")
+
+        async def stream():
+            yield b"data"
+
+        try:
+            with pytest.raises(MatrixRequestError):
+                await HTTPAPI._send(api, "POST", "upload", stream(), {}, {})
+            assert original_send.call_count == 1
+            assert scheduler.rate_limited == 1
+            assert scheduler.in_flight == 0
+
+            original_send.side_effect = [error, {"event_id": "$a"}]
+            assert await HTTPAPI._send(api, "PUT", "send", {}, {}, {}) == {"event_id": "$a"}
+            assert original_send.call_count == 3
+        finally:
+            scheduler.uninstall()
+
+    @pytest.mark.asyncio
+    async def test_sync_does_not_take_slot(self, mocker) -> None:
+        scheduler = RequestScheduler(asyncio.get_event_loop(), max_concurrent=1, rate=0,
+                                     user_rate=0)
+        release = asyncio.Event()
+
+        async def send(api, method: str, endpoint: str, *args) -> dict:
+            if endpoint.endswith("/sync"):
+                await release.wait()
+            return {}
+
+        mocker.patch.object(HTTPAPI, "_send", send)
+        scheduler.install()
+        api = mocker.Mock(identity=None, bot_mxid="@bot")
+        base = "https://example.com/_matrix/client/r0"
+        try:
+            syncs = [asyncio.ensure_future(HTTPAPI._send(api, "GET", f"{base}/sync", None,
+                                                         {"user_id": f"@{i}"}, {}))
+                     for i in range(2)]
+            await asyncio.sleep(0)
+            message = HTTPAPI._send(api, "PUT", f"{base}/rooms/!a/send/m.room.message/1", {},
+                                    {}, {})
+            assert await asyncio.wait_for(message, 1) == {}
+            assert scheduler.requests == 1
+            release.set()
+            await asyncio.gather(*syncs)
+        finally:
+            scheduler.uninstall()
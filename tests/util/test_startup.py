@@ -0,0 +1,47 @@
+import asyncio
+
+import pytest
+
+from mautrix_telegram.util import run_staggered
+
+
+class TestRunStaggered:
+    @pytest.mark.asyncio
+    async def test_runs_all_in_order_despite_failures(self) -> None:
+        started = []
+
+        def task(i: int):
+            async def start() -> None:
+                started.append(i)
+                if i == 2:
+                    raise ValueError("broken session")
+            return start
+
+        await run_staggered("test tasks", [task(i) for i in range(5)], max_concurrent=1,
+                            jitter=0)
+        assert started == [0, 1, 2, 3, 4]
+
+    @pytest.mark.asyncio
+    async def test_limits_concurrency(self) -> None:
+        running = peak = 0
+
+        async def start() -> None:
+            nonlocal running, peak
+            running += 1
+            peak = max(peak, running)
+            await asyncio.sleep(0.01)
+            running -= 1
+
+        await run_staggered("test tasks", [start] * 10, max_concurrent=3, jitter=0.001)
+        assert peak == 3
+
+    @pytest.mark.asyncio
+    async def test_returns_failure_count(self) -> None:
+        async def fail() -> None:
+            raise ValueError("broken session")
+
+        async def succeed() -> None:
+            pass
+
+        assert await run_staggered("test tasks", [fail, succeed, fail], jitter=0) == 2
+        assert await run_staggered("test tasks", [], jitter=0) == 0
@@ -0,0 +1,93 @@
+import asyncio
+
+import pytest
+
+from mautrix_telegram.util import UpdateDispatcher
+
+
+class TestUpdateDispatcher:
+    @pytest.mark.asyncio
+    async def test_same_key_in_order(self) -> None:
+        dispatcher = UpdateDispatcher(asyncio.get_event_loop(), workers=4)
+        handled = []
+
+        def handler(i: int):
+            async def handle() -> None:
+                # Earlier handlers sleep longer, so running them in parallel would reorder them.
+                await asyncio.sleep((5 - i) / 1000)
+                handled.append(i)
+            return handle
+
+        for i in range(5):
+            await dispatcher.dispatch("portal", handler(i))
+        while dispatcher.queued:
+            await asyncio.sleep(0.01)
+        dispatcher.stop()
+
+        assert handled == [0, 1, 2, 3, 4]
+        assert dispatcher.handled == 5
+
+    @pytest.mark.asyncio
+    async def test_slow_key_does_not_block_others(self) -> None:
+        dispatcher = UpdateDispatcher(asyncio.get_event_loop(), workers=2)
+        slow_started = asyncio.Event()
+        release_slow = asyncio.Event()
+        fast_done = asyncio.Event()
+
+        async def slow() -> None:
+            slow_started.set()
+            await release_slow.wait()
+
+        async def fast() -> None:
+            fast_done.set()
+
+        await dispatcher.dispatch("slow", slow)
+        await slow_started.wait()
+        await dispatcher.dispatch("fast", fast)
+        await asyncio.wait_for(fast_done.wait(), timeout=1)
+        assert dispatcher.active_keys == 1
+
+        release_slow.set()
+        while dispatcher.queued:
+            await asyncio.sleep(0.01)
+        dispatcher.stop()
+
+    @pytest.mark.asyncio
+    async def test_failed_handler_is_counted(self) -> None:
+        dispatcher = UpdateDispatcher(asyncio.get_event_loop(), workers=0)
+
+        async def fail() -> None:
+            raise ValueError("test")
+
+        await dispatcher.dispatch("portal", fail)
+        assert dispatcher.failed == 1
+
+    @pytest.mark.asyncio
+    async def test_dispatch_after(self) -> None:
+        dispatcher = UpdateDispatcher(asyncio.get_event_loop(), workers=2)
+        release = asyncio.Event()
+        handled = []
+
+        async def slow() -> None:
+            await release.wait()
+            handled.append("message")
+
+        async def delete() -> None:
+            handled.append("delete")
+
+        async def other() -> None:
+            handled.append("other")
+
+        await dispatcher.dispatch(("chat", 1), slow)
+        await dispatcher.dispatch_after(lambda key: key[0] == "chat", ("user", 1), delete)
+        await dispatcher.dispatch(("channel", 2), other)
+        await asyncio.sleep(0.01)
+        # The deletion waits for the message, but only holds its slot in the queue.
+        assert handled == ["other"]
+        assert dispatcher.queued == 2
+
+        release.set()
+        await asyncio.wait_for(dispatcher.drain(), timeout=1)
+        dispatcher.stop()
+        assert handled == ["other", "message", "delete"]
+        assert dispatcher.handled == 3
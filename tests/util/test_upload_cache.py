@@ -0,0 +1,110 @@
+from datetime import datetime, timezone
+
+import pytest
+import sqlalchemy as sql
+from telethon.errors import FileIdInvalidError, FloodWaitError, RPCError
+from telethon.tl.types import Document, MessageMediaDocument, MessageMediaPhoto, Photo
+
+from mautrix_telegram.db import Base, UploadedFile, init as init_db
+from mautrix_telegram.util.upload_cache import (get_input_media, has_upload_attributes, hash_file,
+                                                is_stale_upload_error, refresh_upload,
+                                                store_upload)
+
+DATE = datetime(2019, 3, 1, tzinfo=timezone.utc)
+
+
+def photo_media(file_reference: bytes) -> MessageMediaPhoto:
+    return MessageMediaPhoto(Photo(id=10, access_hash=20, file_reference=file_reference,
+                                   date=DATE, sizes=[]))
+
+
+def document_media(file_reference: bytes) -> MessageMediaDocument:
+    return MessageMediaDocument(Document(id=11, access_hash=21, file_reference=file_reference,
+                                         date=DATE, mime_type="image/png", size=1,
+                                         dc_id=1, attributes=[]))
+
+
+@pytest.fixture
+def db(tmpdir):
+    # The uploads are stored from the executor threads, which can't see an in-memory database.
+    db_engine = sql.create_engine(f"sqlite:///{tmpdir.join('uploads.db')}")
+    Base.metadata.create_all(db_engine)
+    init_db(db_engine)
+    yield
+    Base.executor.shutdown()
+
+
+def test_hash_file(tmpdir) -> None:
+    path = tmpdir.join("file")
+    path.write_binary(b"content")
+    assert hash_file(str(path)) == hash_file(b"content")
+    assert hash_file(b"content") != hash_file(b"other content")
+
+
+def test_is_stale_upload_error() -> None:
+    assert is_stale_upload_error(FileIdInvalidError(request=None))
+    assert is_stale_upload_error(RPCError(request=None, message="FILE_REFERENCE_EXPIRED"))
+    assert not is_stale_upload_error(FloodWaitError(request=None, capture=5))
+    assert not is_stale_upload_error(RPCError(request=None, message="CHAT_WRITE_FORBIDDEN"))
+
+
+@pytest.mark.asyncio
+async def test_store_and_reuse(db) -> None:
+    await store_upload(1, "hash", "mxc://a", "m.image", "image/jpeg", photo_media(b"ref"),
+                       "a.jpg", None)
+
+    upload = UploadedFile.get_by_hash(1, "hash")
+    assert upload.is_photo and upload.mime_type == "image/jpeg"
+    assert get_input_media(upload).id.file_reference == b"ref"
+    assert UploadedFile.get_by_mxc(1, "mxc://a", "m.image").content_hash == "hash"
+    assert UploadedFile.get_by_mxc(1, "mxc://a", "m.file") is None
+    # Uploads are per user, since other users can't use the file reference.
+    assert UploadedFile.get_by_hash(2, "hash") is None
+    assert UploadedFile.get_by_mxc(2, "mxc://a", "m.image") is None
+
+
+@pytest.mark.asyncio
+async def test_every_mxc_maps_to_the_upload(db) -> None:
+    await store_upload(1, "hash", "mxc://a", "m.image", "image/jpeg", photo_media(b"ref"),
+                       "a.jpg", None)
+    # The same content was sent again from another mxc URI and found by its hash.
+    await refresh_upload(UploadedFile.get_by_hash(1, "hash"), "mxc://b", "m.image",
+                         photo_media(b"new ref"))
+
+    for mxc in ("mxc://a", "mxc://b"):
+        upload = UploadedFile.get_by_mxc(1, mxc, "m.image")
+        assert upload.content_hash == "hash"
+        assert upload.file_reference == b"new ref"
+
+
+@pytest.mark.asyncio
+async def test_stale_upload_is_replaced(db) -> None:
+    await store_upload(1, "hash", "mxc://a", "m.image", "image/jpeg", photo_media(b"ref"),
+                       "a.jpg", None)
+    await refresh_upload(UploadedFile.get_by_hash(1, "hash"), "mxc://b", "m.image", None)
+
+    # What the portal does when sending the stored upload fails with a stale reference error.
+    UploadedFile.get_by_hash(1, "hash").delete()
+    assert UploadedFile.get_by_mxc(1, "mxc://a", "m.image") is None
+
+    await store_upload(1, "hash", "mxc://b", "m.image", "image/jpeg", photo_media(b"fresh"),
+                       "a.jpg", None)
+    for mxc in ("mxc://a", "mxc://b"):
+        assert UploadedFile.get_by_mxc(1, mxc, "m.image").file_reference == b"fresh"
+
+
+@pytest.mark.asyncio
+async def test_document_attributes_must_match(db) -> None:
+    await store_upload(1, "hash", "mxc://a", "m.file", "image/png", document_media(b"ref"),
+                       "a.png", (10, 20))
+
+    upload = UploadedFile.get_by_hash(1, "hash")
+    assert has_upload_attributes(upload, "a.png", (10, 20))
+    # Telegram would show the name and size of the first upload.
+    assert not has_upload_attributes(upload, "b.png", (10, 20))
+    assert not has_upload_attributes(upload, "a.png", None)
+
+    await store_upload(1, "hash", "mxc://a", "m.image", "image/jpeg", photo_media(b"ref"),
+                       "a.jpg", (10, 20))
+    # Photos don't have attributes.
+    assert has_upload_attributes(UploadedFile.get_by_hash(1, "hash"), "b.jpg", None)